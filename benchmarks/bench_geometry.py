@@ -0,0 +1,77 @@
+"""
+Benchmarks of tile geometry: splitting tiles into subtiles,
+and computing the coordinates of their pixels
+"""
+from __future__ import print_function, division
+from time import time
+
+import numpy as np
+
+from toasty._libtoasty import subsample, mid
+from toasty.tile import iter_corners, TileTable
+
+
+class Subsample(object):
+    """The (lon, lat) of each pixel of a tile"""
+
+    params = [[64, 256, 512], [True, False]]
+    param_names = ['npix', 'increasing']
+
+    def setup(self, npix, increasing):
+        corners = next(iter_corners(3))[1]
+        self.corners = [np.asarray(c, dtype=float) for c in corners]
+
+    def time_subsample(self, npix, increasing):
+        c = self.corners
+        subsample(c[0], c[1], c[2], c[3], npix, increasing)
+
+
+class Mid(object):
+    """The great-circle midpoint of two points"""
+
+    def setup(self):
+        rng = np.random.RandomState(0)
+        self.points = [(tuple(a), tuple(b)) for a, b in
+                       zip(rng.uniform(-1, 1, (1000, 2)),
+                           rng.uniform(-1, 1, (1000, 2)))]
+
+    def time_mid_1000(self):
+        for a, b in self.points:
+            mid(a, b)
+
+
+class IterCorners(object):
+    """Traversing the tile hierarchy, with and without pruning"""
+
+    params = [[4, 6, 8], [False, True]]
+    param_names = ['depth', 'pruned']
+
+    def prune(self, tile):
+        return tile[0].x % 2 == 1
+
+    def run(self, depth, pruned):
+        prune = self.prune if pruned else None
+        return sum(1 for item in iter_corners(depth, bottom_only=False,
+                                              prune=prune))
+
+    def time_iter_corners(self, depth, pruned):
+        self.run(depth, pruned)
+
+    def track_tiles_per_second(self, depth, pruned):
+        start = time()
+        count = self.run(depth, pruned)
+        return count / (time() - start)
+    track_tiles_per_second.unit = 'tiles/s'
+
+
+class BuildTileTable(object):
+    """Building the corners of every tile of a level as arrays"""
+
+    params = [4, 6, 8]
+    param_names = ['depth']
+
+    def time_level(self, depth):
+        TileTable().level(depth)
+
+    def peakmem_level(self, depth):
+        TileTable().level(depth)
@@ -0,0 +1,50 @@
+"""
+Benchmarks of encoding and writing tiles
+"""
+from __future__ import print_function, division
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from toasty.io import save_png, TileEncoder
+
+from .common import noise_tile
+
+
+class SavePNG(object):
+    """Writing a tile with save_png"""
+
+    params = [['grey', 'rgb'], ['noise', 'smooth']]
+    param_names = ['channels', 'content']
+
+    def setup(self, channels, content):
+        shape = (256, 256) if channels == 'grey' else (256, 256, 3)
+        if content == 'noise':
+            self.tile = noise_tile(shape)
+        else:
+            y = np.indices(shape)[0]
+            self.tile = (y % 256).astype(np.uint8)
+        self.direc = tempfile.mkdtemp()
+        self.pth = os.path.join(self.direc, 'tile.png')
+
+    def teardown(self, channels, content):
+        shutil.rmtree(self.direc)
+
+    def time_save_png(self, channels, content):
+        save_png(self.pth, self.tile)
+
+
+class Encode(object):
+    """Encoding a tile in memory, in each format"""
+
+    params = ['png', 'jpeg']
+    param_names = ['format']
+
+    def setup(self, format):
+        self.tile = noise_tile()
+        self.encoder = TileEncoder(format)
+
+    def time_encode(self, format):
+        self.encoder.encode(self.tile)
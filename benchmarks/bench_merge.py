@@ -0,0 +1,69 @@
+"""
+Benchmarks of merging tiles into their parents
+"""
+from __future__ import print_function, division
+from time import time
+
+import numpy as np
+
+from toasty.merge import MergeKernel
+from toasty.tile import (iter_corners, _new_parents, _trickle_up,
+                         _mean_kernel)
+
+
+def _tile(dtype):
+    rng = np.random.RandomState(0)
+    return rng.uniform(0, 255, (256, 256)).astype(dtype)
+
+
+class Merge(object):
+    """Merging four subtiles with each built-in kernel"""
+
+    params = [['mean', 'nanmean', 'max', 'nearest'],
+              ['uint8', 'float32', 'float64']]
+    param_names = ['method', 'dtype']
+
+    def setup(self, method, dtype):
+        self.kernel = MergeKernel(method)
+        self.tiles = [_tile(dtype) for i in range(4)]
+        self.mosaic = np.vstack((np.hstack(self.tiles[:2]),
+                                 np.hstack(self.tiles[2:])))
+
+    def time_kernel(self, method, dtype):
+        self.kernel.merge(*self.tiles)
+
+    def time_mosaic(self, method, dtype):
+        self.kernel(self.mosaic)
+
+
+class TrickleUp(object):
+    """
+    Propagating every tile of a level up the hierarchy,
+    as iter_tiles does after sampling them
+    """
+
+    params = [[3, 4, 5], [True, False]]
+    param_names = ['depth', 'merge']
+
+    def setup(self, depth, merge):
+        self.nodes = [t[0] for t in iter_corners(depth)]
+        self.tile = _tile(np.uint8)
+        self.merge = _mean_kernel if merge else False
+
+    def run(self, depth, merge):
+        parents = _new_parents(None)
+        count = 0
+        for node in self.nodes:
+            for item in _trickle_up(self.tile, node, parents, self.merge,
+                                    depth):
+                count += 1
+        return count
+
+    def time_trickle_up(self, depth, merge):
+        self.run(depth, merge)
+
+    def track_tiles_per_second(self, depth, merge):
+        start = time()
+        count = self.run(depth, merge)
+        return count / (time() - start)
+    track_tiles_per_second.unit = 'tiles/s'
@@ -0,0 +1,41 @@
+"""
+Benchmarks of intensity scaling
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+from toasty.norm import warpers, normalize
+
+from .common import noise_tile
+
+
+class Warp(object):
+    """Each stretch in norm.warpers, applied to a tile"""
+
+    params = [sorted(warpers), ['float32', 'float64']]
+    param_names = ['stretch', 'dtype']
+
+    def setup(self, stretch, dtype):
+        rng = np.random.RandomState(0)
+        self.tile = rng.uniform(0, 1000, (256, 256)).astype(dtype)
+
+    def time_warp(self, stretch, dtype):
+        warpers[stretch](self.tile, 100, 900, 0.5, 1)
+
+    def time_normalize(self, stretch, dtype):
+        normalize(self.tile, 100, 900, 0.5, 1, stretch)
+
+
+class NormalizeInteger(object):
+    """Integer tiles, scaled through cached lookup tables"""
+
+    params = [['uint8', 'int16', 'uint16'], ['linear', 'log']]
+    param_names = ['dtype', 'stretch']
+
+    def setup(self, dtype, stretch):
+        self.tile = noise_tile((256, 256), dtype)
+        normalize(self.tile, 10, 200, 0.5, 1, stretch)  # warm the table
+
+    def time_normalize(self, dtype, stretch):
+        normalize(self.tile, 10, 200, 0.5, 1, stretch)
@@ -0,0 +1,49 @@
+"""
+Benchmarks of sampling datasets at the pixels of a tile
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+from toasty import cartesian_sampler, healpix_sampler
+from toasty._libtoasty import subsample
+from toasty.tile import iter_corners
+
+from .common import cartesian_image, healpix_map, require_healpy
+
+
+def _tile_coords(depth=3):
+    corners, increasing = list(iter_corners(depth))[5][1:]
+    c = [np.asarray(x, dtype=float) for x in corners]
+    return subsample(c[0], c[1], c[2], c[3], 256, increasing)
+
+
+class CartesianSampler(object):
+    """Sampling a plate carree image, in equatorial and galactic frames"""
+
+    params = [['C', 'G'], ['nearest', 'bilinear'], ['uint8', 'float32']]
+    param_names = ['coord', 'interpolation', 'dtype']
+
+    def setup(self, coord, interpolation, dtype):
+        self.l, self.b = _tile_coords()
+        self.sampler = cartesian_sampler(cartesian_image(dtype=dtype),
+                                         coord=coord,
+                                         interpolation=interpolation)
+
+    def time_sample(self, coord, interpolation, dtype):
+        self.sampler(self.l, self.b)
+
+
+class HealpixSampler(object):
+    """Sampling a healpix map, in equatorial and galactic frames"""
+
+    params = [['C', 'G'], [False, True]]
+    param_names = ['coord', 'nest']
+
+    def setup(self, coord, nest):
+        require_healpy()
+        self.l, self.b = _tile_coords()
+        self.sampler = healpix_sampler(healpix_map(), nest=nest, coord=coord)
+
+    def time_sample(self, coord, nest):
+        self.sampler(self.l, self.b)
@@ -0,0 +1,47 @@
+"""
+End to end benchmarks of building a pyramid with toast()
+"""
+from __future__ import print_function, division
+import shutil
+import tempfile
+from time import time
+
+from toasty import toast, cartesian_sampler, normalizer
+
+from .common import cartesian_image, ntiles
+
+
+class Toast(object):
+    """
+    Building a whole pyramid from a plate carree image. Float images
+    are scaled to 8 bits with normalizer, as they would be in practice
+    """
+
+    params = [[1, 2, 3, 4], ['uint8', 'float32']]
+    param_names = ['depth', 'dtype']
+    timeout = 300
+
+    def setup(self, depth, dtype):
+        sampler = cartesian_sampler(cartesian_image(dtype=dtype))
+        if dtype != 'uint8':
+            sampler = normalizer(sampler, 0, 255)
+        self.sampler = sampler
+        self.direc = tempfile.mkdtemp()
+
+    def teardown(self, depth, dtype):
+        shutil.rmtree(self.direc)
+
+    def run(self, depth):
+        toast(self.sampler, depth, self.direc)
+
+    def time_toast(self, depth, dtype):
+        self.run(depth)
+
+    def peakmem_toast(self, depth, dtype):
+        self.run(depth)
+
+    def track_tiles_per_second(self, depth, dtype):
+        start = time()
+        self.run(depth)
+        return ntiles(depth) / (time() - start)
+    track_tiles_per_second.unit = 'tiles/s'
@@ -0,0 +1,48 @@
+"""
+Synthetic datasets shared by the benchmarks. Everything is generated
+from fixed seeds, so benchmarks need no data files or network access.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+try:
+    import healpy
+except ImportError:
+    healpy = None
+
+
+def cartesian_image(shape=(1024, 2048), dtype=np.uint8, channels=None):
+    """A smooth all-sky image with noise, in plate carree"""
+    rng = np.random.RandomState(0)
+    y, x = np.mgrid[0:shape[0], 0:shape[1]]
+    im = 100 + 80 * np.sin(x / 50.) * np.cos(y / 30.)
+    im = im + rng.normal(0, 10, shape)
+    if channels is not None:
+        im = np.dstack([im] * channels)
+    if np.dtype(dtype).kind in 'ui':
+        im = np.clip(im, 0, 255)
+    return im.astype(dtype)
+
+
+def noise_tile(shape=(256, 256, 3), dtype=np.uint8):
+    """A tile of random integers between 0 and 255"""
+    rng = np.random.RandomState(0)
+    return rng.randint(0, 255, shape).astype(dtype)
+
+
+def healpix_map(nside=256, dtype=np.float32):
+    """A random healpix map"""
+    rng = np.random.RandomState(0)
+    return rng.uniform(0, 255, 12 * nside ** 2).astype(dtype)
+
+
+def require_healpy():
+    """Skip a benchmark (as asv does) when healpy is missing"""
+    if healpy is None:
+        raise NotImplementedError("healpy is not installed")
+
+
+def ntiles(depth):
+    """The number of tiles in a pyramid of the given depth"""
+    return (4 ** (depth + 1) - 1) // 3
@@ -1,8 +1,20 @@
+import sys
+
 from setuptools import setup, Extension, find_packages
 from Cython.Distutils import build_ext
 import numpy as np
 
-ext_modules = [Extension("toasty._libtoasty", ["toasty/_libtoasty.pyx"])]
+# the default compilers on OSX do not support OpenMP
+if sys.platform == 'win32':
+    openmp = ['/openmp']
+elif sys.platform == 'darwin':
+    openmp = []
+else:
+    openmp = ['-fopenmp']
+
+ext_modules = [Extension("toasty._libtoasty", ["toasty/_libtoasty.pyx"],
+                         extra_compile_args=openmp,
+                         extra_link_args=openmp)]
 setup(
         name = "toasty",
         version='0.0.1',
@@ -1,3 +1,8 @@
 from .tile import (toast, iter_tiles, depth2tiles,
                    healpix_sampler, cartesian_sampler,
                    normalizer, gen_wtml)
+from .cache import GeometryCache, HealpixIndexCache
+from .io import TileEncoder
+from .manifest import Manifest
+from .merge import MergeKernel
+from .stats import BuildStats
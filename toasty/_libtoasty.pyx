@@ -1,18 +1,36 @@
-from libc.math cimport sin, cos, atan2, hypot
+from libc.math cimport sin, cos, atan2, hypot, isnan, NAN, fmod, floor
+from libc.stdlib cimport malloc, free
 import numpy as np
 
 cimport cython
+from cython cimport floating
+from cython.parallel cimport prange
 
 cimport numpy as np
 
-DTYPE = np.float
-ctypedef np.float_t DTYPE_t
+DTYPE = np.float64
+ctypedef np.float64_t DTYPE_t
+
+ctypedef fused pixel:
+    np.uint8_t
+    np.uint16_t
+    np.int16_t
+    np.int32_t
+    np.int64_t
+    np.float32_t
+    np.float64_t
+
+# merge kernels, see downsample
+DEF MEAN = 0
+DEF NANMEAN = 1
+DEF MAX = 2
+DEF NEAREST = 3
 
 cdef struct Point:
     DTYPE_t x
     DTYPE_t y
 
-cdef void _mid(Point a, Point b, Point *cen):
+cdef void _mid(Point a, Point b, Point *cen) nogil:
     """
     Return the midpoint of two points on a great circle arc
 
@@ -40,14 +58,21 @@ def mid(a, b):
 
 
 @cython.boundscheck(False)
-cdef void _subsample(Point ul, Point ur, Point lr, Point ll,
-                    DTYPE_t [:, :] x,
-                    DTYPE_t [:, :] y,
-                    int increasing):
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int _subsample(Point ul, Point ur, Point lr, Point ll,
+                    floating [:, :] x,
+                    floating [:, :] y,
+                    int increasing) nogil:
     """
     Given the corners of a toast tile, return the
     sky locations of a subsampled version
 
+    The tile is refined one level at a time, on a grid of
+    (n+1) x (n+1) cell corners. Each sweep fills in the edge
+    midpoints and centers of every cell at the current level, and
+    the final sweep writes the center of each 1x1 cell to (x, y).
+
     Parameters
     ----------
     ul, ur, lr, ll: Points
@@ -59,32 +84,88 @@ cdef void _subsample(Point ul, Point ur, Point lr, Point ll,
          If 1, the shared edge of the toast tile's two sub-HTM
          trixels increases from left to right. Otherwise, it
          decreases from left to right
-    n : int
-        The number of pixels in x and y
+
+    Returns
+    -------
+    0 on success, -1 if the work buffer could not be allocated
     """
-    cdef Point le, up, lo, ri, cen
     cdef int n = x.shape[0]
-    cdef int n2 = n / 2
+    cdef int m = n + 1
+    cdef int step = n, half, cells, i, j, ii, jj
+    cdef Point cen
+    cdef Point *grid = <Point *> malloc(m * m * sizeof(Point))
 
-    _mid(ul, ur, &up)
-    _mid(ul, ll, &le)
-    _mid(ur, lr, &ri)
-    _mid(ll, lr, &lo)
+    if grid == NULL:
+        return -1
 
-    if increasing:
-        _mid(ll, ur, &cen)
-    else:
-        _mid(ul, lr, &cen)
+    grid[0] = ul
+    grid[n] = ur
+    grid[n * m + n] = lr
+    grid[n * m] = ll
 
-    if n == 1:
-        x[0] = cen.x
-        y[0] = cen.y
-        return
+    while step > 1:
+        half = step / 2
+        cells = n / step
+
+        # horizontal edges, left to right
+        for ii in range(cells + 1):
+            i = ii * step
+            for jj in range(cells):
+                j = jj * step
+                _mid(grid[i * m + j], grid[i * m + j + step],
+                     &grid[i * m + j + half])
 
-    _subsample(ul, up, cen, le, x[:n2, :n2], y[:n2, :n2], increasing)
-    _subsample(up, ur, ri, cen, x[:n2, n2:], y[:n2, n2:], increasing)
-    _subsample(le, cen, lo, ll, x[n2:, :n2], y[n2:, :n2], increasing)
-    _subsample(cen, ri, lr, lo, x[n2:, n2:], y[n2:, n2:], increasing)
+        # vertical edges, top to bottom
+        for ii in range(cells):
+            i = ii * step
+            for jj in range(cells + 1):
+                j = jj * step
+                _mid(grid[i * m + j], grid[(i + step) * m + j],
+                     &grid[(i + half) * m + j])
+
+        # cell centers, along the shared edge of the two trixels
+        for ii in range(cells):
+            i = ii * step
+            for jj in range(cells):
+                j = jj * step
+                if increasing:
+                    _mid(grid[(i + step) * m + j], grid[i * m + j + step],
+                         &grid[(i + half) * m + j + half])
+                else:
+                    _mid(grid[i * m + j], grid[(i + step) * m + j + step],
+                         &grid[(i + half) * m + j + half])
+        step = half
+
+    for i in range(n):
+        for j in range(n):
+            if increasing:
+                _mid(grid[(i + 1) * m + j], grid[i * m + j + 1], &cen)
+            else:
+                _mid(grid[i * m + j], grid[(i + 1) * m + j + 1], &cen)
+            x[i, j] = cen.x
+            y[i, j] = cen.y
+
+    free(grid)
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _subsample_many(DTYPE_t [:, :, ::1] corners,
+                         int [::1] increasing,
+                         floating [:, :, :] x,
+                         floating [:, :, :] y) nogil:
+    cdef Py_ssize_t i
+    cdef int err = 0
+    cdef Point ul, ur, lr, ll
+
+    for i in prange(corners.shape[0], schedule='dynamic'):
+        ul.x, ul.y = corners[i, 0, 0], corners[i, 0, 1]
+        ur.x, ur.y = corners[i, 1, 0], corners[i, 1, 1]
+        lr.x, lr.y = corners[i, 2, 0], corners[i, 2, 1]
+        ll.x, ll.y = corners[i, 3, 0], corners[i, 3, 1]
+        err += _subsample(ul, ur, lr, ll, x[i], y[i], increasing[i])
+    return err
 
 
 def subsample(ul, ur, lr, ll, npix, increasing):
@@ -113,13 +194,618 @@ def subsample(ul, ur, lr, ll, npix, increasing):
 
     cdef Point _ul, _ur, _lr, _ll
     cdef int _inc = (1 if increasing else 0)
+    cdef int err
+    cdef double [:, :] _x, _y
 
     x = np.zeros((npix, npix), dtype=DTYPE)
     y = np.zeros((npix, npix), dtype=DTYPE)
+    _x, _y = x, y
 
     _ul = Point(DTYPE(ul[0]), DTYPE(ul[1]))
     _ur = Point(DTYPE(ur[0]), DTYPE(ur[1]))
     _lr = Point(DTYPE(lr[0]), DTYPE(lr[1]))
     _ll = Point(DTYPE(ll[0]), DTYPE(ll[1]))
-    _subsample(_ul, _ur, _lr, _ll, x, y, increasing)
+
+    with nogil:
+        err = _subsample(_ul, _ur, _lr, _ll, _x, _y, _inc)
+    if err:
+        raise MemoryError()
     return x, y
+
+
+def subsample_many(corners, increasing, lon=None, lat=None, npix=256):
+    """Subdivide many toast quads at once
+
+    The work is split over tiles with OpenMP (when toasty is compiled
+    with OpenMP support), and runs without holding the GIL.
+
+    Parameters
+    ----------
+    corners : array-like
+        An (N, 4, 2) array giving the (lon, lat) positions of the
+        (ul, ur, lr, ll) corners of each tile, in radians
+    increasing : array-like
+        A length-N boolean array, giving the increasing flag of each tile
+    lon, lat : arrays (optional)
+        (N, npix, npix) float32 or float64 arrays to write the
+        pixel locations into. If not provided, new float64
+        arrays are created
+    npix : int (default 256)
+        The pixel resolution of each subsampled image, if lon and lat
+        are not provided. Must be a power of 2
+
+    Returns
+    -------
+    lon, lat
+    """
+    corners = np.ascontiguousarray(corners, dtype=DTYPE)
+    inc = np.ascontiguousarray(increasing, dtype=np.intc)
+    if corners.ndim != 3 or corners.shape[1:] != (4, 2):
+        raise ValueError("corners must have shape (N, 4, 2)")
+    if inc.shape != (corners.shape[0],):
+        raise ValueError("increasing must have one entry per tile")
+
+    if lon is None and lat is None:
+        lon = np.empty((corners.shape[0], npix, npix), dtype=DTYPE)
+        lat = np.empty((corners.shape[0], npix, npix), dtype=DTYPE)
+    elif lon is None or lat is None:
+        raise ValueError("Must provide both lon and lat, or neither")
+
+    shp = lon.shape
+    if lat.shape != shp or lon.dtype != lat.dtype:
+        raise ValueError("lon and lat must have the same shape and dtype")
+    if len(shp) != 3 or shp[0] != corners.shape[0] or shp[1] != shp[2]:
+        raise ValueError("lon and lat must have shape (N, npix, npix)")
+    if 2 ** int(np.log2(shp[1])) != shp[1]:
+        raise ValueError("npix must be a power of 2: %i" % shp[1])
+
+    cdef DTYPE_t [:, :, ::1] _c = corners
+    cdef int [::1] _inc = inc
+    cdef float [:, :, :] x32, y32
+    cdef double [:, :, :] x64, y64
+    cdef int err
+
+    if lon.dtype == np.float32:
+        x32, y32 = lon, lat
+        with nogil:
+            err = _subsample_many(_c, _inc, x32, y32)
+    elif lon.dtype == np.float64:
+        x64, y64 = lon, lat
+        with nogil:
+            err = _subsample_many(_c, _inc, x64, y64)
+    else:
+        raise TypeError("lon and lat must be float32 or float64")
+
+    if err:
+        raise MemoryError()
+    return lon, lat
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _divide_tiles(DTYPE_t [:, :, ::1] c, int [::1] inc, Py_ssize_t w,
+                        DTYPE_t [:, :, ::1] out, int [::1] out_inc) nogil:
+    cdef Py_ssize_t i, j, k, x, y, child
+    cdef Point ul, ur, lr, ll, to, ri, bo, le, ce
+    cdef Point q[16]
+
+    for i in range(c.shape[0]):
+        y = i // w
+        x = i - y * w
+        ul.x, ul.y = c[i, 0, 0], c[i, 0, 1]
+        ur.x, ur.y = c[i, 1, 0], c[i, 1, 1]
+        lr.x, lr.y = c[i, 2, 0], c[i, 2, 1]
+        ll.x, ll.y = c[i, 3, 0], c[i, 3, 1]
+
+        # the same midpoints, with the same argument order, as tile._div4
+        _mid(ul, ur, &to)
+        _mid(ur, lr, &ri)
+        _mid(lr, ll, &bo)
+        _mid(ll, ul, &le)
+        if inc[i]:
+            _mid(ll, ur, &ce)
+        else:
+            _mid(ul, lr, &ce)
+
+        q[0] = ul; q[1] = to; q[2] = ce; q[3] = le
+        q[4] = to; q[5] = ur; q[6] = ri; q[7] = ce
+        q[8] = le; q[9] = ce; q[10] = bo; q[11] = ll
+        q[12] = ce; q[13] = ri; q[14] = lr; q[15] = bo
+
+        for j in range(4):
+            child = (2 * y + j // 2) * 2 * w + 2 * x + j % 2
+            for k in range(4):
+                out[child, k, 0] = q[4 * j + k].x
+                out[child, k, 1] = q[4 * j + k].y
+            out_inc[child] = inc[i]
+
+
+def divide_tiles(corners, increasing):
+    """Compute the corners of every tile one level below a full level
+
+    Parameters
+    ----------
+    corners : array-like
+        A (4^n, 4, 2) array giving the (lon, lat) positions of the
+        (ul, ur, lr, ll) corners of every tile at level n, with tile
+        (n, x, y) at index y * 2^n + x
+    increasing : array-like
+        A length 4^n boolean array, giving the increasing flag of each tile
+
+    Returns
+    -------
+    corners, increasing
+        The same arrays for level n + 1. Corners are bit-for-bit
+        identical to those computed tile by tile with mid
+    """
+    corners = np.ascontiguousarray(corners, dtype=DTYPE)
+    inc = np.ascontiguousarray(increasing, dtype=np.intc)
+    if corners.ndim != 3 or corners.shape[1:] != (4, 2):
+        raise ValueError("corners must have shape (N, 4, 2)")
+    if inc.shape != (corners.shape[0],):
+        raise ValueError("increasing must have one entry per tile")
+    w = int(round(np.sqrt(corners.shape[0])))
+    if w * w != corners.shape[0] or w & (w - 1):
+        raise ValueError("corners must describe every tile of one level")
+
+    out = np.empty((4 * w * w, 4, 2), dtype=DTYPE)
+    out_inc = np.empty(4 * w * w, dtype=np.intc)
+    cdef DTYPE_t [:, :, ::1] _c = corners, _out = out
+    cdef int [::1] _inc = inc, _out_inc = out_inc
+    cdef Py_ssize_t _w = w
+    with nogil:
+        _divide_tiles(_c, _inc, _w, _out, _out_inc)
+    return out, out_inc.astype(bool)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _downsample(const pixel [:, :, :] src, pixel [:, :, :] out,
+                      Py_ssize_t r0, Py_ssize_t c0, int method) nogil:
+    """
+    Downsample src by 2 in each direction, and write the
+    result into out, starting at pixel (r0, c0)
+    """
+    cdef Py_ssize_t i, j, k, nk = src.shape[2]
+    cdef pixel a, b, c, d, best, total
+    cdef int count
+
+    for i in range(src.shape[0] // 2):
+        for j in range(src.shape[1] // 2):
+            for k in range(nk):
+                a = src[2 * i, 2 * j, k]
+                b = src[2 * i + 1, 2 * j, k]
+                c = src[2 * i, 2 * j + 1, k]
+                d = src[2 * i + 1, 2 * j + 1, k]
+
+                if method == NEAREST:
+                    out[r0 + i, c0 + j, k] = a
+                elif method == MAX:
+                    best = a
+                    if pixel is np.float32_t or pixel is np.float64_t:
+                        # ignore NaNs, like np.fmax
+                        if b > best or isnan(best):
+                            best = b
+                        if c > best or isnan(best):
+                            best = c
+                        if d > best or isnan(best):
+                            best = d
+                    else:
+                        if b > best:
+                            best = b
+                        if c > best:
+                            best = c
+                        if d > best:
+                            best = d
+                    out[r0 + i, c0 + j, k] = best
+                elif pixel is np.float32_t or pixel is np.float64_t:
+                    if method == NANMEAN:
+                        total = 0
+                        count = 0
+                        if not isnan(a):
+                            total += a
+                            count += 1
+                        if not isnan(b):
+                            total += b
+                            count += 1
+                        if not isnan(c):
+                            total += c
+                            count += 1
+                        if not isnan(d):
+                            total += d
+                            count += 1
+                        out[r0 + i, c0 + j, k] = (total / count
+                                                  if count else NAN)
+                    else:
+                        # the same operations, in the same precision,
+                        # as numpy's mosaic / 4. in the original merge
+                        out[r0 + i, c0 + j, k] = (a / <pixel> 4 +
+                                                  b / <pixel> 4 +
+                                                  c / <pixel> 4 +
+                                                  d / <pixel> 4)
+                else:
+                    # truncate like _default_merge, which casts
+                    # the float average back to an integer
+                    out[r0 + i, c0 + j, k] = <pixel> (
+                        (<np.int64_t> a + <np.int64_t> b +
+                         <np.int64_t> c + <np.int64_t> d) / 4)
+
+
+_pixel_dtypes = [np.dtype(t) for t in (np.uint8, np.uint16, np.int16,
+                                        np.int32, np.int64, np.float32,
+                                        np.float64)]
+
+
+def _downsample_children(pixel [:, :, :] ul, pixel [:, :, :] ur,
+                         pixel [:, :, :] bl, pixel [:, :, :] br,
+                         pixel [:, :, :] out, int method):
+    cdef Py_ssize_t h = ul.shape[0] // 2, w = ul.shape[1] // 2
+    with nogil:
+        _downsample(ul, out, 0, 0, method)
+        _downsample(ur, out, 0, w, method)
+        _downsample(bl, out, h, 0, method)
+        _downsample(br, out, h, w, method)
+
+
+def downsample(ul, ur, bl, br, out=None, method=MEAN):
+    """Merge the four subtiles of a tile, without building a mosaic
+
+    Each 2x2 block of subtile pixels becomes one pixel of the output.
+
+    Parameters
+    ----------
+    ul, ur, bl, br : arrays
+        The upper left, upper right, bottom left and bottom right
+        subtiles. They must have the same shape, an even number
+        of rows and columns, and the same dtype: one of uint8, uint16,
+        int16, int32, int64, float32 or float64
+    out : array (optional)
+        An array with the same shape and dtype as each subtile,
+        to write the merged tile into
+    method : int (default 0)
+        0 to average each block (truncating integers, like the
+        default merge), 1 to average the non-NaN pixels of each
+        block, 2 to take the maximum, ignoring NaNs, and 3 to
+        take the upper left pixel
+
+    Returns
+    -------
+    out
+    """
+    # typed memoryviews need writeable buffers
+    tiles = [np.asarray(t) for t in (ul, ur, bl, br)]
+    tiles = [t if t.flags.writeable else t.copy() for t in tiles]
+    shp, dtype = tiles[0].shape, tiles[0].dtype
+    for t in tiles[1:]:
+        if t.shape != shp or t.dtype != dtype:
+            raise ValueError("Subtiles must have the same shape and dtype")
+    if dtype not in _pixel_dtypes:
+        raise TypeError("Unsupported dtype: %s" % dtype)
+    if len(shp) not in (2, 3) or shp[0] % 2 or shp[1] % 2:
+        raise ValueError("Subtiles must be 2D or 3D arrays, "
+                         "with an even number of rows and columns")
+    if method not in (MEAN, NANMEAN, MAX, NEAREST):
+        raise ValueError("Invalid merge method: %s" % method)
+
+    if out is None:
+        out = np.empty(shp, dtype=dtype)
+    elif out.shape != shp or out.dtype != dtype:
+        raise ValueError("out must have the same shape and dtype "
+                         "as the subtiles")
+
+    if len(shp) == 2:
+        tiles = [t[:, :, np.newaxis] for t in tiles]
+        result = out[:, :, np.newaxis]
+    else:
+        result = out
+
+    _downsample_children(tiles[0], tiles[1], tiles[2], tiles[3],
+                         result, method)
+    return out
+
+
+# interpolation schemes, see sample_cartesian
+DEF NEAREST_PIXEL = 0
+DEF BILINEAR = 1
+DEF BICUBIC = 2
+
+cdef double PI = np.pi
+cdef double TWO_PI = 2 * np.pi
+cdef double HALF_PI = np.pi / 2
+
+
+cdef inline void _cartesian_pixel(double lon, double lat,
+                                  Py_ssize_t nx, Py_ssize_t ny,
+                                  double *u, double *v) nogil:
+    """
+    The (column, row) position of (lon, lat) in a cartesian map.
+    Pixel (i, j) covers columns [i, i + 1) and rows [j, j + 1)
+    """
+    cdef double m = fmod(lon + PI, TWO_PI)
+    if m < 0:  # floor modulo, like numpy's %
+        m += TWO_PI
+    u[0] = nx * (1 - m / TWO_PI)
+    v[0] = ny * (1 - (lat + HALF_PI) / PI)
+
+
+cdef inline Py_ssize_t _nearest_index(double u, Py_ssize_t n) nogil:
+    """Truncate and clip a pixel position. NaNs map to 0"""
+    if isnan(u) or u < 0:
+        return 0
+    if u > n - 1:
+        return n - 1
+    return <Py_ssize_t> u
+
+
+cdef struct Window:
+    # the shape of the full map, and the position of the
+    # sampled array's first pixel in it
+    Py_ssize_t ny, nx, row0, col0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline pixel _fetch(const pixel [:, :, :] data, Window win,
+                         Py_ssize_t r, Py_ssize_t c, Py_ssize_t ch) nogil:
+    """
+    Read full map pixel (r, c) from a window. Columns wrap around,
+    and pixels outside the window are clamped to its edges
+    """
+    r = min(max(r, 0), win.ny - 1) - win.row0
+    c = c % win.nx
+    if c < 0:
+        c += win.nx
+    c = (c - win.col0) % win.nx
+    if c < 0:
+        c += win.nx
+    r = min(max(r, 0), data.shape[0] - 1)
+    c = min(c, data.shape[1] - 1)
+    return data[r, c, ch]
+
+
+cdef inline void _cubic_weights(double t, double *w) nogil:
+    """Catmull-Rom weights for offsets -1, 0, 1, 2"""
+    w[0] = ((-0.5 * t + 1) * t - 0.5) * t
+    w[1] = (1.5 * t - 2.5) * t * t + 1
+    w[2] = ((-1.5 * t + 2) * t + 0.5) * t
+    w[3] = (0.5 * t - 0.5) * t * t
+
+
+@cython.cdivision(True)
+cdef inline double _interpolate(const pixel [:, :, :] data, Window win,
+                                double u, double v, Py_ssize_t ch,
+                                int method) nogil:
+    """
+    Interpolate one channel of a map at (column, row) = (u, v).
+    Columns wrap around, and rows are clamped at the poles.
+    NaN pixels are ignored
+    """
+    cdef Py_ssize_t x0, y0, i, j
+    cdef double fx = u - 0.5, fy = v - 0.5, tx, ty, val, w, total, weight
+    cdef double wx[4]
+    cdef double wy[4]
+
+    x0 = <Py_ssize_t> floor(fx)
+    y0 = <Py_ssize_t> floor(fy)
+    tx = fx - x0
+    ty = fy - y0
+
+    if method == BICUBIC:
+        _cubic_weights(tx, wx)
+        _cubic_weights(ty, wy)
+        total = 0
+        for j in range(4):
+            for i in range(4):
+                val = _fetch(data, win, y0 + j - 1, x0 + i - 1, ch)
+                if val != val:  # NaN: use bilinear weights instead
+                    break
+                total += wx[i] * wy[j] * val
+            else:
+                continue
+            break
+        else:
+            return total
+
+    # bilinear, ignoring NaNs
+    wx[0], wx[1] = 1 - tx, tx
+    wy[0], wy[1] = 1 - ty, ty
+    total = 0
+    weight = 0
+    for j in range(2):
+        for i in range(2):
+            val = _fetch(data, win, y0 + j, x0 + i, ch)
+            w = wx[i] * wy[j]
+            if val == val and w > 0:
+                total += w * val
+                weight += w
+    if weight == 0:
+        return NAN
+    return total / weight
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _sample_pixel(const pixel [:, :, :] data, Window win,
+                               double lon, double lat, pixel [:, :] out,
+                               Py_ssize_t k, int method,
+                               double lo, double hi) nogil:
+    cdef Py_ssize_t ch, r, c
+    cdef double u = 0, v = 0, val
+
+    _cartesian_pixel(lon, lat, win.nx, win.ny, &u, &v)
+
+    if method == NEAREST_PIXEL:
+        r = _nearest_index(v, win.ny)
+        c = _nearest_index(u, win.nx)
+        for ch in range(data.shape[2]):
+            out[k, ch] = _fetch(data, win, r, c, ch)
+        return
+
+    for ch in range(data.shape[2]):
+        if isnan(u) or isnan(v):
+            val = NAN
+        else:
+            val = _interpolate(data, win, u, v, ch, method)
+
+        if pixel is np.float32_t or pixel is np.float64_t:
+            out[k, ch] = <pixel> val
+        else:
+            # round, and clip to the range of the integer type
+            if isnan(val):
+                val = 0
+            val = floor(val + 0.5)
+            out[k, ch] = <pixel> min(max(val, lo), hi)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void _sample_cartesian(const pixel [:, :, :] data, Window win,
+                            const double [::1] lon, const double [::1] lat,
+                            pixel [:, :] out, int method,
+                            double lo, double hi, int threads) nogil:
+    cdef Py_ssize_t k
+
+    if threads > 1:
+        for k in prange(lon.shape[0], num_threads=threads,
+                        schedule='static'):
+            _sample_pixel(data, win, lon[k], lat[k], out, k, method, lo, hi)
+    else:
+        for k in range(lon.shape[0]):
+            _sample_pixel(data, win, lon[k], lat[k], out, k, method, lo, hi)
+
+
+_interpolations = dict(nearest=NEAREST_PIXEL, bilinear=BILINEAR,
+                       bicubic=BICUBIC)
+
+
+def sample_cartesian(data, lon, lat, out=None, interpolation='nearest',
+                     threads=1, shape=None, origin=(0, 0)):
+    """Sample a map in the cartesian projection
+
+    The map is oriented with longitude increasing to the left, and
+    (lon, lat) = (0, 0) at its center (see tile.cartesian_sampler).
+    Sampling runs without holding the GIL.
+
+    Parameters
+    ----------
+    data : array
+        The (ny, nx) or (ny, nx, nchannel) map, with nx = 2 * ny.
+        Must have one of the dtypes uint8, uint16, int16, int32, int64,
+        float32 or float64, in native byte order
+    lon, lat : arrays
+        The positions to sample, in radians
+    out : array (optional)
+        An array to write the result into, with the shape of lon
+        (plus a channel axis, for multi-channel maps) and the
+        dtype of data
+    interpolation : 'nearest' | 'bilinear' | 'bicubic'
+        The interpolation scheme. Bilinear interpolation ignores
+        NaN pixels, and bicubic interpolation falls back to bilinear
+        next to NaN pixels. Interpolated integer maps are rounded
+    threads : int (default 1)
+        The number of OpenMP threads to use
+    shape : (ny, nx) (optional)
+        If data is a window of a larger map, the shape of the full map
+    origin : (row, column) (default (0, 0))
+        The position of data's first pixel in the full map. The window
+        may wrap around in longitude, and must contain every pixel
+        needed to sample (lon, lat)
+
+    Returns
+    -------
+    out
+    """
+    if interpolation not in _interpolations:
+        raise ValueError("Invalid interpolation %s. Must be one of %s" %
+                         (interpolation, sorted(_interpolations)))
+    cdef int method = _interpolations[interpolation]
+
+    data = np.asarray(data)
+    if data.dtype not in _pixel_dtypes:
+        raise TypeError("Unsupported dtype: %s" % data.dtype)
+    if data.ndim not in (2, 3):
+        raise ValueError("data must be a 2D or 3D array")
+
+    lon = np.asarray(lon)
+    lat = np.asarray(lat)
+    if lon.shape != lat.shape:
+        raise ValueError("lon and lat must have the same shape")
+
+    shp = lon.shape + data.shape[2:]
+    if out is None:
+        out = np.empty(shp, dtype=data.dtype)
+    elif out.shape != shp or out.dtype != data.dtype:
+        raise ValueError("out must have shape %s and dtype %s" %
+                         (shp, data.dtype))
+
+    cdef const double [::1] _lon = np.ascontiguousarray(lon.ravel(),
+                                                        dtype=np.float64)
+    cdef const double [::1] _lat = np.ascontiguousarray(lat.ravel(),
+                                                        dtype=np.float64)
+    cdef double lo = 0, hi = 0
+    cdef int _threads = threads
+    cdef Window win
+    win.ny, win.nx = data.shape[:2] if shape is None else shape
+    win.row0, win.col0 = origin
+    if data.dtype.kind in 'iu':
+        lo, hi = np.iinfo(data.dtype).min, np.iinfo(data.dtype).max
+
+    data3 = data.reshape(data.shape[:2] + (-1,))
+    out2 = out.reshape(_lon.shape[0], -1)
+
+    cdef const np.uint8_t [:, :, :] d_u8
+    cdef const np.uint16_t [:, :, :] d_u16
+    cdef const np.int16_t [:, :, :] d_i16
+    cdef const np.int32_t [:, :, :] d_i32
+    cdef const np.int64_t [:, :, :] d_i64
+    cdef const np.float32_t [:, :, :] d_f32
+    cdef const np.float64_t [:, :, :] d_f64
+    cdef np.uint8_t [:, :] o_u8
+    cdef np.uint16_t [:, :] o_u16
+    cdef np.int16_t [:, :] o_i16
+    cdef np.int32_t [:, :] o_i32
+    cdef np.int64_t [:, :] o_i64
+    cdef np.float32_t [:, :] o_f32
+    cdef np.float64_t [:, :] o_f64
+
+    # dispatch by hand: Cython 0.29 can't bind read-only
+    # buffers to fused memoryview arguments of def functions
+    dtype = data.dtype
+    if dtype == np.uint8:
+        d_u8, o_u8 = data3, out2
+        with nogil:
+            _sample_cartesian(d_u8, win, _lon, _lat, o_u8, method, lo, hi,
+                              _threads)
+    elif dtype == np.uint16:
+        d_u16, o_u16 = data3, out2
+        with nogil:
+            _sample_cartesian(d_u16, win, _lon, _lat, o_u16, method, lo, hi,
+                              _threads)
+    elif dtype == np.int16:
+        d_i16, o_i16 = data3, out2
+        with nogil:
+            _sample_cartesian(d_i16, win, _lon, _lat, o_i16, method, lo, hi,
+                              _threads)
+    elif dtype == np.int32:
+        d_i32, o_i32 = data3, out2
+        with nogil:
+            _sample_cartesian(d_i32, win, _lon, _lat, o_i32, method, lo, hi,
+                              _threads)
+    elif dtype == np.int64:
+        d_i64, o_i64 = data3, out2
+        with nogil:
+            _sample_cartesian(d_i64, win, _lon, _lat, o_i64, method, lo, hi,
+                              _threads)
+    elif dtype == np.float32:
+        d_f32, o_f32 = data3, out2
+        with nogil:
+            _sample_cartesian(d_f32, win, _lon, _lat, o_f32, method, lo, hi,
+                              _threads)
+    else:
+        d_f64, o_f64 = data3, out2
+        with nogil:
+            _sample_cartesian(d_f64, win, _lon, _lat, o_f64, method, lo, hi,
+                              _threads)
+    return out
@@ -0,0 +1,203 @@
+"""
+Persistent, memory-mapped caches of per-tile data which
+do not depend on the dataset being toasted
+"""
+from __future__ import print_function, division
+import os
+
+import numpy as np
+
+from ._libtoasty import subsample_many
+from .tile import TileTable
+from .frames import transform, _check_frame
+
+
+def _atomic_save(pth, build):
+    """
+    Create a .npy file at pth by calling build(tmp_path),
+    and move it into place once it is complete
+    """
+    direc = os.path.dirname(pth)
+    if not os.path.exists(direc):
+        try:
+            os.makedirs(direc)
+        except OSError:  # another process created it first
+            if not os.path.isdir(direc):
+                raise
+
+    tmp = '%s.%i.tmp' % (pth, os.getpid())
+    try:
+        build(tmp)
+        os.rename(tmp, pth)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def _level_corners(n):
+    """
+    The corners and increasing flags of every tile at level n,
+    with tile (n, x, y) at index y * 2^n + x
+    """
+    return TileTable().level(n)
+
+
+class _LevelCache(object):
+    """
+    Base class for caches which store an array per tile, with one
+    .npy file per level. Subclasses define the name, dtype and
+    per-tile shape of the arrays, and _fill to compute them
+    """
+
+    #: number of tiles to compute at once
+    chunk = 64
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._levels = {}
+
+    def path(self, n):
+        """The path to the file storing level n"""
+        return os.path.join(self.directory, self._name(), '%i.npy' % n)
+
+    def build(self, n):
+        """
+        Compute and save the arrays for every tile at level n,
+        overwriting any previous file
+        """
+        if n < 1:
+            raise ValueError("Can only cache levels >= 1: %i" % n)
+
+        ntile = 4 ** n
+        corners, increasing = _level_corners(n)
+
+        def build(tmp):
+            out = np.lib.format.open_memmap(
+                tmp, mode='w+', dtype=self.dtype,
+                shape=(ntile,) + self._shape())
+            # write straight into the file, a few tiles at a time
+            for lo in range(0, ntile, self.chunk):
+                hi = min(lo + self.chunk, ntile)
+                self._fill(out[lo:hi], corners[lo:hi], increasing[lo:hi])
+            out.flush()
+            del out
+
+        _atomic_save(self.path(n), build)
+        self._levels.pop(n, None)
+
+    def level(self, n):
+        """
+        Return a memory-mapped array of all tiles at level n,
+        building it first if needed
+        """
+        if n not in self._levels:
+            if not os.path.exists(self.path(n)):
+                self.build(n)
+            self._levels[n] = np.load(self.path(n), mmap_mode='r')
+        return self._levels[n]
+
+    def _tile(self, pos):
+        n, x, y = pos
+        return self.level(n)[y * 2 ** n + x]
+
+
+class GeometryCache(_LevelCache):
+    """
+    An on-disk cache of the (lon, lat) grids that subsample
+    computes for each toast tile.
+
+    Each level n is built once, and stored as a single .npy file
+    of shape (4^n, 2, npix, npix). Tile (n, x, y) is at index
+    y * 2^n + x. Files are memory mapped when read, so that
+    lookups return read-only views without copying.
+
+    Parameters
+    ----------
+    directory : str
+      Where to store the cache. Caches for different
+      tile sizes and dtypes can share a directory
+    npix : int (default 256)
+      The pixel width of each tile
+    dtype : float32 or float64 (default float64)
+      The precision of the cached coordinates
+    """
+
+    def __init__(self, directory, npix=256, dtype=np.float64):
+        super(GeometryCache, self).__init__(directory)
+        self.npix = npix
+        self.dtype = np.dtype(dtype)
+        if self.dtype not in (np.dtype(np.float32), np.dtype(np.float64)):
+            raise ValueError("dtype must be float32 or float64: %s" % dtype)
+
+    def _name(self):
+        return 'geometry_%i_%s' % (self.npix, self.dtype.name)
+
+    def _shape(self):
+        return (2, self.npix, self.npix)
+
+    def _fill(self, out, corners, increasing):
+        subsample_many(corners, increasing, out[:, 0], out[:, 1])
+
+    def get(self, pos):
+        """
+        Return read-only (lon, lat) arrays for tile pos = (n, x, y)
+        """
+        grid = self._tile(pos)
+        return grid[0], grid[1]
+
+
+class HealpixIndexCache(_LevelCache):
+    """
+    An on-disk cache of the HEALPix pixel that each toast pixel
+    falls in, for nearest-neighbor sampling of HEALPix maps.
+
+    Indices only depend on the resolution, ordering and frame of
+    a map, so many maps can share a cache (see healpix_sampler).
+    Each level n is stored as a .npy file of shape (4^n, npix, npix),
+    laid out like GeometryCache.
+
+    Parameters
+    ----------
+    directory : str
+      Where to store the cache. Caches for different maps
+      can share a directory
+    nside : int
+      The HEALPix resolution
+    nest : bool (default False)
+      Whether maps use the nested ordering
+    coord : 'C' | 'G' | 'E' (default 'C')
+      The frame of the maps (see toasty.frames)
+    npix : int (default 256)
+      The pixel width of each tile
+    """
+
+    def __init__(self, directory, nside, nest=False, coord='C', npix=256):
+        super(HealpixIndexCache, self).__init__(directory)
+        self.nside = nside
+        self.nest = bool(nest)
+        self.coord = _check_frame(coord)
+        self.npix = npix
+        self.dtype = np.dtype(np.int32 if 12 * nside ** 2 < 2 ** 31
+                              else np.int64)
+
+    def _name(self):
+        return 'healpix_%i_%s_%s_%i' % (self.nside,
+                                        'nest' if self.nest else 'ring',
+                                        self.coord, self.npix)
+
+    def _shape(self):
+        return (self.npix, self.npix)
+
+    def _fill(self, out, corners, increasing):
+        from healpy import ang2pix
+
+        lon, lat = subsample_many(corners, increasing, npix=self.npix)
+        lon, lat = transform(lon, lat, 'C', self.coord)
+        out[...] = ang2pix(self.nside, np.pi / 2 - lat, lon, nest=self.nest)
+
+    def get(self, pos):
+        """
+        Return a read-only array of HEALPix pixel indices
+        for tile pos = (n, x, y)
+        """
+        return self._tile(pos)
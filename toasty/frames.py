@@ -0,0 +1,142 @@
+"""
+Rotations between celestial coordinate frames
+
+Each frame is identified by the same letter as the HEALPix
+COORDSYS keyword:
+
+  * 'C' : equatorial (ICRS / FK5 J2000)
+  * 'G' : galactic
+  * 'E' : ecliptic (mean ecliptic and equinox of J2000, like
+          astropy's BarycentricMeanEcliptic)
+
+Conversions are fixed 3x3 rotations of unit vectors, computed
+once. The galactic frame uses astropy's definition of the
+galactic pole and origin; the ecliptic frame is a rotation by the
+J2000 mean obliquity, ignoring precession and aberration.
+
+All angles are in radians.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+FRAMES = 'CGE'
+
+# the north galactic pole and the galactic longitude of the north
+# celestial pole, in J2000 coordinates (degrees). From astropy's Galactic
+_NGP_RA, _NGP_DEC, _NCP_L = 192.85948, 27.12825, 122.93192
+
+# mean obliquity of the ecliptic at J2000 (degrees)
+_OBLIQUITY = 23.4392911
+
+
+def rotation_matrix(angle, axis):
+    """
+    The matrix which rotates coordinate axes by angle about
+    axis = 'x', 'y' or 'z'. Vectors are rotated by -angle
+    """
+    c, s = np.cos(angle), np.sin(angle)
+    i = 'xyz'.index(axis)
+    j, k = (i + 1) % 3, (i + 2) % 3
+    m = np.eye(3)
+    m[j, j] = m[k, k] = c
+    m[j, k] = s
+    m[k, j] = -s
+    return m
+
+
+#: rotate equatorial unit vectors to galactic
+EQUATORIAL_TO_GALACTIC = np.dot(
+    rotation_matrix(np.radians(180 - _NCP_L), 'z'),
+    np.dot(rotation_matrix(np.radians(90 - _NGP_DEC), 'y'),
+           rotation_matrix(np.radians(_NGP_RA), 'z')))
+
+#: rotate equatorial unit vectors to ecliptic
+EQUATORIAL_TO_ECLIPTIC = rotation_matrix(np.radians(_OBLIQUITY), 'x')
+
+_FROM_EQUATORIAL = dict(C=np.eye(3),
+                        G=EQUATORIAL_TO_GALACTIC,
+                        E=EQUATORIAL_TO_ECLIPTIC)
+
+
+def _check_frame(frame):
+    frame = frame.upper()
+    if len(frame) != 1 or frame not in FRAMES:
+        raise ValueError("Invalid coord %s. Must be one of %s" %
+                         (frame, list(FRAMES)))
+    return frame
+
+
+def frame_matrix(frame_from, frame_to):
+    """
+    The rotation matrix from one frame to another
+
+    Parameters
+    ----------
+    frame_from, frame_to : 'C' | 'G' | 'E'
+    """
+    a = _FROM_EQUATORIAL[_check_frame(frame_from)]
+    b = _FROM_EQUATORIAL[_check_frame(frame_to)]
+    return np.dot(b, a.T)
+
+
+def rotate(lon, lat, matrix):
+    """
+    Apply a rotation matrix to arrays of (lon, lat)
+
+    Returns
+    -------
+    lon, lat : arrays
+       The rotated coordinates. lon is in the range [-pi, pi]
+    """
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    m = matrix
+    cb = np.cos(lat)
+    x, y, z = cb * np.cos(lon), cb * np.sin(lon), np.sin(lat)
+
+    rx = m[0, 0] * x + m[0, 1] * y + m[0, 2] * z
+    ry = m[1, 0] * x + m[1, 1] * y + m[1, 2] * z
+    rz = m[2, 0] * x + m[2, 1] * y + m[2, 2] * z
+    return np.arctan2(ry, rx), np.arctan2(rz, np.hypot(rx, ry))
+
+
+def transform(lon, lat, frame_from, frame_to):
+    """
+    Convert arrays of (lon, lat) from one frame to another
+    """
+    if _check_frame(frame_from) == _check_frame(frame_to):
+        return lon, lat
+    return rotate(lon, lat, frame_matrix(frame_from, frame_to))
+
+
+def frame_sampler(sampler, coord):
+    """
+    Adapt a sampler for data in another frame to equatorial (lon, lat)
+
+    Parameters
+    ----------
+    sampler : function
+      A function of (lon, lat) in the coord frame
+    coord : 'C' | 'G' | 'E'
+      The frame of the sampler's data
+
+    Returns
+    -------
+    A function of equatorial (lon, lat). If sampler has a coverage
+    function (see toasty.tile.toast), so does the result, which
+    rotates the tile corners into the coord frame before testing them
+    """
+    if _check_frame(coord) == 'C':
+        return sampler
+    matrix = frame_matrix('C', coord)
+
+    def result(lon, lat):
+        return sampler(*rotate(lon, lat, matrix))
+
+    if hasattr(sampler, 'coverage'):
+        def coverage(corners):
+            lon, lat = rotate([c[0] for c in corners],
+                              [c[1] for c in corners], matrix)
+            return sampler.coverage(list(zip(lon, lat)))
+        result.coverage = coverage
+    return result
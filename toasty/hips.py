@@ -0,0 +1,213 @@
+"""
+Sample HiPS (Hierarchical Progressive Survey) directories.
+
+A HiPS stores a HEALPix map as a tree of image tiles. Tile ipix of
+order k covers HEALPix pixel ipix at that order, and its w x w pixels
+are the nested sub-pixels at order k + log2(w). The file for each tile
+is Norder{k}/Dir{d}/Npix{ipix}.{ext}, with d = 10000 * (ipix // 10000).
+
+Within a tile, pixels follow the layout of Aladin's Hipsgen: the
+nested index's x bits increase from the bottom row to the top row of
+the image, and its y bits increase from left to right. FITS tiles
+store their rows bottom first, so are flipped relative to PNG
+and JPEG tiles.
+"""
+from __future__ import print_function, division
+import os
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+from .frames import frame_sampler
+from .io import read_png
+from .tile import _pixel_scale
+
+_frames = dict(equatorial='C', galactic='G', ecliptic='E')
+_extensions = dict(png='png', jpeg='jpg', fits='fits')
+
+
+def read_properties(path):
+    """
+    Read the properties file of a HiPS directory, as a dict of strings
+    """
+    result = {}
+    with open(os.path.join(path, 'properties')) as infile:
+        for line in infile:
+            line = line.strip()
+            if not line or line.startswith('#') or '=' not in line:
+                continue
+            key, value = line.split('=', 1)
+            result[key.strip()] = value.strip()
+    return result
+
+
+def tile_path(path, order, ipix, ext):
+    """The path of a HiPS tile"""
+    return os.path.join(path, 'Norder%i' % order,
+                        'Dir%i' % (10000 * (ipix // 10000)),
+                        'Npix%i.%s' % (ipix, ext))
+
+
+def _read_tile(pth):
+    """Read a tile, with rows ordered from top to bottom"""
+    if pth.endswith('.fits'):
+        from astropy.io import fits
+        data = fits.getdata(pth)[::-1]
+        return np.ascontiguousarray(data, dtype=data.dtype.newbyteorder('='))
+    return read_png(pth)
+
+
+class TileCache(object):
+    """
+    A thread-safe, least-recently-used cache of the tiles of a HiPS
+
+    Parameters
+    ----------
+    path : str
+      The HiPS directory
+    ext : str
+      The file extension of the tiles to read
+    cache_mb : float (default 256)
+      The maximum size of the cached tiles, in megabytes
+    """
+
+    def __init__(self, path, ext, cache_mb=256):
+        self.path = path
+        self.ext = ext
+        self.limit = int(cache_mb * 2 ** 20)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def hit_rate(self):
+        """The fraction of tile reads served from the cache"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def get(self, order, ipix):
+        """
+        Return tile ipix of the given order, or None if it doesn't exist
+        """
+        key = (order, ipix)
+        with self._lock:
+            if key in self._tiles:
+                self.hits += 1
+                result = self._tiles.pop(key)
+                self._tiles[key] = result
+                return result
+            self.misses += 1
+
+        # read outside the lock, so other threads can use the cache
+        pth = tile_path(self.path, order, ipix, self.ext)
+        result = _read_tile(pth) if os.path.exists(pth) else None
+        with self._lock:
+            if key in self._tiles:  # read by another thread meanwhile
+                return self._tiles[key]
+            self._tiles[key] = result
+            self.nbytes += 0 if result is None else result.nbytes
+            while self.nbytes > self.limit and len(self._tiles) > 1:
+                _, old = self._tiles.popitem(last=False)
+                self.nbytes -= 0 if old is None else old.nbytes
+        return result
+
+
+def _find_tile(path, order, ext):
+    """Read any one tile of a given order, to learn the tiles' format"""
+    top = os.path.join(path, 'Norder%i' % order)
+    for direc in sorted(os.listdir(top)):
+        for name in sorted(os.listdir(os.path.join(top, direc))):
+            if name.startswith('Npix') and name.endswith('.' + ext):
+                return _read_tile(os.path.join(top, direc, name))
+    raise IOError("No .%s tiles found in %s" % (ext, top))
+
+
+def hips_sampler(path, format=None, order=None, cache_mb=256):
+    """
+    Build a sampler for a HiPS directory
+
+    Tiles are read as they are needed, through a TileCache. Each call
+    reads tiles from the order whose pixels best match the spacing of
+    the input (lon, lat) grid, so that the top levels of a toast
+    pyramid built with merge=False only read low resolution tiles.
+
+    Parameters
+    ----------
+    path : str
+      The HiPS directory, containing a properties file
+    format : 'png' | 'jpeg' | 'fits' (optional)
+      Which tiles to read. Defaults to the first format
+      listed in hips_tile_format
+    order : int (optional)
+      Always read tiles of this order, instead of choosing
+      an order for each grid
+    cache_mb : float (default 256)
+      The size of the tile cache, in megabytes
+
+    Returns
+    -------
+    A function of (lon, lat). Its cache attribute is the TileCache.
+    Pixels in missing tiles are 0, or NaN for floating point data
+    """
+    from healpy import ang2pix, pix2xyf
+
+    props = read_properties(path)
+    max_order = int(props.get('hips_order', props.get('hips_order_max', 3)))
+    min_order = int(props.get('hips_order_min', 0))
+    width = int(props.get('hips_tile_width', 512))
+    k = int(np.log2(width))
+    if 2 ** k != width:
+        raise ValueError("Tile width must be a power of 2: %i" % width)
+
+    if format is None:
+        format = props.get('hips_tile_format', 'png').split()[0]
+    if format not in _extensions:
+        raise ValueError("Invalid format %s. Must be one of %s" %
+                         (format, sorted(_extensions)))
+    ext = _extensions[format]
+
+    frame = props.get('hips_frame', props.get('coordsys', 'equatorial'))
+    coord = _frames.get(frame, frame[:1].upper())
+
+    cache = TileCache(path, ext, cache_mb)
+    template = _find_tile(path, min_order, ext)
+    blank = np.nan if template.dtype.kind == 'f' else 0
+
+    def vec2pix(l, b):
+        l, b = np.asarray(l), np.asarray(b)
+        if order is not None:
+            tile_order = order
+        else:
+            # the coarsest order whose pixels are no larger than the grid's
+            scale = _pixel_scale(l, b)
+            pix_order = (np.ceil(np.log2(np.sqrt(np.pi / 3) / scale))
+                         if scale > 0 else max_order + k)
+            tile_order = int(np.clip(pix_order - k, min_order, max_order))
+
+        ipix = ang2pix(2 ** (tile_order + k), np.pi / 2 - b, l, nest=True)
+        tiles = ipix >> (2 * k)
+        x, y, _ = pix2xyf(width, ipix & (width ** 2 - 1), nest=True)
+        rows, cols = width - 1 - x, y
+
+        out = np.empty(l.shape + template.shape[2:], dtype=template.dtype)
+        out[...] = blank
+
+        # read each tile once
+        flat_tiles = tiles.ravel()
+        srt = np.argsort(flat_tiles, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(flat_tiles[srt])) + 1
+        flat_out = out.reshape((-1,) + template.shape[2:])
+        for group in np.split(srt, bounds):
+            if group.size == 0:
+                continue
+            im = cache.get(tile_order, int(flat_tiles[group[0]]))
+            if im is not None:
+                flat_out[group] = im[rows.ravel()[group], cols.ravel()[group]]
+        return out
+
+    result = frame_sampler(vec2pix, coord)
+    result.cache = cache
+    return result
@@ -1,3 +1,12 @@
+import zlib
+from threading import Thread
+try:
+    from queue import Queue
+    from io import BytesIO
+except ImportError:  # python 2.X
+    from Queue import Queue
+    from cStringIO import StringIO as BytesIO
+
 from PIL import Image
 import numpy as np
 
@@ -25,4 +34,225 @@ def read_png(pth):
     pth : str
        Path to write read
     """
-    return np.asarray(Image.open(pth))
+    im = Image.open(pth)
+    if im.mode == 'P':  # e.g. an optimized TileEncoder tile
+        pal = np.array(im.getpalette()).reshape(-1, 3)
+        grey = (pal == pal[:, :1]).all()
+        im = im.convert('L' if grey else 'RGB')
+    return np.asarray(im)
+
+
+class TileEncoder(object):
+    """
+    Encode tiles as PNG, JPEG, or WebP images
+
+    Parameters
+    ----------
+    format : 'png' | 'jpeg' | 'webp' (default 'png')
+       The image format to write
+    compress_level : int between 0-9 (optional)
+       The zlib compression level of PNG tiles. Defaults to PIL's default
+    strategy : 'default' | 'filtered' | 'huffman' | 'rle' | 'fixed'
+       The zlib compression strategy of PNG tiles. Defaults to PIL's
+       default
+    optimize : bool (default False)
+       For PNG tiles, spend more time to find the smallest encoding,
+       and write uint8 single-channel tiles with at most 16 distinct
+       values as 1, 2, or 4 bit palette images
+    quality : int between 1-100 (default 90)
+       The quality of lossy JPEG and WebP tiles
+    lossless : bool (default False)
+       Whether to write lossless WebP tiles
+    """
+
+    extensions = dict(png='.png', jpeg='.jpg', webp='.webp')
+
+    strategies = dict(default=zlib.Z_DEFAULT_STRATEGY,
+                      filtered=zlib.Z_FILTERED,
+                      huffman=zlib.Z_HUFFMAN_ONLY,
+                      rle=getattr(zlib, 'Z_RLE', 3),
+                      fixed=getattr(zlib, 'Z_FIXED', 4))
+
+    def __init__(self, format='png', compress_level=None, strategy=None,
+                 optimize=False, quality=90, lossless=False):
+        format = format.lower()
+        format = 'jpeg' if format == 'jpg' else format
+        if format not in self.extensions:
+            raise ValueError("Invalid format %s. Must be one of %s" %
+                             (format, sorted(self.extensions)))
+        if strategy is not None and strategy not in self.strategies:
+            raise ValueError("Invalid strategy %s. Must be one of %s" %
+                             (strategy, sorted(self.strategies)))
+
+        self.format = format
+        self.compress_level = compress_level
+        self.strategy = strategy
+        self.optimize = optimize
+        self.quality = quality
+        self.lossless = lossless
+
+    @property
+    def extension(self):
+        """The file extension of encoded tiles"""
+        return self.extensions[self.format]
+
+    def _prepare(self, array):
+        """
+        Convert an array to a PIL image, and return it along with
+        the options to save it with
+        """
+        array = np.asarray(array)
+
+        if self.format == 'png':
+            opts = dict(optimize=self.optimize)
+            if self.compress_level is not None:
+                opts['compress_level'] = self.compress_level
+            if self.strategy is not None:
+                opts['compress_type'] = self.strategies[self.strategy]
+            if self.optimize and array.ndim == 2 and array.dtype == np.uint8:
+                im, bits = _palette_image(array)
+                if bits is not None:
+                    opts['bits'] = bits
+                return im, opts
+            return Image.fromarray(array), opts
+
+        im = Image.fromarray(array)
+        if self.format == 'jpeg' and im.mode in ('RGBA', 'LA'):
+            # JPEG has no alpha channel
+            im = im.convert(im.mode[:-1])
+        if self.format == 'webp' and self.lossless:
+            return im, dict(lossless=True, quality=self.quality)
+        return im, dict(quality=self.quality)
+
+    def encode(self, array):
+        """
+        Encode a tile, and return the image file contents as bytes
+        """
+        im, opts = self._prepare(array)
+        out = BytesIO()
+        im.save(out, format=self.format.upper(), **opts)
+        return out.getvalue()
+
+    def save(self, pth, array):
+        """
+        Encode a tile, and save it to pth
+        """
+        im, opts = self._prepare(array)
+        im.save(pth, format=self.format.upper(), **opts)
+
+
+def _palette_image(array):
+    """
+    Convert a uint8 greyscale image to a palette image, if it has
+    at most 16 distinct values. Returns the image, and the
+    bit depth to save it with (or None, for a greyscale image)
+    """
+    values = np.flatnonzero(np.bincount(array.ravel(), minlength=256))
+    if values.size > 16:
+        return Image.fromarray(array), None
+
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[values] = np.arange(values.size)
+    im = Image.fromarray(lut[array]).convert('P')
+    im.putpalette(np.repeat(values, 3).astype(np.uint8).tobytes())
+    bits = 1 if values.size <= 2 else 2 if values.size <= 4 else 4
+    return im, bits
+
+
+def get_encoder(encoder):
+    """
+    Return a TileEncoder, given a TileEncoder, a format name, or None
+    """
+    if encoder is None:
+        return TileEncoder()
+    if isinstance(encoder, TileEncoder):
+        return encoder
+    return TileEncoder(encoder)
+
+
+class TileWriter(object):
+    """
+    Save tiles from a bounded queue, in a pool of background threads
+
+    Calls to put() return as soon as the tile is queued, and only
+    block when the queue is full. Errors raised while saving are
+    re-raised in the caller, by the next call to put() or close().
+
+    Parameters
+    ----------
+    threads : int (default 2)
+       The number of writer threads. If 0, tiles are saved
+       immediately, in the calling thread
+    maxsize : int (optional)
+       The maximum number of queued tiles. Defaults to 4 per thread
+    save : function (default save_png)
+       A function of (path, array) which saves each tile
+    """
+
+    def __init__(self, threads=2, maxsize=None, save=save_png):
+        self.save = save
+        self.error = None
+        self._threads = []
+
+        if maxsize is None:
+            maxsize = 4 * threads
+        self._queue = Queue(maxsize)
+
+        for i in range(threads):
+            t = Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self.error is None:
+                    self.save(*item)
+            except Exception as e:
+                self.error = self.error or e
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def put(self, pth, array):
+        """
+        Queue a tile to be saved to pth
+        """
+        self._check()
+        if not self._threads:
+            self.save(pth, array)
+            return
+        self._queue.put((pth, array))
+
+    def close(self):
+        """
+        Wait for all queued tiles to be saved, and stop the writer threads
+        """
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+            return
+
+        # don't mask the original exception with a write error
+        try:
+            self.close()
+        except Exception:
+            pass
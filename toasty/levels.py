@@ -0,0 +1,244 @@
+"""
+Build toast pyramids breadth first, one level at a time.
+
+iter_tiles builds a pyramid depth first, merging each set of four
+tiles as soon as they are ready. That keeps memory small, but spends
+much of its time in thousands of small merges driven from Python.
+Here, the deepest level is sampled into a memory-mapped mosaic (a
+LevelStore), and each shallower level is merged from the one below
+it with a few large 2x2 reductions over blocks of the mosaic. Peak
+memory is set by the block size, rather than the size of a level.
+Levels small enough to keep in memory skip the files.
+
+The tiles are identical to those of iter_tiles.
+"""
+from __future__ import print_function, division
+import os
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from . import stats as _stats
+from .merge import MergeKernel
+from .tile import TileTable, Pos, _sample, _mean_kernel
+
+
+class LevelStore(object):
+    """
+    A memory-mapped mosaic of every tile in one level of a pyramid
+
+    Tile (n, x, y) covers rows y * h to (y + 1) * h and columns
+    x * w to (x + 1) * w of the mosaic, for (h, w) tiles.
+
+    Parameters
+    ----------
+    directory : str or None
+      The directory to keep the mosaic in. If None, the
+      mosaic is kept in memory
+    n : int
+      The level
+    shape : tuple
+      The shape of each tile
+    dtype : dtype
+      The type of each tile
+    """
+
+    def __init__(self, directory, n, shape, dtype):
+        self.n = n
+        self.shape = tuple(shape)
+        size = 2 ** n
+        mosaic = (size * shape[0], size * shape[1]) + self.shape[2:]
+        if directory is None:
+            self.path = None
+            self.data = np.empty(mosaic, dtype=dtype)
+        else:
+            self.path = os.path.join(directory, 'level_%i.npy' % n)
+            self.data = np.lib.format.open_memmap(self.path, mode='w+',
+                                                  dtype=dtype, shape=mosaic)
+
+    def tile(self, x, y):
+        """A view of tile (n, x, y)"""
+        h, w = self.shape[:2]
+        return self.data[y * h:(y + 1) * h, x * w:(x + 1) * w]
+
+    def close(self):
+        """Delete the mosaic"""
+        self.data = None
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _store_directory(n, tile, directory, memory_mb):
+    """Where to keep level n: None (in memory) if it is small enough"""
+    nbytes = 4 ** n * tile.size * tile.dtype.itemsize
+    return None if nbytes <= memory_mb * 2 ** 20 else directory
+
+
+def sample_level(data_sampler, n, directory, geometry=None, memory_mb=0):
+    """
+    Sample every tile of level n into a new LevelStore. Levels
+    of at most memory_mb megabytes are kept in memory
+
+    Tiles are sampled in the same (postfix) order as iter_tiles,
+    so samplers see neighboring tiles one after another
+    """
+    table = TileTable()
+    store = None
+    for x, y in zip(*table.postfix(n)[1:]):
+        node = Pos(n=n, x=int(x), y=int(y))
+        corners, increasing = table.corners(node)
+        im = np.asarray(_sample(data_sampler, node, corners, increasing,
+                                geometry))
+        if store is None:
+            store = LevelStore(_store_directory(n, im, directory, memory_mb),
+                               n, im.shape, im.dtype)
+        store.tile(node.x, node.y)[...] = im
+    return store
+
+
+def reduce_level(store, merge, directory, chunk=8, threads=1, memory_mb=0):
+    """
+    Build the level above a LevelStore
+
+    Parameters
+    ----------
+    store : LevelStore
+      The level to merge
+    merge : MergeKernel or callable
+      The merge strategy (see toast)
+    directory : str
+      Where to keep the new LevelStore
+    chunk : int (default 8)
+      The width of the blocks of parent tiles to merge at once. Each
+      block reads (2 * chunk)^2 child tiles
+    threads : int (default 1)
+      The number of threads to merge blocks with. Built-in merge
+      kernels release the GIL
+    memory_mb : float (default 0)
+      Keep the new level in memory if it is at most this many megabytes
+
+    Returns
+    -------
+    The LevelStore of level store.n - 1
+    """
+    merge = merge or _mean_kernel
+    h, w = store.shape[:2]
+    tile = store.tile(0, 0)
+    parent = LevelStore(
+        _store_directory(store.n - 1, tile, directory, memory_mb),
+        store.n - 1, store.shape, store.data.dtype)
+    size = 2 ** parent.n
+    kernel = isinstance(merge, MergeKernel)
+    step = chunk if kernel else 1
+
+    def run(block):
+        y0, x0 = block
+        y1, x1 = min(y0 + step, size), min(x0 + step, size)
+        src = store.data[2 * y0 * h:2 * y1 * h, 2 * x0 * w:2 * x1 * w]
+        out = parent.data[y0 * h:y1 * h, x0 * w:x1 * w]
+        with _stats.stage('merge'):
+            if kernel:
+                merge.merge(src[:(y1 - y0) * h, :(x1 - x0) * w],
+                            src[:(y1 - y0) * h, (x1 - x0) * w:],
+                            src[(y1 - y0) * h:, :(x1 - x0) * w],
+                            src[(y1 - y0) * h:, (x1 - x0) * w:], out=out)
+            else:
+                out[...] = merge(np.asarray(src))
+
+    blocks = [(y, x) for y in range(0, size, step)
+              for x in range(0, size, step)]
+    if threads > 1 and kernel:
+        pool = ThreadPool(threads)
+        try:
+            pool.map(run, blocks)
+        finally:
+            pool.close()
+    else:
+        for block in blocks:
+            run(block)
+
+    return parent
+
+
+def _level_tiles(store, depth):
+    """Yield the (path, tile) of every tile in a LevelStore"""
+    n = store.n
+    if n > depth:  # the depth=0 build samples level 1
+        return
+    size = 2 ** n
+    for y in range(size):
+        for x in range(size):
+            pth = os.path.join('%i' % n, '%i' % y, '%i_%i.png' % (y, x))
+            yield pth, np.array(store.tile(x, y))
+
+
+def iter_levels(data_sampler, depth, merge=True, directory=None,
+                geometry=None, chunk=8, threads=1, memory_mb=256):
+    """
+    Create a hierarchy of toast tiles, one level at a time
+
+    The deepest level is sampled into a LevelStore, and each
+    level is merged from the one below it. Every level's tiles
+    are yielded before the level above it is built, and the
+    mosaic of each level is deleted once the next is built
+
+    Parameters
+    ----------
+    data_sampler : func
+      A function of (lon, lat) that samples a dataset
+    depth : int
+      The maximum depth to tile to
+    merge : True, merge method, or callable (default True)
+      How to build lower resolution tiles (see iter_tiles). Every
+      level is merged, so merge must not be False
+    directory : str (optional)
+      Where to keep the level mosaics. Defaults to a
+      temporary directory, deleted afterwards
+    geometry : GeometryCache (optional)
+      A cache of tile coordinates to read from
+    chunk : int (default 8)
+      The width of the blocks of parent tiles to merge at once
+    threads : int (default 1)
+      The number of threads to merge each level with
+    memory_mb : float (default 256)
+      Levels of at most this many megabytes are kept in memory,
+      instead of memory mapped files
+
+    Yields
+    ------
+    (pth, tile) : str, ndarray
+      pth is the relative path where the tile image should be saved
+    """
+    from .merge import get_merge
+
+    if isinstance(data_sampler, dict):
+        raise ValueError("Breadth first builds take a single sampler")
+    merge = get_merge(merge)
+    if not merge:
+        raise ValueError("Breadth first builds merge every level, "
+                         "so merge can't be False")
+
+    tmp = None
+    if directory is None:
+        directory = tmp = tempfile.mkdtemp(prefix='toasty-levels-')
+
+    store = None
+    try:
+        store = sample_level(data_sampler, max(depth, 1), directory,
+                             geometry, memory_mb)
+        while True:
+            for item in _level_tiles(store, depth):
+                yield item
+            if store.n == 0:
+                break
+            parent = reduce_level(store, merge, directory, chunk, threads,
+                                  memory_mb)
+            store.close()
+            store = parent
+    finally:
+        if store is not None:
+            store.close()
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
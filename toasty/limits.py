@@ -0,0 +1,216 @@
+"""
+Estimate intensity limits for normalizer, without a full pass
+over the data.
+
+Samples can either come from a low resolution sweep of the whole sky,
+from random points on the sky, or from a QuantileSketch which is fed
+the tiles of a build as they are created.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+from ._libtoasty import subsample_many
+from .tile import iter_corners, _wrap_sampler
+
+
+def _finite(values):
+    values = np.asarray(values, dtype=float).ravel()
+    return values[np.isfinite(values)]
+
+
+def sky_sample(sampler, level=2, npix=64):
+    """
+    Sample a function at the pixels of a low resolution toast pyramid
+
+    Parameters
+    ----------
+    sampler : function
+      A function of (lon, lat) that samples a dataset
+    level : int (default 2)
+      The toast level to sample. The whole sky is covered by 4^level
+      tiles of npix x npix pixels
+    npix : int (default 64)
+      The pixel width of each tile. Must be a power of 2
+
+    Returns
+    -------
+    A 1D array of the finite sampled values
+    """
+    tiles = list(iter_corners(level))
+    corners = np.array([c for _, c, _ in tiles])
+    increasing = np.array([inc for _, _, inc in tiles])
+    lon, lat = subsample_many(corners, increasing, npix=npix)
+    lon = lon.reshape(-1, npix)
+    lat = lat.reshape(-1, npix)
+    return _finite(sampler(lon, lat))
+
+
+def random_sample(sampler, size=65536, seed=None):
+    """
+    Sample a function at random points, uniformly distributed
+    over the sky
+
+    Parameters
+    ----------
+    sampler : function
+      A function of (lon, lat) that samples a dataset
+    size : int (default 65536)
+      The number of points to sample
+    seed : int (optional)
+      The random seed
+
+    Returns
+    -------
+    A 1D array of the finite sampled values
+    """
+    rng = np.random.RandomState(seed)
+    width = int(np.ceil(np.sqrt(size)))
+    lon = rng.uniform(0, 2 * np.pi, (width, width))
+    lat = np.arcsin(rng.uniform(-1, 1, (width, width)))
+    return _finite(sampler(lon, lat))
+
+
+class QuantileSketch(object):
+    """
+    Estimate the quantiles of a stream of values in bounded memory
+
+    The sketch keeps a uniform random sample (a reservoir) of all the
+    finite values it has seen. Quantiles of the reservoir estimate the
+    quantiles of the whole stream, with an error of about
+    1 / sqrt(size) in rank.
+
+    Parameters
+    ----------
+    size : int (default 65536)
+      The number of values to keep
+    seed : int (optional)
+      The random seed
+    """
+
+    def __init__(self, size=65536, seed=None):
+        self.size = size
+        self.count = 0
+        self._reservoir = np.empty(size)
+        self._rng = np.random.RandomState(seed)
+
+    def update(self, values):
+        """
+        Add an array of values to the sketch. NaNs and
+        infinities are ignored
+        """
+        values = _finite(values)
+
+        # fill the reservoir
+        nfill = min(self.size - min(self.count, self.size), values.size)
+        start = self.count
+        self._reservoir[start:start + nfill] = values[:nfill]
+        self.count += nfill
+        values = values[nfill:]
+        if values.size == 0:
+            return
+
+        # keep the t'th value with probability size / t, replacing a
+        # random entry. Assignments happen in order, so later values
+        # replace earlier ones, as they would one at a time
+        t = self.count + 1 + np.arange(values.size)
+        keep = self._rng.uniform(size=values.size) * t < self.size
+        slots = self._rng.randint(0, self.size, keep.sum())
+        self._reservoir[slots] = values[keep]
+        self.count += values.size
+
+    @property
+    def values(self):
+        """The values kept in the reservoir"""
+        return self._reservoir[:min(self.count, self.size)]
+
+    def percentile(self, q):
+        """
+        Estimate the q'th percentile(s) of all values seen so far
+        """
+        if self.count == 0:
+            raise ValueError("No values have been added to the sketch")
+        return np.percentile(self.values, q)
+
+    def limits(self, lo=0.5, hi=99.5):
+        """
+        Estimate (vmin, vmax) from the lo'th and hi'th percentiles
+        """
+        vmin, vmax = self.percentile([lo, hi])
+        return float(vmin), float(vmax)
+
+    def equalization(self, nbins=256):
+        """
+        Build a histogram equalization curve
+
+        Returns
+        -------
+        An array of nbins + 1 increasing data values. Mapping them
+        linearly onto [0, 1] (with np.interp) gives each of the nbins
+        intensity ranges an equal share of the data
+        """
+        return self.percentile(np.linspace(0, 100, nbins + 1))
+
+
+def sketch_sampler(sampler, sketch):
+    """
+    Wrap a sampler, so that every tile it samples is fed to a sketch
+
+    This lets one build (for example, of an un-normalized
+    pyramid) estimate the limits for the next, without another
+    pass over the data.
+
+    Parameters
+    ----------
+    sampler : function
+      A function of (lon, lat) that samples a dataset
+    sketch : QuantileSketch
+      The sketch to update
+
+    Returns
+    -------
+    A function of (lon, lat)
+    """
+    def update(values):
+        sketch.update(values)
+        return values
+    return _wrap_sampler(sampler, update)
+
+
+def get_sketch(sampler, sample=None):
+    """
+    Return a QuantileSketch describing a sampler's data
+
+    Parameters
+    ----------
+    sampler : function
+      A function of (lon, lat) that samples a dataset
+    sample : None, 'toast', 'random', array, or QuantileSketch
+      Where to take values from: a low resolution toast pyramid
+      (None or 'toast', see sky_sample), random points on the sky
+      (see random_sample), an array of values, or an existing sketch
+    """
+    if isinstance(sample, QuantileSketch):
+        return sample
+
+    if sample is None or isinstance(sample, str):
+        if sample in (None, 'toast'):
+            sample = sky_sample(sampler)
+        elif sample == 'random':
+            sample = random_sample(sampler)
+        else:
+            raise ValueError("Invalid sample %s. Must be 'toast', 'random', "
+                             "an array, or a QuantileSketch" % sample)
+
+    sample = _finite(sample)
+    sketch = QuantileSketch(max(sample.size, 1))
+    sketch.update(sample)
+    return sketch
+
+
+def auto_limits(sampler, lo=0.5, hi=99.5, sample=None):
+    """
+    Estimate (vmin, vmax) for a sampler, from percentiles of
+    a sample of its data (see get_sketch)
+    """
+    return get_sketch(sampler, sample).limits(lo, hi)
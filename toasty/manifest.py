@@ -0,0 +1,156 @@
+"""
+A record of the tiles written by a build, used to resume
+interrupted builds.
+
+Each line of the manifest file is the SHA-1 hash of a tile's
+contents, followed by its path relative to the pyramid's base
+directory. Lines are appended after the tile is written, so
+a tile is only recorded once it is complete.
+
+Tiles which are not written (the blank tiles of a sparse build) are
+recorded with a hash of '-', and the roots of subtrees which were
+skipped entirely (because no dataset covers them) with '*'.
+"""
+from __future__ import print_function, division
+import os
+import hashlib
+try:
+    from io import BytesIO
+except ImportError:  # python 2.X
+    from cStringIO import StringIO as BytesIO
+
+from . import stats as _stats
+from .io import get_encoder, read_png
+
+EMPTY = '-'
+SKIPPED = '*'
+
+
+class Manifest(object):
+    """
+    The manifest of a pyramid of tiles
+
+    Parameters
+    ----------
+    base_dir : str
+      The base directory of the pyramid. The manifest is stored
+      in this directory, as toasty.manifest
+    encoder : TileEncoder or str (optional)
+      How tiles are encoded. Defaults to PNG
+    """
+
+    filename = 'toasty.manifest'
+
+    def __init__(self, base_dir, encoder=None):
+        self.base_dir = base_dir
+        self.encoder = get_encoder(encoder)
+        self.path = os.path.join(base_dir, self.filename)
+        self._hashes = self._read()
+        self._complete = {}
+
+    def _read(self):
+        hashes = {}
+        if not os.path.exists(self.path):
+            return hashes
+        with open(self.path, 'rb') as infile:
+            for line in infile:
+                # a line without a newline was cut off mid-write
+                if not line.endswith(b'\n'):
+                    continue
+                digest, _, rel = line.decode('utf-8').rstrip('\n') \
+                                     .partition(' ')
+                hashes[rel] = digest
+        return hashes
+
+    def tile_path(self, pos):
+        """The path of tile pos = (n, x, y), relative to base_dir"""
+        n, x, y = pos
+        return '%i/%i/%i_%i%s' % (n, y, y, x, self.encoder.extension)
+
+    def __contains__(self, pos):
+        return self.tile_path(pos) in self._hashes
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def save(self, pth, array):
+        """
+        Encode a tile, save it to pth, and record it in the manifest.
+        If array is None, record the tile as empty instead
+
+        pth must be inside base_dir
+        """
+        rel = os.path.relpath(pth, self.base_dir).replace(os.sep, '/')
+        if array is None:
+            if self._hashes.get(rel) != SKIPPED:
+                self._record(rel, EMPTY)
+            return
+
+        with _stats.stage('encode'):
+            data = self.encoder.encode(array)
+        with _stats.stage('write'):
+            with open(pth, 'wb') as outfile:
+                outfile.write(data)
+        self._record(rel, hashlib.sha1(data).hexdigest())
+
+    def skip(self, pos):
+        """
+        Record that the subtree below tile pos = (n, x, y) is empty,
+        so that none of its tiles are written
+        """
+        self._record(self.tile_path(pos), SKIPPED)
+
+    def _record(self, rel, digest):
+        line = ('%s %s\n' % (digest, rel)).encode('utf-8')
+
+        # a single append is atomic, even from several processes
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        self._hashes[rel] = digest
+
+    def empty(self, pos):
+        """Whether the tile pos = (n, x, y) is recorded as empty"""
+        return self._hashes.get(self.tile_path(pos)) in (EMPTY, SKIPPED)
+
+    def complete(self, pos, depth):
+        """
+        Whether the manifest records the tile pos = (n, x, y),
+        and all of its subtiles down to level depth, as written
+        """
+        n, x, y = pos
+        key = (n, x, y, depth)
+        if key not in self._complete:
+            rel = self.tile_path(pos)
+            digest = self._hashes.get(rel)
+            result = digest is not None
+            if digest not in (None, EMPTY, SKIPPED):
+                result = os.path.exists(os.path.join(self.base_dir, rel))
+            if result and n < depth and digest != SKIPPED:
+                result = all(self.complete((n + 1, 2 * x + dx, 2 * y + dy),
+                                           depth)
+                             for dy in (0, 1) for dx in (0, 1))
+            self._complete[key] = result
+        return self._complete[key]
+
+    def load(self, pos):
+        """
+        Read a recorded tile, and return it as an array.
+
+        Returns None if the tile is not recorded, is empty, or if
+        its contents do not match the manifest
+        """
+        rel = self.tile_path(pos)
+        if rel not in self._hashes or self.empty(pos):
+            return None
+        try:
+            with open(os.path.join(self.base_dir, rel), 'rb') as infile:
+                data = infile.read()
+        except IOError:
+            return None
+        if hashlib.sha1(data).hexdigest() != self._hashes[rel]:
+            return None
+        return read_png(BytesIO(data))
@@ -0,0 +1,118 @@
+"""
+Built-in strategies for merging four subtiles into their parent tile
+"""
+from __future__ import print_function, division
+import warnings
+
+import numpy as np
+
+from ._libtoasty import downsample
+
+
+def _mean(mosaic):
+    """The original merge strategy -- just average all 4 pixels"""
+    return (mosaic[::2, ::2] / 4. +
+            mosaic[1::2, ::2] / 4. +
+            mosaic[::2, 1::2] / 4. +
+            mosaic[1::2, 1::2] / 4.).astype(mosaic.dtype)
+
+
+def _blocks(mosaic):
+    return np.stack((mosaic[::2, ::2], mosaic[1::2, ::2],
+                     mosaic[::2, 1::2], mosaic[1::2, 1::2]))
+
+
+def _nanmean(mosaic):
+    if mosaic.dtype.kind not in 'fc':
+        return _mean(mosaic)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN blocks
+        return np.nanmean(_blocks(mosaic), axis=0).astype(mosaic.dtype)
+
+
+def _max(mosaic):
+    return np.fmax.reduce(_blocks(mosaic), axis=0)
+
+
+def _nearest(mosaic):
+    return mosaic[::2, ::2].copy()
+
+
+class MergeKernel(object):
+    """
+    A built-in merge strategy
+
+    Kernels downsample the four subtiles of a tile directly into
+    the parent tile, in compiled code, without building a mosaic
+    or any temporary arrays. Like custom merge functions, a kernel
+    can also be called with a 2x oversampled mosaic.
+
+    Tiles of dtypes the compiled kernels don't support
+    (e.g. bool or int8) are merged with numpy instead.
+
+    Parameters
+    ----------
+    method : 'mean' | 'nanmean' | 'max' | 'nearest' (default 'mean')
+      - 'mean' averages each 2x2 block of pixels. Integer
+        averages are truncated
+      - 'nanmean' averages the non-NaN pixels of each block
+      - 'max' takes the maximum of each block, ignoring NaNs
+      - 'nearest' takes the upper left pixel of each block
+    """
+
+    methods = dict(mean=(0, _mean), nanmean=(1, _nanmean),
+                   max=(2, _max), nearest=(3, _nearest))
+
+    def __init__(self, method='mean'):
+        if method not in self.methods:
+            raise ValueError("Invalid merge method %s. Must be one of %s" %
+                             (method, sorted(self.methods)))
+        self.method = method
+
+    def __repr__(self):
+        return 'MergeKernel(%r)' % self.method
+
+    def __call__(self, mosaic):
+        h, w = mosaic.shape[0] // 2, mosaic.shape[1] // 2
+        return self.merge(mosaic[:h, :w], mosaic[:h, w:],
+                          mosaic[h:, :w], mosaic[h:, w:])
+
+    def merge(self, ul, ur, bl, br, out=None):
+        """
+        Merge four subtiles into their parent tile
+
+        Parameters
+        ----------
+        ul, ur, bl, br : arrays
+          The upper left, upper right, bottom left
+          and bottom right subtiles
+        out : array (optional)
+          An array to write the result into
+
+        Returns
+        -------
+        The parent tile, with the same shape as each subtile
+        """
+        code, fallback = self.methods[self.method]
+        try:
+            return downsample(ul, ur, bl, br, out=out, method=code)
+        except (TypeError, ValueError):
+            # unsupported dtypes, or odd or mismatched shapes
+            mosaic = np.vstack((np.hstack((ul, ur)), np.hstack((bl, br))))
+            result = fallback(mosaic)
+            if out is None:
+                return result
+            out[...] = result
+            return out
+
+
+def get_merge(merge):
+    """
+    Return the merge strategy for a merge argument: False for no merging,
+    a MergeKernel for True or a method name, or a custom function
+    """
+    if merge is True:
+        return MergeKernel()
+    if isinstance(merge, str):
+        return MergeKernel(merge)
+    return merge
@@ -0,0 +1,162 @@
+"""
+Pyramids of progressively downsampled maps, for samplers to
+read coarse grids from.
+
+Point sampling a full resolution map onto a much coarser grid (e.g.
+the top levels of a pyramid built with merge=False) aliases badly, and
+touches pages across the whole map for every tile. A Mipmap averages
+2x2 blocks of pixels (or the 4 nested children of each HEALPix pixel)
+into each level, building levels only when they are first needed, and
+samplers read each grid from the coarsest level whose pixels are no
+larger than the grid's.
+
+Levels are built from the previous level in chunks, so building a
+pyramid only reads the full resolution map once, in bounded memory.
+"""
+from __future__ import print_function, division
+import warnings
+from threading import Lock
+
+import numpy as np
+
+
+def _block_mean(blocks, axes, dtype):
+    """Average blocks of pixels along axes, ignoring NaNs"""
+    if blocks.dtype.kind in 'fc':
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN blocks
+            result = np.nanmean(blocks, axis=axes)
+    else:
+        result = np.mean(blocks, axis=axes)
+    if np.dtype(dtype).kind in 'biu':
+        result = np.rint(result)
+    return result.astype(dtype)
+
+
+def reduce_cartesian(data, chunk=1024):
+    """
+    Average each 2x2 block of pixels of a cartesian map
+
+    Parameters
+    ----------
+    data : array-like
+      The (ny, nx) or (ny, nx, nchannel) map. ny must be even
+    chunk : int (default 1024)
+      The number of input rows to read at once
+    """
+    ny, nx = data.shape[:2]
+    rest = tuple(data.shape[2:])
+    out = np.empty((ny // 2, nx // 2) + rest, dtype=data.dtype)
+    chunk += chunk % 2
+    for r in range(0, ny, chunk):
+        rows = np.asarray(data[r:r + chunk])
+        rows = rows.reshape((rows.shape[0] // 2, 2, nx // 2, 2) + rest)
+        out[r // 2:(r + chunk) // 2] = _block_mean(rows, (1, 3), data.dtype)
+    return out
+
+
+def reduce_healpix(data, nest=True, chunk=2 ** 20):
+    """
+    Average the 4 nested children of each pixel of a HEALPix map,
+    like healpy.ud_grade but ignoring NaNs
+
+    Parameters
+    ----------
+    data : array-like
+      The HEALPix map
+    nest : bool (default True)
+      Whether data is in the nested ordering. The result always is
+    chunk : int (default 2^20)
+      The number of output pixels to compute at once
+    """
+    from healpy import npix2nside, nest2ring
+
+    nside = npix2nside(data.size)
+    n = data.size // 4
+    out = np.empty(n, dtype=data.dtype)
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        if nest:
+            children = np.asarray(data[4 * start:4 * stop])
+        else:
+            children = data[nest2ring(nside, np.arange(4 * start, 4 * stop))]
+        out[start:stop] = _block_mean(children.reshape(-1, 4), 1, data.dtype)
+    return out
+
+
+class Mipmap(object):
+    """
+    A lazily built pyramid of downsampled copies of a map
+
+    Parameters
+    ----------
+    data : array-like
+      The full resolution map, which is level 0
+    reduce : function
+      reduce(level, j) builds level j + 1 from level j
+    pixel_size : float
+      The pixel size of level 0, in radians. Each level's pixels
+      are twice as large as the last's
+    nlevels : int
+      The number of levels, including level 0
+
+    Levels can be requested from several threads at once
+    (e.g. by the threads of a TileServer)
+    """
+
+    def __init__(self, data, reduce, pixel_size, nlevels):
+        self.reduce = reduce
+        self.pixel_size = pixel_size
+        self.nlevels = max(int(nlevels), 1)
+        self._levels = [data]
+        self._lock = Lock()
+
+    def level(self, j):
+        """Return level j, building it (and any finer levels) if needed"""
+        if not 0 <= j < self.nlevels:
+            raise IndexError("Mipmap has no level %i" % j)
+        if j >= len(self._levels):
+            with self._lock:
+                while len(self._levels) <= j:
+                    k = len(self._levels) - 1
+                    self._levels.append(self.reduce(self._levels[k], k))
+        return self._levels[j]
+
+    def build(self):
+        """Build every level"""
+        self.level(self.nlevels - 1)
+
+    def choose(self, scale):
+        """
+        The coarsest level whose pixels are no larger than scale,
+        or 0 if scale is not positive
+        """
+        if not scale > 0:
+            return 0
+        j = int(np.floor(np.log2(scale / self.pixel_size)))
+        return int(np.clip(j, 0, self.nlevels - 1))
+
+
+def cartesian_mipmap(data):
+    """A Mipmap of a cartesian map, halving it while its height is even"""
+    ny = data.shape[0]
+    nlevels = 1
+    while ny % 2 == 0 and ny > 1:
+        ny //= 2
+        nlevels += 1
+    return Mipmap(data, lambda level, j: reduce_cartesian(level),
+                  np.pi / data.shape[0], nlevels)
+
+
+def healpix_mipmap(data, nest=False):
+    """
+    A Mipmap of a HEALPix map, down to nside=1. Every level
+    but level 0 is in the nested ordering
+    """
+    from healpy import npix2nside
+
+    nside = npix2nside(data.size)
+    return Mipmap(data,
+                  lambda level, j: reduce_healpix(level, nest or j > 0),
+                  np.sqrt(np.pi / 3) / nside,
+                  int(np.log2(nside)) + 1)
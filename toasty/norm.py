@@ -116,14 +116,31 @@ warpers = dict(linear=linear_warp,
                arcsinh=asinh_warp)
 
 def normalize(value, vmin, vmax, bias=.5, contrast=1, stretch='linear'):
-    inverted = vmax <= vmin
-
-    hi, lo = max(vmin, vmax), min(vmin, vmax)
+    """
+    Scale data values to uint8 intensities
 
+    Integer arrays of at most 16 bits are scaled with a lookup table,
+    computed once for each combination of dtype and parameters.
+    """
     if stretch not in warpers:
         raise ValueError("Invalid stretch option %s. Valid options are %s" %
                          (stretch, warpers.keys()))
 
+    if isinstance(value, np.ndarray) and value.dtype.kind in 'iu' and \
+            value.dtype.itemsize <= 2:
+        lut = _lookup_table(value.dtype, vmin, vmax, bias, contrast, stretch)
+        # index by the unsigned bit pattern of each value
+        index = value.view(value.dtype.str.replace('i', 'u'))
+        return lut.take(index)
+
+    return _normalize(value, vmin, vmax, bias, contrast, stretch)
+
+
+def _normalize(value, vmin, vmax, bias, contrast, stretch):
+    inverted = vmax <= vmin
+
+    hi, lo = max(vmin, vmax), min(vmin, vmax)
+
     warp = warpers[stretch]
     result = warp(value, lo, hi, bias, contrast)
 
@@ -133,3 +150,23 @@ def normalize(value, vmin, vmax, bias=.5, contrast=1, stretch='linear'):
     result = np.multiply(255, result, out=result)
     result = np.clip(result, 0, 255, out=result)
     return result.astype(np.uint8)
+
+
+# lookup tables for normalize, keyed by dtype and scaling parameters
+_luts = {}
+
+
+def _lookup_table(dtype, vmin, vmax, bias, contrast, stretch):
+    """
+    The normalized value of every integer of a given dtype,
+    ordered by their unsigned bit patterns
+    """
+    key = (dtype.str, vmin, vmax, bias, contrast, stretch)
+    if key not in _luts:
+        if len(_luts) >= 16:
+            _luts.clear()
+        bits = np.arange(2 ** (8 * dtype.itemsize))
+        values = bits.astype(dtype.str.replace('i', 'u')).view(dtype)
+        _luts[key] = _normalize(values.astype(np.float64), vmin, vmax,
+                                bias, contrast, stretch)
+    return _luts[key]
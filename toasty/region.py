@@ -0,0 +1,224 @@
+"""
+Regions of the sky, used to build only the part of a pyramid
+which overlaps them.
+
+Each region has a coverage(corners) method which returns whether
+a toast tile with the given (ul, ur, lr, ll) corners might overlap
+the region. Tests are conservative: a few tiles just outside
+a region may be included, but no overlapping tile is missed.
+
+All coordinates are (lon, lat) in radians.
+"""
+from __future__ import print_function, division
+
+import numpy as np
+
+
+def lonlat2xyz(lon, lat):
+    """
+    Convert (lon, lat) to unit vectors, stacked along the last axis
+    """
+    lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+    c = np.cos(lat)
+    return np.stack((c * np.cos(lon), c * np.sin(lon), np.sin(lat)), axis=-1)
+
+
+def xyz2lonlat(xyz):
+    """
+    Convert vectors (stacked along the last axis) to (lon, lat)
+    """
+    xyz = np.asarray(xyz, dtype=float)
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+    return np.arctan2(y, x), np.arctan2(z, np.hypot(x, y))
+
+
+def _angle(a, b):
+    """The angle between two unit vectors"""
+    return np.arctan2(np.linalg.norm(np.cross(a, b), axis=-1),
+                      np.sum(a * b, axis=-1))
+
+
+def tile_cap(corners):
+    """
+    Compute a bounding cap for a toast tile
+
+    A tile is a pair of spherical triangles, whose edges are great
+    circle arcs between its corners. Any cap which contains the
+    corners and has a radius smaller than 90 degrees therefore
+    contains the whole tile.
+
+    Parameters
+    ----------
+    corners : sequence of 4 (lon, lat) pairs
+       The corners of the tile
+
+    Returns
+    -------
+    center, radius : unit vector, angle in radians
+       If radius >= pi / 2, the cap may not contain the tile,
+       which should be treated as covering the whole sky
+    """
+    xyz = lonlat2xyz(*np.transpose(corners))
+    center = xyz.sum(axis=0)
+    norm = np.linalg.norm(center)
+    if norm < 1e-12:
+        return np.array([0., 0., 1.]), np.pi
+    center /= norm
+    return center, _angle(center, xyz).max()
+
+
+class Region(object):
+    """
+    Base class for sky regions
+    """
+
+    def intersects_cap(self, center, radius):
+        """
+        Whether a cap might overlap the region
+
+        Parameters
+        ----------
+        center : unit vector
+        radius : angle in radians
+        """
+        raise NotImplementedError()
+
+    def coverage(self, corners):
+        """
+        Whether a toast tile with the given corners might
+        overlap the region
+        """
+        center, radius = tile_cap(corners)
+        if radius >= np.pi / 2:
+            return True
+        # pad the cap to absorb rounding errors
+        return bool(self.intersects_cap(center, radius + 1e-9))
+
+
+class Cone(Region):
+    """
+    A circular region
+
+    Parameters
+    ----------
+    lon, lat : float
+       The center of the cone
+    radius : float
+       The angular radius of the cone
+    """
+
+    def __init__(self, lon, lat, radius):
+        self.center = lonlat2xyz(lon, lat)
+        self.radius = radius
+
+    def intersects_cap(self, center, radius):
+        return _angle(self.center, center) <= self.radius + radius
+
+
+class LonLatBox(Region):
+    """
+    A region bounded by lines of constant longitude and latitude
+
+    Parameters
+    ----------
+    lon_min, lon_max : float
+       The longitude range, running east from lon_min to lon_max.
+       If lon_min > lon_max, the box wraps through lon=0
+    lat_min, lat_max : float
+       The latitude range
+    """
+
+    def __init__(self, lon_min, lon_max, lat_min, lat_max):
+        if lat_min > lat_max:
+            raise ValueError("lat_min must be <= lat_max")
+        self.lon_min = lon_min % (2 * np.pi)
+        self.lon_width = (lon_max - lon_min) % (2 * np.pi)
+        if lon_max != lon_min and self.lon_width == 0:
+            self.lon_width = 2 * np.pi
+        self.lat_min = lat_min
+        self.lat_max = lat_max
+
+    def intersects_cap(self, center, radius):
+        clon, clat = xyz2lonlat(center)
+
+        # the latitude and longitude range of the cap
+        lo, hi = clat - radius, clat + radius
+        if lo > self.lat_max or hi < self.lat_min:
+            return False
+        if hi >= np.pi / 2 or lo <= -np.pi / 2:  # cap contains a pole
+            return True
+
+        half_width = np.arcsin(min(np.sin(radius) / np.cos(clat), 1))
+
+        # compare the distance between the centers of the
+        # longitude ranges to their total half width
+        box_center = self.lon_min + self.lon_width / 2
+        delta = (clon - box_center + np.pi) % (2 * np.pi) - np.pi
+        return abs(delta) <= half_width + self.lon_width / 2
+
+
+class Polygon(Region):
+    """
+    A region bounded by great circle arcs
+
+    The polygon must fit within a hemisphere.
+
+    Parameters
+    ----------
+    vertices : sequence of (lon, lat) pairs
+       The vertices of the polygon, in order
+    """
+
+    def __init__(self, vertices):
+        vertices = np.asarray(vertices, dtype=float)
+        if vertices.ndim != 2 or vertices.shape[0] < 3 or \
+                vertices.shape[1] != 2:
+            raise ValueError("Polygons need at least 3 (lon, lat) vertices")
+
+        self.a = lonlat2xyz(vertices[:, 0], vertices[:, 1])
+        self.b = np.roll(self.a, -1, axis=0)
+        normal = np.cross(self.a, self.b)
+        self.normal = normal / np.linalg.norm(normal, axis=1)[:, np.newaxis]
+
+        # a point which is outside a polygon smaller than a hemisphere
+        center = self.a.sum(axis=0)
+        self.outside = -center / np.linalg.norm(center)
+
+    def contains(self, point):
+        """
+        Whether a unit vector is inside the polygon
+        """
+        # count the edges crossed by the arc from point to self.outside
+        n = np.cross(point, self.outside)
+        norm = np.linalg.norm(n)
+        if norm < 1e-12:  # point is self.outside, or the polygon's center
+            return bool(np.dot(point, self.outside) < 0)
+        n /= norm
+        t = np.cross(self.normal, n)
+        t /= np.linalg.norm(t, axis=1)[:, np.newaxis]
+        t *= np.where(np.sum(t * (self.a + self.b), axis=1) < 0,
+                      -1, 1)[:, np.newaxis]
+
+        on_edge = ((np.sum(np.cross(self.a, t) * self.normal, axis=1) >= 0) &
+                   (np.sum(np.cross(t, self.b) * self.normal, axis=1) >= 0))
+        on_arc = ((np.dot(np.cross(point, t), n) >= 0) &
+                  (np.dot(np.cross(t, self.outside), n) >= 0))
+        return bool(np.sum(on_edge & on_arc) % 2)
+
+    def distance(self, point):
+        """
+        The angular distance from a unit vector to the polygon's boundary
+        """
+        # the closest point on each great circle, if within the arc
+        q = point - np.sum(point * self.normal, axis=1)[:, np.newaxis] * \
+            self.normal
+        inside = ((np.sum(np.cross(self.a, q) * self.normal, axis=1) >= 0) &
+                  (np.sum(np.cross(q, self.b) * self.normal, axis=1) >= 0))
+
+        to_circle = np.abs(np.arcsin(np.clip(np.dot(self.normal, point),
+                                             -1, 1)))
+        to_vertex = np.minimum(_angle(self.a, point), _angle(self.b, point))
+        return np.where(inside, to_circle, to_vertex).min()
+
+    def intersects_cap(self, center, radius):
+        return self.contains(center) or self.distance(center) <= radius
@@ -0,0 +1,269 @@
+"""
+Render toast tiles on demand, instead of building a whole pyramid.
+
+A TileRenderer is a TileStore whose tiles are sampled the first time
+they are requested, and kept in a size-bounded least-recently-used
+cache (in memory, and optionally on disk). Parent tiles are merged from
+their four children when those are already cached, and sampled
+directly otherwise, so only the tiles someone looks at cost anything.
+toasty.viewer.TileServer serves a TileRenderer like any other store:
+
+    python -m toasty.viewer map.fits
+"""
+from __future__ import print_function, division
+import os
+from collections import OrderedDict
+from threading import Lock
+try:
+    from io import BytesIO
+except ImportError:  # python 2.X
+    from cStringIO import StringIO as BytesIO
+
+import numpy as np
+
+from ._libtoasty import subsample
+from .io import get_encoder, read_png
+from .merge import get_merge
+from .storage import TileStore, DirectoryStore, parse_tile_path
+from .tile import (_tile_corners, _sample, _merge_children, _pixel_scale,
+                   _guess_healpix, healpix_sampler, normalizer)
+
+
+def _healpix_depth(nside, max_depth=12):
+    """
+    The shallowest depth whose tiles resolve the pixels
+    of a HEALPix map with the given nside
+    """
+    resolution = np.sqrt(4 * np.pi / 12) / nside
+    for n in range(1, max_depth):
+        mid = 2 ** (n - 1)
+        _, c, increasing = _tile_corners((n, mid, mid))
+        l, b = subsample(c[0], c[1], c[2], c[3], 256, increasing)
+        if _pixel_scale(l, b) <= resolution:
+            return n
+    return max_depth
+
+
+def _tile_key(n, x, y):
+    return '%i/%i/%i_%i' % (n, y, y, x)
+
+
+class TileRenderer(TileStore):
+    """
+    A TileStore which renders tiles as they are requested
+
+    Parameters
+    ----------
+    data_sampler : function or str
+      A function of (lon, lat) that samples a dataset, or the
+      path to a HEALPix FITS file (read with healpix_sampler)
+    depth : int (optional)
+      The deepest level to render. Required for samplers. For
+      HEALPix files, defaults to the shallowest depth that
+      resolves the map's pixels
+    merge : True, merge method, callable or False (default True)
+      How to build a tile from its four children (see toast), when
+      they are all cached. If False, every tile is sampled directly.
+      Level 0 is always merged from level 1
+    vmin, vmax : float or 'auto' (optional)
+      If given, scale the sampled intensities with normalizer. HEALPix
+      files default to 'auto' limits
+    scaling : str (default 'linear')
+      The intensity scaling of the normalizer
+    encoder : TileEncoder or format name (optional)
+      How to encode tiles. Defaults to PNG
+    cache_mb : float (default 256)
+      The maximum size of the tiles kept in memory, in megabytes
+    cache_dir : str (optional)
+      A directory to also keep rendered tiles in, as n/y/y_x.png
+      files. Tiles already there (e.g. from an earlier session with
+      the same dataset) are reused
+    disk_mb : float (default 1024)
+      The maximum size of the tiles kept in cache_dir, in megabytes
+
+    Attributes
+    ----------
+    rendered : int
+      The number of tiles sampled so far
+    merged : int
+      The number of tiles merged from cached children so far
+    """
+
+    def __init__(self, data_sampler, depth=None, merge=True, vmin=None,
+                 vmax=None, scaling='linear', encoder=None, cache_mb=256,
+                 cache_dir=None, disk_mb=1024):
+        if isinstance(data_sampler, str):
+            data, nest, coord = _guess_healpix(data_sampler)
+            if depth is None:
+                depth = _healpix_depth(int(np.sqrt(data.size // 12)))
+            data_sampler = healpix_sampler(data, nest, coord)
+            vmin = 'auto' if vmin is None else vmin
+            vmax = 'auto' if vmax is None else vmax
+        if depth is None:
+            raise ValueError("depth is required when rendering a sampler")
+        if vmin is not None or vmax is not None:
+            data_sampler = normalizer(data_sampler, vmin, vmax, scaling)
+
+        self.sampler = data_sampler
+        self.depth = depth
+        self.merge = get_merge(merge)
+        self.encoder = get_encoder(encoder)
+        self.extension = self.encoder.extension
+        self.limit = int(cache_mb * 2 ** 20)
+        self.nbytes = 0
+        self.rendered = 0
+        self.merged = 0
+        self._tiles = OrderedDict()
+        self._lock = Lock()
+        # a lock per tile being rendered, and the number of threads
+        # holding or waiting for it
+        self._rendering = {}
+
+        self.disk = None
+        if cache_dir is not None:
+            self.disk = DirectoryStore(cache_dir)
+            self.disk_limit = int(disk_mb * 2 ** 20)
+            self.disk_nbytes = 0
+            self._files = OrderedDict()
+            self._scan_disk()
+
+    def _scan_disk(self):
+        """Register the tiles already in cache_dir, oldest first"""
+        found = []
+        for root, dirs, files in os.walk(self.disk.base_dir):
+            for f in files:
+                pth = os.path.join(root, f)
+                pos = parse_tile_path(pth)
+                if pos is not None and f.endswith(self.extension):
+                    found.append((os.path.getmtime(pth), pos,
+                                  os.path.getsize(pth)))
+        for _, pos, size in sorted(found):
+            self._files[_tile_key(*pos)] = size
+            self.disk_nbytes += size
+
+    def _path(self, key):
+        return key + self.extension
+
+    def _remember(self, key, im, data, on_disk=False):
+        """Add a rendered tile to the caches"""
+        removed = []
+        with self._lock:
+            if key not in self._tiles:
+                self._tiles[key] = (im, data)
+                self.nbytes += im.nbytes + len(data)
+            while self.nbytes > self.limit and len(self._tiles) > 1:
+                _, (old, old_data) = self._tiles.popitem(last=False)
+                self.nbytes -= old.nbytes + len(old_data)
+
+            if on_disk or self.disk is None or key in self._files:
+                return
+            self._files[key] = len(data)
+            self.disk_nbytes += len(data)
+            while self.disk_nbytes > self.disk_limit and len(self._files) > 1:
+                old, size = self._files.popitem(last=False)
+                removed.append(old)
+                self.disk_nbytes -= size
+
+        # file I/O happens outside the lock, so it doesn't block cache hits
+        self.disk.put(self._path(key), data)
+        for old in removed:
+            try:
+                os.remove(os.path.join(self.disk.base_dir, self._path(old)))
+            except OSError:
+                pass
+
+    def _cached(self, key):
+        """The (image, bytes) of a cached tile, or None"""
+        with self._lock:
+            if key in self._tiles:
+                result = self._tiles.pop(key)
+                self._tiles[key] = result
+                return result
+            if self.disk is None or key not in self._files:
+                return None
+            self._files[key] = self._files.pop(key)
+        data = self.disk.get(self._path(key))
+        if data is None:  # deleted behind our back
+            with self._lock:
+                self.disk_nbytes -= self._files.pop(key, 0)
+            return None
+        im = read_png(BytesIO(data))
+        self._remember(key, im, data, on_disk=True)
+        return im, data
+
+    def _acquire(self, key):
+        """
+        Acquire the render lock of a tile, so that each tile is only
+        rendered once, while different tiles render in parallel
+        """
+        with self._lock:
+            entry = self._rendering.get(key)
+            if entry is None:
+                entry = self._rendering[key] = [Lock(), 0]
+            entry[1] += 1
+        entry[0].acquire()
+
+    def _release(self, key):
+        with self._lock:
+            entry = self._rendering[key]
+            entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._rendering[key]
+
+    def _render(self, n, x, y):
+        """Return the (image, bytes) of tile (n, x, y)"""
+        key = _tile_key(n, x, y)
+        result = self._cached(key)
+        if result is not None:
+            return result
+
+        self._acquire(key)
+        try:
+            result = self._cached(key)  # rendered by another thread
+            if result is not None:
+                return result
+
+            children = [(n + 1, 2 * x + dx, 2 * y + dy)
+                        for dy in (0, 1) for dx in (0, 1)]
+            if n == 0:
+                cached = [self._render(*c)[0] for c in children]
+            elif self.merge and n < self.depth:
+                cached = [self._cached(_tile_key(*c)) for c in children]
+                cached = [None if c is None else c[0] for c in cached]
+            else:
+                cached = [None]
+
+            if all(c is not None for c in cached):
+                corners = dict(zip([(0, 0), (1, 0), (0, 1), (1, 1)], cached))
+                im = _merge_children(corners, self.merge)
+                with self._lock:
+                    self.merged += 1
+            else:
+                pos, corners, increasing = _tile_corners((n, x, y))
+                im = _sample(self.sampler, pos, corners, increasing)
+                with self._lock:
+                    self.rendered += 1
+
+            im = np.asarray(im)
+            data = self.encoder.encode(im)
+            self._remember(key, im, data)
+            return im, data
+        finally:
+            self._release(key)
+
+    def tile(self, n, x, y):
+        """Return tile (n, x, y) as an array, rendering it if needed"""
+        return self._render(n, x, y)[0]
+
+    def get(self, pth):
+        pos = parse_tile_path(pth)
+        if pos is None or not pth.endswith(self.extension):
+            return None
+        n, x, y = pos
+        if n > self.depth or max(x, y) >= 2 ** n:
+            return None
+        return self._render(n, x, y)[1]
+
+    def put(self, pth, data):
+        raise TypeError("Tiles of a TileRenderer can't be written")
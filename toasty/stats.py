@@ -0,0 +1,318 @@
+"""
+Timings and counters of a toast() build.
+
+A BuildStats records how long a build spends in each stage:
+
+  * geometry : computing the (lon, lat) of each tile's pixels
+  * sample : calling the samplers
+  * normalize : intensity scaling (see toasty.tile.normalizer)
+  * merge : merging subtiles into their parents
+  * encode : encoding tiles as images
+  * write : writing encoded tiles to disk, or to a TileStore
+
+Stage times are exclusive: time spent normalizing inside a sampler is
+counted as normalize, not sample. They are summed over threads (e.g.
+the writer threads of toast), and over the worker processes of a
+parallel build, so they can add up to more than the elapsed time.
+
+The BuildStats of the running build is kept in this module, so that
+any part of the pipeline can report to it with stage(name). When no
+build is being measured, stage() returns a shared no-op context.
+"""
+from __future__ import print_function, division
+import os
+import json
+import threading
+from time import time
+try:
+    from time import perf_counter as _clock
+except ImportError:  # python 2.X
+    from time import time as _clock
+
+STAGES = ('geometry', 'sample', 'normalize', 'merge', 'encode', 'write')
+
+# the BuildStats of the running build, if any
+_active = None
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_null_stage = _NullStage()
+
+
+class _Stage(object):
+
+    __slots__ = ('stats', 'name')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats._enter(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stats._exit()
+        return False
+
+
+class BuildStats(object):
+    """
+    Cumulative timers and counters for a toast() build
+
+    Parameters
+    ----------
+    progress : callable (optional)
+      Called with a dict of the number of tiles built so far
+      ('tiles'), the number of tiles in the pyramid ('total'),
+      the seconds since the build started ('elapsed'), the build
+      rate ('tiles_per_second') and the estimated seconds left
+      ('eta', or None). Called at most once every interval seconds,
+      and when the build finishes. For sparse or region builds,
+      total (and so eta) is an upper bound
+    interval : float (default 1)
+      The minimum number of seconds between progress calls
+    profile : bool or list of str (default False)
+      Whether to run cProfile during every stage, or a list of the
+      stages to profile. Each stage has its own profile, in
+      profiles. Only the thread (and process) which created the
+      BuildStats is profiled
+
+    Attributes
+    ----------
+    seconds, calls : dict
+      The total time spent in, and the number of calls to, each stage
+    tiles : int
+      The number of tiles built
+    peak_parent_tiles, peak_parent_bytes : int
+      The most subtiles held at once while waiting for their siblings,
+      to merge into their parent, and their total size. For parallel
+      builds, the largest of any process
+    profiles : dict
+      The cProfile.Profile of each profiled stage
+    """
+
+    def __init__(self, progress=None, interval=1., profile=False):
+        self.progress = progress
+        self.interval = interval
+        self.seconds = dict((s, 0.) for s in STAGES)
+        self.calls = dict((s, 0) for s in STAGES)
+        self.tiles = 0
+        self.total = None
+        self.parent_tiles = 0
+        self.parent_bytes = 0
+        self.peak_parent_tiles = 0
+        self.peak_parent_bytes = 0
+        self.started = None
+        self.elapsed = 0.
+        self._reported = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread = threading.current_thread()
+
+        self.profiles = {}
+        if profile:
+            import cProfile
+            names = STAGES if profile is True else profile
+            self.profiles = dict((s, cProfile.Profile()) for s in names)
+
+    def stage(self, name):
+        """A context manager which times a stage"""
+        return _Stage(self, name)
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _profile(self, name, enable):
+        prof = self.profiles.get(name)
+        if prof is None or threading.current_thread() is not self._thread:
+            return
+        if enable:
+            prof.enable()
+        else:
+            prof.disable()
+
+    def _add(self, name, seconds, calls):
+        with self._lock:
+            self.seconds[name] = self.seconds.get(name, 0.) + seconds
+            self.calls[name] = self.calls.get(name, 0) + calls
+
+    def _enter(self, name):
+        now = _clock()
+        stack = self._stack()
+        if stack:  # pause the enclosing stage
+            outer = stack[-1]
+            self._profile(outer[0], False)
+            self._add(outer[0], now - outer[1], 0)
+        stack.append([name, now])
+        self._profile(name, True)
+
+    def _exit(self):
+        now = _clock()
+        stack = self._stack()
+        name, start = stack.pop()
+        self._profile(name, False)
+        self._add(name, now - start, 1)
+        if stack:  # resume the enclosing stage
+            stack[-1][1] = now
+            self._profile(stack[-1][0], True)
+
+    def buffered(self, nbytes, ntiles):
+        """Record subtiles added to (or removed from) the parent buffer"""
+        self.parent_bytes += nbytes
+        self.parent_tiles += ntiles
+        if self.parent_bytes > self.peak_parent_bytes:
+            self.peak_parent_bytes = self.parent_bytes
+        if self.parent_tiles > self.peak_parent_tiles:
+            self.peak_parent_tiles = self.parent_tiles
+
+    def start(self, total=None):
+        """Start the clock of a build of total tiles"""
+        self.total = total
+        self.started = time()
+        self._reported = self.started
+
+    def finish(self):
+        """Stop the clock, and report the final progress"""
+        if self.started is not None:
+            self.elapsed = time() - self.started
+        self.report(force=True)
+
+    def add_tiles(self, count=1):
+        """Count built tiles, and report progress if it is due"""
+        self.tiles += count
+        self.report()
+
+    def report(self, force=False):
+        """Call the progress callback, if it is due (or forced)"""
+        if self.progress is None or self.started is None:
+            return
+        now = time()
+        if not force and now - self._reported < self.interval:
+            return
+        self._reported = now
+        self.progress(self.status(now))
+
+    def status(self, now=None):
+        """The dict passed to the progress callback"""
+        elapsed = (now or time()) - self.started
+        rate = self.tiles / elapsed if elapsed > 0 else 0.
+        eta = None
+        if self.total is not None and rate > 0:
+            eta = max(self.total - self.tiles, 0) / rate
+        return dict(tiles=self.tiles, total=self.total, elapsed=elapsed,
+                    tiles_per_second=rate, eta=eta)
+
+    def state(self):
+        """The counters of this BuildStats, to merge into another"""
+        return dict(seconds=self.seconds, calls=self.calls,
+                    tiles=self.tiles,
+                    peak_parent_tiles=self.peak_parent_tiles,
+                    peak_parent_bytes=self.peak_parent_bytes)
+
+    def merge(self, state):
+        """Add the counters of a worker's BuildStats (see state)"""
+        for name, seconds in state['seconds'].items():
+            self._add(name, seconds, state['calls'].get(name, 0))
+        self.peak_parent_tiles = max(self.peak_parent_tiles,
+                                     state['peak_parent_tiles'])
+        self.peak_parent_bytes = max(self.peak_parent_bytes,
+                                     state['peak_parent_bytes'])
+        self.add_tiles(state['tiles'])
+
+    def summary(self):
+        """A JSON-serializable summary of the build"""
+        elapsed = self.elapsed
+        return dict(tiles=self.tiles, total=self.total, elapsed=elapsed,
+                    tiles_per_second=self.tiles / elapsed if elapsed else 0.,
+                    stages=dict((s, dict(seconds=self.seconds[s],
+                                         calls=self.calls[s]))
+                                for s in self.seconds),
+                    peak_parent_tiles=self.peak_parent_tiles,
+                    peak_parent_bytes=self.peak_parent_bytes)
+
+    def write_json(self, pth):
+        """Write the summary to a JSON file"""
+        with open(pth, 'w') as outfile:
+            json.dump(self.summary(), outfile, indent=2, sort_keys=True)
+
+    def dump_profiles(self, directory):
+        """
+        Write the profile of each stage to directory/{stage}.prof,
+        for pstats or other profile viewers
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name, prof in self.profiles.items():
+            prof.dump_stats(os.path.join(directory, '%s.prof' % name))
+
+
+def stage(name):
+    """
+    A context manager which times a stage of the running build,
+    or does nothing if no build is being measured
+    """
+    if _active is None:
+        return _null_stage
+    return _active.stage(name)
+
+
+def timed(name, func):
+    """Wrap a function, so that calls to it are timed as a stage"""
+    def result(*args, **kwargs):
+        with stage(name):
+            return func(*args, **kwargs)
+    return result
+
+
+def buffered(nbytes, ntiles):
+    """Record a change in the parent buffer of the running build"""
+    if _active is not None:
+        _active.buffered(nbytes, ntiles)
+
+
+def active():
+    """The BuildStats of the running build, or None"""
+    return _active
+
+
+class activate(object):
+    """
+    A context manager which measures a build with a BuildStats
+    (or does nothing, if stats is None), and restores the
+    previously active BuildStats afterwards
+    """
+
+    def __init__(self, stats, total=None):
+        self.stats = stats
+        self.total = total
+
+    def __enter__(self):
+        global _active
+        self.previous = _active
+        if self.stats is not None:
+            _active = self.stats
+            self.stats.start(self.total)
+        return self.stats
+
+    def __exit__(self, exc_type, exc_value, tb):
+        global _active
+        _active = self.previous
+        if self.stats is None:
+            return False
+        if exc_type is None:
+            self.stats.finish()
+        elif self.stats.started is not None:
+            self.stats.elapsed = time() - self.stats.started
+        return False
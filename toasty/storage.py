@@ -0,0 +1,345 @@
+"""
+Where the tiles of a pyramid are kept.
+
+By default, toast() writes each tile to its own n/y/y_x.png file. Deep
+pyramids have millions of tiles, and creating, listing and copying that
+many small files can take longer than building them. A TileStore holds
+encoded tiles under the same relative paths, in one of several layouts:
+
+  * DirectoryStore : the usual n/y/y_x.png files
+  * PackStore : a few large pack files, each holding many tiles
+    followed by a table of their offsets
+  * MemoryStore : a dict, for tests
+
+Pack files hold either every tile of one level, or every tile of a
+subtree below a given level (so the workers of a parallel build each
+write their own packs). Tiles above that level share one pack.
+A toasty.packs file describes the layout, so that readers
+(e.g. toasty.viewer) can find each tile.
+"""
+from __future__ import print_function, division
+import os
+import re
+import json
+import struct
+from threading import Lock
+
+import numpy as np
+
+_tile_path = re.compile(r'(?:^|/)(\d+)/(\d+)/(\d+)_(\d+)(\.\w+)?$')
+
+PACK_MAGIC = b'TOASTPK1'
+INDEX_MAGIC = b'TOASTIX1'
+_trailer = struct.Struct('<8sQQ')
+_index_dtype = np.dtype([('key', '<u8'), ('offset', '<u8'), ('length', '<u8')])
+
+
+def parse_tile_path(pth):
+    """
+    Return the (n, x, y) position of a tile path like n/y/y_x.png,
+    or None if pth isn't a tile path
+    """
+    match = _tile_path.search(pth.replace(os.sep, '/'))
+    if match is None or match.group(2) != match.group(3):
+        return None
+    n, y, _, x = map(int, match.groups()[:4])
+    return n, x, y
+
+
+def _key(n, x, y):
+    """A sortable integer for each tile position"""
+    return (n << 58) | (y << 29) | x
+
+
+if hasattr(os, 'pread'):
+    def _read(f, offset, length, lock):
+        return os.pread(f.fileno(), length, offset)
+else:  # python 2.X
+    def _read(f, offset, length, lock):
+        with lock:
+            f.seek(offset)
+            return f.read(length)
+
+
+class TileStore(object):
+    """
+    Base class for tile stores. Tiles are named by their
+    path relative to the pyramid, like n/y/y_x.png
+    """
+
+    #: whether the forked workers of a parallel build can write to the store
+    multiprocess = True
+
+    def put(self, pth, data):
+        """Store the encoded bytes of a tile"""
+        raise NotImplementedError()
+
+    def get(self, pth):
+        """Return the encoded bytes of a tile, or None if it is missing"""
+        raise NotImplementedError()
+
+    def locate(self, pth):
+        """
+        Return the (file, offset, length) of a tile's bytes,
+        or None if it is missing or not kept in a file
+        """
+        return None
+
+    def __contains__(self, pth):
+        return self.get(pth) is not None
+
+    def close(self):
+        """Finish writing any tiles written by this process"""
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+class DirectoryStore(TileStore):
+    """
+    Keep each tile in its own file, at base_dir/n/y/y_x.png
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = base_dir
+
+    def _path(self, pth):
+        """The file of a tile, or None if pth leads outside base_dir"""
+        full = os.path.join(self.base_dir, pth)
+        base = os.path.join(os.path.abspath(self.base_dir), '')
+        if not os.path.abspath(full).startswith(base):
+            return None
+        return full
+
+    def put(self, pth, data):
+        full = self._path(pth)
+        if full is None:
+            raise ValueError("Tile path outside of the store: %s" % pth)
+        pth = full
+        direc = os.path.dirname(pth)
+        if not os.path.isdir(direc):
+            try:
+                os.makedirs(direc)
+            except OSError:  # made by another thread
+                if not os.path.isdir(direc):
+                    raise
+        with open(pth, 'wb') as outfile:
+            outfile.write(data)
+
+    def get(self, pth):
+        pth = self._path(pth)
+        if pth is None or not os.path.isfile(pth):
+            return None
+        with open(pth, 'rb') as infile:
+            return infile.read()
+
+    def locate(self, pth):
+        pth = self._path(pth)
+        if pth is None or not os.path.isfile(pth):
+            return None
+        return pth, 0, os.path.getsize(pth)
+
+
+class MemoryStore(TileStore):
+    """
+    Keep tiles in a dict, mapping paths to bytes. The workers
+    of a parallel build can't write to a MemoryStore
+    """
+
+    multiprocess = False
+
+    def __init__(self):
+        self.tiles = {}
+
+    def put(self, pth, data):
+        self.tiles[pth.replace(os.sep, '/')] = data
+
+    def get(self, pth):
+        return self.tiles.get(pth.replace(os.sep, '/'))
+
+
+class PackStore(TileStore):
+    """
+    Keep tiles in a few large pack files
+
+    Each pack starts with an 8 byte marker, followed by the encoded
+    tiles written to it, and ends with an index: a table of the
+    (key, offset, length) of each tile, sorted by key, and a trailer
+    giving the offset of the table and its number of entries.
+    Tile (n, x, y) has key n << 58 | y << 29 | x.
+
+    Parameters
+    ----------
+    base_dir : str
+      The directory to keep the packs in
+    subtree_level : int (optional)
+      If given, tiles at or below this level are packed by the subtree
+      they belong to, in subtree_{level}_{y}_{x}.pack, and the tiles
+      above it in top.pack. Otherwise, each level has its own pack,
+      level_{n}.pack
+    extension : str (default '.png')
+      The file extension of the tiles, to serve them with
+    depth : int (optional)
+      The depth of the pyramid, recorded for readers
+
+    Packs are written by the process which writes their first tile,
+    and are finished (their index written) when that process calls
+    close. A PackStore built with no arguments beyond base_dir reads
+    the layout of an existing store from its toasty.packs file.
+    """
+
+    layout_file = 'toasty.packs'
+
+    def __init__(self, base_dir, subtree_level=None, extension=None,
+                 depth=None):
+        self.base_dir = base_dir
+        layout = os.path.join(base_dir, self.layout_file)
+        if extension is None and os.path.exists(layout):
+            with open(layout) as infile:
+                info = json.load(infile)
+            subtree_level = info['subtree_level']
+            extension = info['extension']
+            depth = info['depth']
+        elif extension is None:
+            extension = '.png'
+
+        self.subtree_level = subtree_level
+        self.extension = extension
+        self.depth = depth
+        self._writing = {}
+        self._reading = {}
+        self._lock = Lock()
+
+    def write_layout(self):
+        """Record the layout of the store, in base_dir/toasty.packs"""
+        if not os.path.isdir(self.base_dir):
+            os.makedirs(self.base_dir)
+        info = dict(subtree_level=self.subtree_level,
+                    extension=self.extension, depth=self.depth)
+        with open(os.path.join(self.base_dir, self.layout_file), 'w') as out:
+            json.dump(info, out)
+
+    def pack_name(self, n, x, y):
+        """The name of the pack holding tile (n, x, y)"""
+        s = self.subtree_level
+        if s is None:
+            return 'level_%i.pack' % n
+        if n < s:
+            return 'top.pack'
+        return 'subtree_%i_%i_%i.pack' % (s, y >> (n - s), x >> (n - s))
+
+    def _pos(self, pth):
+        pos = parse_tile_path(pth)
+        if pos is None:
+            raise ValueError("Not a tile path: %s" % pth)
+        return pos
+
+    def put(self, pth, data):
+        n, x, y = self._pos(pth)
+        name = self.pack_name(n, x, y)
+        with self._lock:
+            if name not in self._writing:
+                f = open(os.path.join(self.base_dir, name), 'wb')
+                f.write(PACK_MAGIC)
+                self._writing[name] = (f, [])
+            f, index = self._writing[name]
+            index.append((_key(n, x, y), f.tell(), len(data)))
+            f.write(data)
+
+    def close(self):
+        with self._lock:
+            for name, (f, index) in self._writing.items():
+                table = np.array(index, dtype=_index_dtype)
+                table.sort(order='key')
+                offset = f.tell()
+                f.write(table.tobytes())
+                f.write(_trailer.pack(INDEX_MAGIC, offset, table.size))
+                f.close()
+                self._reading.pop(name, None)
+            self._writing = {}
+            for f, _ in self._reading.values():
+                if f is not None:
+                    f.close()
+            self._reading = {}
+
+    def _open(self, name):
+        """The file and index of a finished pack, or (None, None)"""
+        with self._lock:
+            if name not in self._reading:
+                pth = os.path.join(self.base_dir, name)
+                if not os.path.exists(pth):
+                    self._reading[name] = (None, None)
+                else:
+                    f = open(pth, 'rb')
+                    f.seek(-_trailer.size, os.SEEK_END)
+                    magic, offset, count = _trailer.unpack(
+                        f.read(_trailer.size))
+                    if magic != INDEX_MAGIC:
+                        f.close()
+                        raise IOError("%s is not a finished pack" % pth)
+                    f.seek(offset)
+                    table = np.frombuffer(
+                        f.read(count * _index_dtype.itemsize),
+                        dtype=_index_dtype)
+                    self._reading[name] = (f, table)
+            return self._reading[name]
+
+    def _find(self, pth):
+        pos = parse_tile_path(pth)
+        if pos is None:
+            return None
+        name = self.pack_name(*pos)
+        f, table = self._open(name)
+        if f is None:
+            return None
+        key = np.uint64(_key(*pos))  # a python int would compare as float64
+        i = np.searchsorted(table['key'], key)
+        if i == table.size or table['key'][i] != key:
+            return None
+        return name, f, int(table['offset'][i]), int(table['length'][i])
+
+    def get(self, pth):
+        found = self._find(pth)
+        if found is None:
+            return None
+        _, f, offset, length = found
+        return _read(f, offset, length, self._lock)
+
+    def locate(self, pth):
+        found = self._find(pth)
+        if found is None:
+            return None
+        name, _, offset, length = found
+        return os.path.join(self.base_dir, name), offset, length
+
+
+def open_store(base_dir):
+    """
+    Open the tiles of an existing pyramid: a PackStore if
+    base_dir has a toasty.packs file, else a DirectoryStore
+    """
+    if os.path.exists(os.path.join(base_dir, PackStore.layout_file)):
+        return PackStore(base_dir)
+    return DirectoryStore(base_dir)
+
+
+def get_store(store, base_dir, extension='.png', depth=None,
+              subtree_level=None):
+    """
+    Return a TileStore, given a TileStore, or 'directory',
+    'pack' or 'memory' for a new store under base_dir
+    """
+    if isinstance(store, TileStore):
+        return store
+    if store in (None, 'directory'):
+        return DirectoryStore(base_dir)
+    if store == 'memory':
+        return MemoryStore()
+    if store == 'pack':
+        return PackStore(base_dir, subtree_level, extension, depth)
+    raise ValueError("Invalid store %s. Must be a TileStore, 'directory', "
+                     "'pack' or 'memory'" % store)
@@ -0,0 +1,24 @@
+"""
+Test data shared by the test modules
+"""
+import numpy as np
+
+from .. import cartesian_sampler
+
+
+def random_image(shape=(64, 128, 3), dtype=np.uint8, nans=False):
+    """
+    A reproducible image of random integers between 0 and 255.
+    If nans is True, floating point images have a patch of NaNs
+    """
+    data = np.random.RandomState(0).randint(0, 255, shape).astype(dtype)
+    if nans and data.dtype.kind == 'f':
+        data[10:14, 30:40] = np.nan
+    return data
+
+
+def random_sampler(shape=(64, 128, 3), dtype=np.uint8, nans=False):
+    """
+    A cartesian sampler of a random_image
+    """
+    return cartesian_sampler(random_image(shape, dtype, nans))
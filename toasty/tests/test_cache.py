@@ -0,0 +1,138 @@
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+import numpy as np
+import pytest
+
+try:
+    import healpy
+    HAS_HEALPY = True
+except ImportError:
+    HAS_HEALPY = False
+
+from .. import iter_tiles, healpix_sampler
+from ..cache import GeometryCache, HealpixIndexCache
+from ..tile import iter_corners
+from .._libtoasty import subsample
+
+
+def mock_sampler(x, y):
+    return x
+
+
+class TestGeometryCache(object):
+
+    def setup_method(self, method):
+        self.base = mkdtemp()
+
+    def teardown_method(self, method):
+        rmtree(self.base)
+
+    def test_matches_subsample(self):
+        cache = GeometryCache(self.base, npix=16)
+        for node, c, increasing in iter_corners(2):
+            l, b = cache.get(node)
+            le, be = subsample(c[0], c[1], c[2], c[3], 16, increasing)
+            np.testing.assert_array_equal(l, le)
+            np.testing.assert_array_equal(b, be)
+
+    def test_float32(self):
+        cache = GeometryCache(self.base, npix=16, dtype=np.float32)
+        node, c, increasing = next(iter_corners(2))
+        l, b = cache.get(node)
+        assert l.dtype == np.float32
+        le, be = subsample(c[0], c[1], c[2], c[3], 16, increasing)
+        np.testing.assert_array_almost_equal(l, le, 6)
+        np.testing.assert_array_almost_equal(b, be, 6)
+
+    def test_persistent(self):
+        cache = GeometryCache(self.base, npix=16)
+        cache.level(1)
+        assert os.path.exists(cache.path(1))
+
+        cache = GeometryCache(self.base, npix=16)
+        cache.build = None  # should not be needed
+        l, b = cache.get((1, 0, 0))
+        assert isinstance(l, np.memmap)
+        assert not l.flags.writeable
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            GeometryCache(self.base, dtype=np.int32)
+        with pytest.raises(ValueError):
+            GeometryCache(self.base).build(0)
+
+    @pytest.mark.parametrize('merge', (True, False))
+    def test_iter_tiles(self, merge):
+        cache = GeometryCache(self.base)
+        expected = list(iter_tiles(mock_sampler, 2, merge))
+        actual = list(iter_tiles(mock_sampler, 2, merge, geometry=cache))
+        assert len(expected) == len(actual)
+        for (p1, t1), (p2, t2) in zip(expected, actual):
+            assert p1 == p2
+            np.testing.assert_array_equal(t1, t2)
+
+
+@pytest.mark.skipif('not HAS_HEALPY')
+class TestHealpixIndexCache(object):
+
+    def setup_method(self, method):
+        self.base = mkdtemp()
+        self.data = np.arange(12 * 8 ** 2, dtype=np.float32)
+
+    def teardown_method(self, method):
+        rmtree(self.base)
+
+    @pytest.mark.parametrize(('nest', 'coord'),
+                             [(False, 'C'), (True, 'G'), (True, 'E')])
+    def test_matches_sampler(self, nest, coord):
+        cache = HealpixIndexCache(self.base, 8, nest, coord, npix=16)
+        sampler = healpix_sampler(self.data, nest, coord)
+        for node, c, increasing in iter_corners(2):
+            l, b = subsample(c[0], c[1], c[2], c[3], 16, increasing)
+            np.testing.assert_array_equal(self.data[cache.get(node)],
+                                          sampler(l, b))
+
+    def test_dtype(self):
+        assert HealpixIndexCache(self.base, 8).dtype == np.int32
+        assert HealpixIndexCache(self.base, 2 ** 14).dtype == np.int64
+
+    @pytest.mark.parametrize('merge', (True, False))
+    def test_iter_tiles(self, merge):
+        plain = healpix_sampler(self.data, coord='G')
+        cached = healpix_sampler(self.data, coord='G', index=self.base)
+        assert hasattr(cached, 'sample_tile')
+        assert os.path.isdir(self.base)
+
+        expected = list(iter_tiles(plain, 1, merge))
+        actual = list(iter_tiles(cached, 1, merge))
+        assert len(expected) == len(actual)
+        for (p1, t1), (p2, t2) in zip(expected, actual):
+            assert p1 == p2
+            np.testing.assert_array_equal(t1, t2)
+
+        # another map can reuse the cache
+        other = healpix_sampler(2 * self.data, coord='G', index=cached.index)
+        tiles = dict(iter_tiles(other, 1, merge))
+        np.testing.assert_array_equal(tiles['1/0/0_0.png'],
+                                      2 * dict(actual)['1/0/0_0.png'])
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            healpix_sampler(self.data, index=self.base,
+                            interpolation='bilinear')
+        with pytest.raises(ValueError):
+            healpix_sampler(self.data, index=HealpixIndexCache(self.base, 4))
+        with pytest.raises(ValueError):
+            HealpixIndexCache(self.base, 8, coord='X')
+
+    def test_normalizer(self):
+        from .. import normalizer
+        cached = healpix_sampler(self.data, index=self.base)
+        scaled = normalizer(cached, 0, self.data.max())
+        assert scaled.index is cached.index
+        np.testing.assert_array_equal(
+            scaled.sample_tile((1, 0, 1)),
+            normalizer(healpix_sampler(self.data), 0, self.data.max())(
+                *GeometryCache(self.base).get((1, 0, 1))))
@@ -0,0 +1,104 @@
+import numpy as np
+import pytest
+
+from ..frames import (rotation_matrix, frame_matrix, rotate, transform,
+                      frame_sampler, EQUATORIAL_TO_GALACTIC)
+from .. import cartesian_sampler
+
+try:
+    from astropy.coordinates import SkyCoord, FK5, Galactic
+    import astropy.units as u
+    HAS_ASTRO = True
+except ImportError:
+    HAS_ASTRO = False
+
+
+def random_points(n=1000):
+    rng = np.random.RandomState(0)
+    return (rng.uniform(0, 2 * np.pi, n),
+            np.arcsin(rng.uniform(-1, 1, n)))
+
+
+def separation(l1, b1, l2, b2):
+    c = (np.sin(b1) * np.sin(b2) +
+         np.cos(b1) * np.cos(b2) * np.cos(l1 - l2))
+    return np.arccos(np.clip(c, -1, 1))
+
+
+def test_rotation_matrix():
+    m = rotation_matrix(np.pi / 2, 'z')
+    # rotating the axes by 90 degrees moves the y axis onto x
+    np.testing.assert_allclose(np.dot(m, [0, 1, 0]), [1, 0, 0], atol=1e-15)
+
+
+@pytest.mark.parametrize('frames', ['CG', 'GC', 'CE', 'EG', 'CC'])
+def test_matrices_orthonormal(frames):
+    m = frame_matrix(*frames)
+    np.testing.assert_allclose(np.dot(m, m.T), np.eye(3), atol=1e-14)
+    np.testing.assert_allclose(np.dot(frame_matrix(*frames[::-1]), m),
+                               np.eye(3), atol=1e-14)
+
+
+def test_known_points():
+    # the galactic center and north pole
+    l, b = transform(np.radians([266.40499, 192.85948]),
+                     np.radians([-28.93617, 27.12825]), 'C', 'G')
+    np.testing.assert_allclose(np.degrees(b), [0, 90], atol=1e-4)
+    assert abs(np.degrees(l[0])) < 1e-4
+
+    # the north ecliptic pole
+    l, b = transform(np.radians(270.), np.radians(90 - 23.4392911), 'C', 'E')
+    np.testing.assert_allclose(np.degrees(b), 90, atol=1e-8)
+
+
+def test_round_trip():
+    lon, lat = random_points()
+    l, b = transform(*transform(lon, lat, 'C', 'E'), frame_from='E',
+                     frame_to='C')
+    assert separation(lon, lat, l, b).max() < 1e-7
+
+
+def test_invalid_frame():
+    with pytest.raises(ValueError):
+        frame_matrix('C', 'X')
+    with pytest.raises(ValueError):
+        frame_sampler(None, 'GE')
+
+
+@pytest.mark.skipif('not HAS_ASTRO')
+def test_against_astropy():
+    lon, lat = random_points()
+    c = SkyCoord(lon * u.rad, lat * u.rad, frame=FK5(equinox='J2000'))
+    g = c.transform_to(Galactic())
+    l, b = rotate(lon, lat, EQUATORIAL_TO_GALACTIC)
+    assert np.degrees(separation(l, b, g.l.rad, g.b.rad)).max() < 1. / 3600
+
+
+def test_frame_sampler():
+    def sampler(l, b):
+        return b
+
+    lon, lat = random_points(10)
+    assert frame_sampler(sampler, 'C') is sampler
+    np.testing.assert_allclose(frame_sampler(sampler, 'G')(lon, lat),
+                               transform(lon, lat, 'C', 'G')[1])
+
+
+def test_frame_sampler_coverage():
+    def sampler(l, b):
+        return b
+    sampler.coverage = lambda corners: corners
+
+    lon, lat = random_points(4)
+    corners = list(zip(lon, lat))
+    rotated = frame_sampler(sampler, 'G').coverage(corners)
+    np.testing.assert_allclose(rotated, np.transpose(
+        transform(lon, lat, 'C', 'G')))
+
+
+def test_cartesian_sampler_coord():
+    data = np.arange(180 * 360).reshape(180, 360)
+    l, b = np.radians([[10.5, 200.5]]), np.radians([[5.5, -60.5]])
+    lon, lat = transform(l, b, 'G', 'C')
+    np.testing.assert_array_equal(cartesian_sampler(data, coord='G')(lon, lat),
+                                  cartesian_sampler(data)(l, b))
@@ -0,0 +1,217 @@
+import os
+from threading import Thread
+from time import sleep
+from tempfile import mkdtemp
+from shutil import rmtree
+
+import numpy as np
+import pytest
+
+try:
+    import healpy
+    from astropy.io import fits
+    HAS_HEALPY = True
+except ImportError:
+    HAS_HEALPY = False
+
+from .. import iter_tiles
+from .. import hips
+from ..io import save_png
+from ..tile import healpix_sampler
+from ..hips import hips_sampler, read_properties, tile_path, TileCache
+
+WIDTH = 4
+
+
+def xy2hpx(nsize):
+    """
+    The nested sub-index of each pixel of a tile, in row-major order
+    from the top left. Ported from Aladin's Util.createHealpixOrder
+    """
+    npix = np.zeros(nsize * nsize, dtype=int)
+
+    def fill(nsize, pos):
+        size = nsize * nsize
+        children = [[], [], [], []]
+        for i in range(size):
+            dg = 0 if (i % nsize) < nsize // 2 else 1
+            bh = 1 if i < size // 2 else 0
+            quad = (dg << 1) | bh
+            j = i if pos is None else pos[i]
+            npix[j] = npix[j] << 2 | quad
+            children[quad].append(j)
+        if size > 4:
+            for c in children:
+                fill(nsize // 2, c)
+
+    fill(nsize, None)
+    return npix.reshape(nsize, nsize)
+
+
+def write_hips(base, maps, frame='equatorial', fmt='png', skip=()):
+    """Write nested HEALPix maps (one per order) as a HiPS"""
+    orders = sorted(maps)
+    with open(os.path.join(base, 'properties'), 'w') as outfile:
+        outfile.write('# a test survey\n')
+        outfile.write('hips_order = %i\n' % orders[-1])
+        outfile.write('hips_order_min = %i\n' % orders[0])
+        outfile.write('hips_tile_width = %i\n' % WIDTH)
+        outfile.write('hips_frame = %s\n' % frame)
+        outfile.write('hips_tile_format = %s\n' % fmt)
+
+    order = xy2hpx(WIDTH)
+    for k, m in maps.items():
+        for ipix in range(12 * 4 ** k):
+            if (k, ipix) in skip:
+                continue
+            tile = m[ipix * WIDTH ** 2 + order]
+            pth = tile_path(base, k, ipix, 'fits' if fmt == 'fits' else fmt)
+            if not os.path.exists(os.path.dirname(pth)):
+                os.makedirs(os.path.dirname(pth))
+            if fmt == 'fits':
+                fits.writeto(pth, tile[::-1])
+            else:
+                save_png(pth, tile)
+
+
+def make_maps(orders=(0, 1, 2), dtype=np.uint8):
+    rng = np.random.RandomState(0)
+    return dict((k, rng.randint(0, 255, 12 * 4 ** k * WIDTH ** 2).astype(dtype))
+                for k in orders)
+
+
+def random_lonlat(n=2000):
+    rng = np.random.RandomState(1)
+    return rng.uniform(0, 2 * np.pi, n), np.arcsin(rng.uniform(-1, 1, n))
+
+
+@pytest.mark.skipif('not HAS_HEALPY')
+class TestHipsSampler(object):
+
+    def setup_method(self, method):
+        self.base = mkdtemp()
+
+    def teardown_method(self, method):
+        rmtree(self.base)
+
+    def test_properties(self):
+        write_hips(self.base, make_maps((0,)), frame='galactic')
+        props = read_properties(self.base)
+        assert props['hips_frame'] == 'galactic'
+        assert props['hips_tile_width'] == '4'
+        assert '# a test survey' not in props
+
+    @pytest.mark.parametrize('fmt', ['png', 'fits'])
+    def test_matches_healpix(self, fmt):
+        dtype = np.float32 if fmt == 'fits' else np.uint8
+        maps = make_maps(dtype=dtype)
+        write_hips(self.base, maps, fmt=fmt)
+        lon, lat = random_lonlat()
+
+        for k in maps:
+            expected = healpix_sampler(maps[k], nest=True)(lon, lat)
+            actual = hips_sampler(self.base, order=k)(lon, lat)
+            assert actual.dtype == dtype
+            np.testing.assert_array_equal(actual, expected)
+
+    def test_pixel_centers(self):
+        maps = make_maps()
+        write_hips(self.base, maps)
+        nside = 2 ** 2 * WIDTH
+        theta, phi = healpy.pix2ang(nside, np.arange(12 * nside ** 2),
+                                    nest=True)
+        actual = hips_sampler(self.base, order=2)(phi, np.pi / 2 - theta)
+        np.testing.assert_array_equal(actual, maps[2])
+
+    @pytest.mark.parametrize('frame', ['galactic', 'ecliptic'])
+    def test_frame(self, frame):
+        maps = make_maps((1,))
+        write_hips(self.base, maps, frame=frame)
+        lon, lat = random_lonlat()
+        expected = healpix_sampler(maps[1], nest=True,
+                                   coord=frame[0].upper())(lon, lat)
+        np.testing.assert_array_equal(hips_sampler(self.base)(lon, lat),
+                                      expected)
+
+    def test_order_matches_level(self):
+        maps = make_maps()
+        write_hips(self.base, maps)
+        sampler = hips_sampler(self.base)
+        list(iter_tiles(sampler, depth=1, merge=False))
+
+        # 256 pixel toast tiles are finer than every order,
+        # so each level reads the deepest tiles
+        loaded = set(o for o, _ in sampler.cache._tiles)
+        assert loaded == set([2])
+
+        # coarse grids read coarse tiles
+        sampler = hips_sampler(self.base)
+        l, b = np.meshgrid(np.linspace(0, 2 * np.pi, 8, endpoint=False),
+                           np.linspace(-1, 1, 8))
+        sampler(l, b)
+        assert set(o for o, _ in sampler.cache._tiles) == set([0])
+
+    def test_missing_tiles(self):
+        maps = make_maps((0,), dtype=np.float32)
+        write_hips(self.base, maps, fmt='fits', skip=[(0, 3)])
+        nside = WIDTH
+        theta, phi = healpy.pix2ang(nside, np.arange(12 * nside ** 2),
+                                    nest=True)
+        actual = hips_sampler(self.base)(phi, np.pi / 2 - theta)
+        missing = np.arange(actual.size) // WIDTH ** 2 == 3
+        assert np.isnan(actual[missing]).all()
+        np.testing.assert_array_equal(actual[~missing], maps[0][~missing])
+
+    def test_invalid(self):
+        write_hips(self.base, make_maps((0,)))
+        with pytest.raises(ValueError) as exc:
+            hips_sampler(self.base, format='gif')
+        assert 'Invalid format' in exc.value.args[0]
+
+
+@pytest.mark.skipif('not HAS_HEALPY')
+def test_tile_cache():
+    base = mkdtemp()
+    try:
+        write_hips(base, make_maps((1,)))
+        # each tile is 16 bytes
+        cache = TileCache(base, 'png', cache_mb=64 / 2 ** 20)
+        for ipix in range(8):
+            cache.get(1, ipix)
+        assert cache.nbytes <= 64
+        assert len(cache._tiles) == 4
+        assert cache.misses == 8
+
+        cache.get(1, 7)
+        assert cache.hits == 1
+        assert cache.get(1, 1000) is None
+    finally:
+        rmtree(base)
+
+
+@pytest.mark.skipif('not HAS_HEALPY')
+def test_tile_cache_threads(monkeypatch):
+    base = mkdtemp()
+    read_tile = hips._read_tile
+
+    def slow_read(pth):  # let other threads run
+        sleep(0.001)
+        return read_tile(pth)
+    monkeypatch.setattr(hips, '_read_tile', slow_read)
+    try:
+        write_hips(base, make_maps((1,)))
+        cache = TileCache(base, 'png', cache_mb=64 / 2 ** 20)
+
+        def run(seed):
+            rng = np.random.RandomState(seed)
+            for ipix in rng.randint(0, 48, 50):
+                assert cache.get(1, ipix) is not None
+        threads = [Thread(target=run, args=(seed,)) for seed in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert cache.nbytes == sum(t.nbytes for t in cache._tiles.values())
+        assert cache.nbytes <= 64
+    finally:
+        rmtree(base)
@@ -0,0 +1,117 @@
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+try:
+    from io import BytesIO
+except ImportError:  # python 2.X
+    from cStringIO import StringIO as BytesIO
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from ..io import (TileWriter, TileEncoder, get_encoder,
+                  read_png, save_png)
+
+
+class TestTileWriter(object):
+
+    def setup_method(self, method):
+        self.base = mkdtemp()
+
+    def teardown_method(self, method):
+        rmtree(self.base)
+
+    @pytest.mark.parametrize('threads', (0, 1, 3))
+    def test_write(self, threads):
+        tiles = dict((os.path.join(self.base, '%i.png' % i),
+                      np.zeros((8, 8), dtype=np.uint8) + i)
+                     for i in range(20))
+        with TileWriter(threads, maxsize=2) as writer:
+            for pth, tile in tiles.items():
+                writer.put(pth, tile)
+
+        for pth, tile in tiles.items():
+            np.testing.assert_array_equal(read_png(pth), tile)
+
+    @pytest.mark.parametrize('threads', (0, 2))
+    def test_error(self, threads):
+        pth = os.path.join(self.base, 'missing', 'x.png')
+        tile = np.zeros((8, 8), dtype=np.uint8)
+
+        with pytest.raises(IOError):
+            with TileWriter(threads) as writer:
+                writer.put(pth, tile)
+
+    def test_error_not_masked(self):
+        pth = os.path.join(self.base, 'missing', 'x.png')
+        tile = np.zeros((8, 8), dtype=np.uint8)
+
+        with pytest.raises(KeyError):
+            with TileWriter(2) as writer:
+                writer.put(pth, tile)
+                raise KeyError()
+
+
+class TestTileEncoder(object):
+
+    def setup_method(self, method):
+        self.rgb = np.random.RandomState(0).randint(
+            0, 255, (32, 32, 3)).astype(np.uint8)
+
+    def test_default_matches_save_png(self):
+        base = mkdtemp()
+        try:
+            pth = os.path.join(base, 'x.png')
+            save_png(pth, self.rgb)
+            with open(pth, 'rb') as infile:
+                assert infile.read() == TileEncoder().encode(self.rgb)
+        finally:
+            rmtree(base)
+
+    @pytest.mark.parametrize('strategy', sorted(TileEncoder.strategies))
+    def test_png_options(self, strategy):
+        enc = TileEncoder(compress_level=9, strategy=strategy)
+        result = Image.open(BytesIO(enc.encode(self.rgb)))
+        np.testing.assert_array_equal(np.asarray(result), self.rgb)
+
+    @pytest.mark.parametrize('nvalues', (2, 4, 16, 17))
+    def test_palette(self, nvalues):
+        base = mkdtemp()
+        try:
+            pth = os.path.join(base, 'x.png')
+            im = (np.arange(32 * 32) % nvalues * 3).astype(np.uint8)
+            im = im.reshape(32, 32)
+            TileEncoder(optimize=True).save(pth, im)
+            np.testing.assert_array_equal(read_png(pth), im)
+            mode = 'P' if nvalues <= 16 else 'L'
+            assert Image.open(pth).mode == mode
+        finally:
+            rmtree(base)
+
+    @pytest.mark.parametrize(('fmt', 'ext', 'pil_format'),
+                             [('jpeg', '.jpg', 'JPEG'),
+                              ('jpg', '.jpg', 'JPEG'),
+                              ('webp', '.webp', 'WEBP')])
+    def test_lossy(self, fmt, ext, pil_format):
+        enc = TileEncoder(fmt, quality=50)
+        assert enc.extension == ext
+
+        rgba = np.dstack((self.rgb, self.rgb[:, :, :1]))
+        for im in (self.rgb, rgba):
+            result = Image.open(BytesIO(enc.encode(im)))
+            assert result.format == pil_format
+            assert result.size == (32, 32)
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            TileEncoder('gif')
+        with pytest.raises(ValueError):
+            TileEncoder(strategy='fast')
+
+    def test_get_encoder(self):
+        enc = TileEncoder('webp')
+        assert get_encoder(enc) is enc
+        assert get_encoder('jpeg').format == 'jpeg'
+        assert get_encoder(None).format == 'png'
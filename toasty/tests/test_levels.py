@@ -0,0 +1,118 @@
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+import numpy as np
+import pytest
+
+from .. import iter_tiles, toast
+from ..io import read_png
+from ..levels import iter_levels, LevelStore, sample_level, reduce_level
+from ..merge import MergeKernel
+from . import random_sampler
+
+
+def make_sampler(dtype=np.float32):
+    return random_sampler((128, 256, 3), dtype, nans=True)
+
+
+def assert_same_tiles(a, b):
+    a, b = dict(a), dict(b)
+    assert sorted(a) == sorted(b)
+    for k in a:
+        np.testing.assert_array_equal(a[k], b[k])
+
+
+@pytest.mark.parametrize('depth', (0, 1, 3))
+@pytest.mark.parametrize('merge', (True, 'nanmean', 'max'))
+def test_matches_iter_tiles(depth, merge):
+    sampler = make_sampler()
+    assert_same_tiles(iter_tiles(sampler, depth, merge),
+                      iter_levels(sampler, depth, merge, chunk=3))
+
+
+def test_custom_merge():
+    sampler = make_sampler(np.uint8)
+
+    def merge(mosaic):
+        assert mosaic.shape[:2] == (512, 512)
+        return mosaic[1::2, 1::2]
+
+    assert_same_tiles(iter_tiles(sampler, 2, merge),
+                      iter_levels(sampler, 2, merge))
+
+
+@pytest.mark.parametrize('memory_mb', (0, 256))
+def test_threads_and_files(memory_mb):
+    sampler = make_sampler()
+    base = mkdtemp()
+    try:
+        tiles = iter_levels(sampler, 2, directory=base, threads=3, chunk=1,
+                            memory_mb=memory_mb)
+        assert_same_tiles(iter_tiles(sampler, 2), tiles)
+        assert os.listdir(base) == []
+    finally:
+        rmtree(base)
+
+
+def test_level_store():
+    base = mkdtemp()
+    try:
+        im = np.arange(16 * 16, dtype=np.uint8).reshape(16, 16)
+
+        def sampler(l, b):
+            return im
+        sampler.sample_tile = lambda pos: im + pos.x + 2 * pos.y
+
+        store = sample_level(sampler, 2, base)
+        assert os.path.exists(store.path)
+        assert store.data.shape == (64, 64)
+        np.testing.assert_array_equal(store.tile(3, 1), im + 5)
+
+        parent = reduce_level(store, MergeKernel('nearest'), None)
+        assert parent.path is None
+        np.testing.assert_array_equal(parent.tile(1, 0)[:8, :8],
+                                      im[::2, ::2] + 2)
+
+        store.close()
+        assert not os.path.exists(store.path)
+    finally:
+        rmtree(base)
+
+
+def test_invalid():
+    sampler = make_sampler()
+    with pytest.raises(ValueError):
+        list(iter_levels(sampler, 1, merge=False))
+    with pytest.raises(ValueError):
+        list(iter_levels({'a': sampler}, 1))
+
+
+class TestToastBreadthFirst(object):
+
+    def setup_method(self, method):
+        self.base = mkdtemp()
+
+    def teardown_method(self, method):
+        rmtree(self.base)
+
+    def test_same_files(self):
+        sampler = make_sampler(np.uint8)
+        a = os.path.join(self.base, 'a')
+        b = os.path.join(self.base, 'b')
+        toast(sampler, 2, a)
+        toast(sampler, 2, b, breadth_first=True, workers=2,
+              level_dir=self.base)
+
+        for root, dirs, files in os.walk(a):
+            for f in files:
+                pth = os.path.relpath(os.path.join(root, f), a)
+                np.testing.assert_array_equal(
+                    read_png(os.path.join(a, pth)),
+                    read_png(os.path.join(b, pth)))
+        assert sorted(os.listdir(self.base)) == ['a', 'b']
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            toast(make_sampler(), 1, self.base, breadth_first=True,
+                  sparse=True)
@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+
+from ..limits import (sky_sample, random_sample, QuantileSketch,
+                      sketch_sampler, get_sketch, auto_limits)
+from .. import normalizer
+
+
+def lat_sampler(x, y):
+    """sin(lat) is uniform over the sky"""
+    return np.sin(y)
+
+
+def test_sky_sample():
+    values = sky_sample(lat_sampler, level=1, npix=16)
+    assert values.shape == (4 * 16 * 16,)
+    assert abs(np.median(values)) < .05
+
+
+def test_random_sample():
+    values = random_sample(lat_sampler, size=10000, seed=0)
+    assert values.size >= 10000
+    np.testing.assert_allclose(np.percentile(values, [10, 90]),
+                               [-.8, .8], atol=.03)
+
+
+def test_sample_ignores_nan():
+    def sampler(x, y):
+        return np.where(y > 0, np.nan, y)
+
+    assert np.isfinite(sky_sample(sampler, level=1, npix=8)).all()
+
+
+class TestQuantileSketch(object):
+
+    def test_small(self):
+        s = QuantileSketch(100)
+        s.update(np.arange(10.))
+        s.update([np.nan, np.inf])
+        assert s.count == 10
+        np.testing.assert_array_equal(np.sort(s.values), np.arange(10.))
+        assert s.limits(0, 100) == (0, 9)
+
+    def test_stream(self):
+        s = QuantileSketch(5000, seed=1)
+        data = np.random.RandomState(0).uniform(0, 1, 200000)
+        for chunk in np.split(data, 100):
+            s.update(chunk)
+        assert s.count == data.size
+        assert s.values.size == 5000
+        np.testing.assert_allclose(s.percentile([5, 50, 95]),
+                                   [.05, .5, .95], atol=.02)
+
+    def test_uniform_reservoir(self):
+        # the reservoir is an unbiased sample of the whole stream
+        s = QuantileSketch(2000, seed=2)
+        s.update(np.zeros(100000))
+        s.update(np.ones(100000))
+        assert abs(s.values.mean() - .5) < .05
+
+    def test_equalization(self):
+        s = QuantileSketch(2000)
+        s.update(np.arange(1001.) ** 2)
+        curve = s.equalization(4)
+        np.testing.assert_allclose(curve, np.array([0, 250, 500, 750,
+                                                    1000.]) ** 2)
+
+    def test_empty(self):
+        with pytest.raises(ValueError):
+            QuantileSketch().percentile(50)
+
+
+def test_sketch_sampler():
+    s = QuantileSketch(1000)
+    wrapped = sketch_sampler(lat_sampler, s)
+    x = np.zeros((4, 4))
+    np.testing.assert_array_equal(wrapped(x, x), 0)
+    assert s.count == 16
+    assert get_sketch(lat_sampler, s) is s
+
+
+def test_auto_limits():
+    lo, hi = auto_limits(lat_sampler, 5, 95)
+    np.testing.assert_allclose([lo, hi], [-.9, .9], atol=.02)
+    lo, hi = auto_limits(lat_sampler, 0, 100, sample=[3, 1, 2])
+    assert (lo, hi) == (1, 3)
+    with pytest.raises(ValueError):
+        auto_limits(lat_sampler, sample='everything')
+
+
+def test_normalizer_auto():
+    x = np.zeros((1, 3))
+    y = np.array([[-1.5, 0, 1.5]])
+    sampler = normalizer(lat_sampler, 'auto', 'auto', percentiles=(5, 95))
+    np.testing.assert_array_equal(sampler(x, y), [[0, 127, 255]])
+
+    sampler = normalizer(lat_sampler, 'auto', 0.)
+    assert sampler(x, y)[0, 2] == 255
+
+
+def test_normalizer_histeq():
+    def sampler(x, y):
+        return np.sin(y) ** 3  # concentrated around 0
+
+    rng = np.random.RandomState(0)
+    x = np.zeros((100, 100))
+    y = np.arcsin(rng.uniform(-1, 1, x.shape))  # uniform over the sky
+
+    counts = {}
+    for scaling in ['linear', 'histeq']:
+        scaled = normalizer(sampler, 'auto', 'auto', scaling=scaling,
+                            percentiles=(0, 100))
+        values = scaled(x, y)
+        assert values.dtype == np.uint8
+        counts[scaling] = np.histogram(values, bins=8, range=(0, 256))[0]
+
+    # equalized intensities are spread evenly
+    assert counts['histeq'].min() > 0.6 * counts['histeq'].max()
+    assert counts['linear'].min() < 0.2 * counts['linear'].max()
@@ -0,0 +1,68 @@
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+
+from ..manifest import Manifest
+
+
+class TestManifest(object):
+
+    def setup_method(self, method):
+        self.base = mkdtemp()
+        for n in range(2):
+            for y in range(2 ** n):
+                os.makedirs(os.path.join(self.base, str(n), str(y)))
+        self.tile = (np.arange(256 * 256) % 251).astype(np.uint8) \
+                                                 .reshape(256, 256)
+
+    def teardown_method(self, method):
+        rmtree(self.base)
+
+    def save(self, m, pos):
+        m.save(os.path.join(self.base, m.tile_path(pos)), self.tile)
+
+    def test_save_load(self):
+        m = Manifest(self.base)
+        self.save(m, (1, 1, 0))
+        assert (1, 1, 0) in m
+        np.testing.assert_array_equal(m.load((1, 1, 0)), self.tile)
+
+        # reloaded from disk
+        m = Manifest(self.base)
+        assert len(m) == 1
+        np.testing.assert_array_equal(m.load((1, 1, 0)), self.tile)
+        assert m.load((1, 0, 0)) is None
+
+    def test_complete(self):
+        m = Manifest(self.base)
+        for pos in [(0, 0, 0), (1, 0, 0), (1, 1, 0), (1, 0, 1)]:
+            self.save(m, pos)
+        assert m.complete((1, 0, 0), 1)
+        assert not m.complete((0, 0, 0), 1)
+        assert m.complete((0, 0, 0), 0)
+
+        # a recorded tile that was deleted isn't complete
+        os.remove(os.path.join(self.base, m.tile_path((1, 1, 0))))
+        assert not Manifest(self.base).complete((1, 1, 0), 1)
+
+    def test_corrupt(self):
+        m = Manifest(self.base)
+        self.save(m, (1, 0, 0))
+        with open(os.path.join(self.base, m.tile_path((1, 0, 0))), 'ab') as f:
+            f.write(b'garbage')
+        assert m.load((1, 0, 0)) is None
+
+    def test_partial_line(self):
+        m = Manifest(self.base)
+        self.save(m, (1, 0, 0))
+        with open(m.path, 'ab') as f:
+            f.write(b'0123abcd 1/0/0_1.p')
+        m = Manifest(self.base)
+        assert (1, 0, 0) in m
+        assert (1, 1, 0) not in m
+
+    def test_encoder(self):
+        m = Manifest(self.base, encoder='jpeg')
+        assert m.tile_path((2, 1, 3)) == '2/3/3_1.jpg'
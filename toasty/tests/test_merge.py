@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+
+from ..merge import MergeKernel, get_merge, _mean, _nanmean, _max, _nearest
+from .._libtoasty import downsample
+from .. import iter_tiles
+
+DTYPES = [np.uint8, np.uint16, np.int16, np.int32, np.int64,
+          np.float32, np.float64, np.int8, np.bool_]
+
+
+def random_tiles(dtype, shape, nan=False):
+    rng = np.random.RandomState(42)
+    tiles = []
+    for i in range(4):
+        t = rng.uniform(-1000, 1000, shape)
+        if np.dtype(dtype).kind in 'fc':
+            if nan:
+                t[rng.uniform(size=shape) < .3] = np.nan
+                t[:2, :2] = np.nan
+        else:
+            t = np.abs(t) if np.dtype(dtype).kind in 'ub' else t
+            t = t.astype(np.int64) % np.iinfo(np.int8).max
+        tiles.append(t.astype(dtype))
+    return tiles
+
+
+@pytest.mark.parametrize('dtype', DTYPES)
+@pytest.mark.parametrize('shape', [(8, 8), (8, 8, 3)])
+@pytest.mark.parametrize(('method', 'reference'),
+                         [('mean', _mean), ('nanmean', _nanmean),
+                          ('max', _max), ('nearest', _nearest)])
+def test_kernel(dtype, shape, method, reference):
+    ul, ur, bl, br = random_tiles(dtype, shape, nan=method != 'mean')
+    mosaic = np.vstack((np.hstack((ul, ur)), np.hstack((bl, br))))
+
+    expected = reference(mosaic)
+    result = MergeKernel(method).merge(ul, ur, bl, br)
+    assert result.dtype == expected.dtype
+    np.testing.assert_array_equal(result, expected)
+    np.testing.assert_array_equal(MergeKernel(method)(mosaic), expected)
+
+
+def test_mean_negative():
+    # integers are truncated towards zero, like a float cast
+    tiles = [np.array([[-1, -2], [-2, -2]], dtype=np.int16)] * 4
+    mosaic = np.vstack((np.hstack(tiles[:2]), np.hstack(tiles[2:])))
+    np.testing.assert_array_equal(MergeKernel().merge(*tiles), _mean(mosaic))
+
+
+def test_out():
+    tiles = random_tiles(np.float32, (4, 4))
+    out = np.zeros((4, 4), dtype=np.float32)
+    assert MergeKernel().merge(*tiles, out=out) is out
+    np.testing.assert_array_equal(out, MergeKernel().merge(*tiles))
+
+
+def test_readonly():
+    tiles = random_tiles(np.uint8, (4, 4))
+    for t in tiles:
+        t.flags.writeable = False
+    np.testing.assert_array_equal(MergeKernel().merge(*tiles),
+                                  downsample(*[t.copy() for t in tiles]))
+
+
+def test_odd_shape():
+    tiles = random_tiles(np.uint8, (3, 3))
+    mosaic = np.vstack((np.hstack(tiles[:2]), np.hstack(tiles[2:])))
+    np.testing.assert_array_equal(MergeKernel().merge(*tiles), _mean(mosaic))
+
+
+def test_downsample_invalid():
+    a = np.zeros((4, 4), dtype=np.uint8)
+    with pytest.raises(ValueError):
+        downsample(a, a, a, a.astype(np.float32))
+    with pytest.raises(ValueError):
+        downsample(a, a, a, a, method=7)
+    with pytest.raises(ValueError):
+        downsample(a, a, a, a, out=np.zeros((2, 2), dtype=np.uint8))
+    with pytest.raises(TypeError):
+        downsample(*[a.astype(np.int8)] * 4)
+
+
+def test_get_merge():
+    assert get_merge(True).method == 'mean'
+    assert get_merge('max').method == 'max'
+    assert get_merge(False) is False
+    with pytest.raises(ValueError):
+        get_merge('median')
+
+
+def test_iter_tiles_method():
+    def sampler(x, y):
+        return np.where(x > 1, np.nan, y).astype(np.float32)
+
+    tiles = dict(iter_tiles(sampler, 1, merge='nanmean'))
+    assert np.isfinite(tiles['0/0/0_0.png']).any()
+
+    seen = []
+
+    def custom(mosaic):
+        seen.append(mosaic.shape)
+        return mosaic[::2, ::2]
+
+    dict(iter_tiles(sampler, 1, merge=custom))
+    assert seen == [(512, 512)]
@@ -0,0 +1,171 @@
+import warnings
+from threading import Thread
+from time import sleep
+
+import numpy as np
+import pytest
+
+try:
+    import healpy
+    HAS_HEALPY = True
+except ImportError:
+    HAS_HEALPY = False
+
+from .. import iter_tiles, cartesian_sampler, healpix_sampler
+from ..mipmap import (reduce_cartesian, reduce_healpix, Mipmap,
+                      cartesian_mipmap, healpix_mipmap)
+
+
+def test_reduce_cartesian():
+    data = np.random.RandomState(0).uniform(0, 1, (8, 16, 3))
+    data[0, 0] = data[0, 1] = data[1, 0] = np.nan
+    data[2:4, 2:4] = np.nan
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        expected = np.nanmean(data.reshape(4, 2, 8, 2, 3), axis=(1, 3))
+    for chunk in (1, 3, 4, 1024):
+        actual = reduce_cartesian(data, chunk=chunk)
+        np.testing.assert_array_equal(actual, expected)
+    assert np.isnan(actual[1, 1]).all()
+    assert np.isfinite(actual[0, 0]).all()
+
+
+def test_reduce_cartesian_rounds_ints():
+    data = np.array([[0, 1, 2, 2], [1, 1, 3, 3]], dtype=np.uint8)
+    actual = reduce_cartesian(data)
+    assert actual.dtype == np.uint8
+    np.testing.assert_array_equal(actual, [[1, 2]])
+
+
+@pytest.mark.skipif('not HAS_HEALPY')
+def test_reduce_healpix():
+    nside = 16
+    nested = np.random.RandomState(0).uniform(0, 1, 12 * nside ** 2)
+    ring = healpy.reorder(nested, n2r=True)
+
+    expected = healpy.ud_grade(nested, nside // 2, order_in='NESTED')
+    np.testing.assert_allclose(reduce_healpix(nested, chunk=100), expected)
+    np.testing.assert_allclose(reduce_healpix(ring, nest=False, chunk=7),
+                               expected)
+
+
+def test_mipmap_is_lazy():
+    calls = []
+
+    def reduce(level, j):
+        calls.append(j)
+        return level[::2]
+
+    m = Mipmap(np.arange(16), reduce, 1., 4)
+    assert calls == []
+    np.testing.assert_array_equal(m.level(2), [0, 4, 8, 12])
+    assert calls == [0, 1]
+    m.level(1)
+    assert calls == [0, 1]
+    m.build()
+    assert calls == [0, 1, 2]
+    with pytest.raises(IndexError):
+        m.level(4)
+
+
+def test_mipmap_threads():
+    calls = []
+
+    def reduce(level, j):
+        calls.append(j)
+        sleep(0.01)  # let the other threads catch up
+        return level[::2]
+
+    m = Mipmap(np.arange(16), reduce, 1., 4)
+    threads = [Thread(target=m.level, args=(3,)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert calls == [0, 1, 2]
+    np.testing.assert_array_equal(m.level(3), [0, 8])
+
+
+def test_choose():
+    m = Mipmap(None, None, 0.1, 4)
+    assert m.choose(0) == 0
+    assert m.choose(0.05) == 0
+    assert m.choose(0.1) == 0
+    assert m.choose(0.3) == 1
+    assert m.choose(0.4) == 2
+    assert m.choose(100) == 3
+
+
+def test_cartesian_levels():
+    m = cartesian_mipmap(np.zeros((24, 48)))
+    assert m.nlevels == 4
+    assert m.level(3).shape == (3, 6)
+    assert m.pixel_size == np.pi / 24
+
+
+class TestCartesianMipmap(object):
+
+    def setup_method(self, method):
+        rng = np.random.RandomState(0)
+        self.data = rng.uniform(0, 255, (1024, 2048)).astype(np.float32)
+
+    def test_coarse_levels(self):
+        sampler = cartesian_sampler(self.data, mipmap=True)
+        mipped = dict(iter_tiles(sampler, depth=1, merge=False))
+        # 256 pixel tiles at level 1 are about 3x coarser than the map
+        assert len(sampler.mipmap._levels) == 2
+
+        plain = dict(iter_tiles(cartesian_sampler(self.data), 1, False))
+        coarse = cartesian_sampler(sampler.mipmap.level(1))
+        expected = dict(iter_tiles(coarse, 1, False))
+        np.testing.assert_array_equal(mipped['1/0/0_0.png'],
+                                      expected['1/0/0_0.png'])
+
+        # averaging suppresses the noise of point sampling
+        assert mipped['1/0/0_0.png'].std() < plain['1/0/0_0.png'].std() * .75
+
+    def test_fine_levels_unchanged(self):
+        data = self.data[::8, ::8].copy()
+        plain = cartesian_sampler(data)
+        mipped = cartesian_sampler(data, mipmap=True)
+        for (p1, t1), (p2, t2) in zip(iter_tiles(plain, 2, False),
+                                      iter_tiles(mipped, 2, False)):
+            if p1.startswith('2/'):
+                np.testing.assert_array_equal(t1, t2)
+
+    def test_normalizer_keeps_mipmap(self):
+        from .. import normalizer
+        sampler = normalizer(cartesian_sampler(self.data, mipmap=True),
+                             0, 255)
+        assert hasattr(sampler, 'mipmap')
+
+
+@pytest.mark.skipif('not HAS_HEALPY')
+class TestHealpixMipmap(object):
+
+    def setup_method(self, method):
+        nside = 256
+        self.data = np.random.RandomState(0).uniform(0, 1, 12 * nside ** 2)
+
+    @pytest.mark.parametrize('nest', [True, False])
+    def test_coarse_levels(self, nest):
+        sampler = healpix_sampler(self.data, nest=nest, mipmap=True)
+        tiles = dict(iter_tiles(sampler, depth=1, merge=False))
+        m = sampler.mipmap
+        j = len(m._levels) - 1
+        assert j > 0
+
+        coarse = healpix_sampler(m.level(j), nest=True)
+        expected = dict(iter_tiles(coarse, depth=1, merge=False))
+        np.testing.assert_array_equal(tiles['1/0/0_0.png'],
+                                      expected['1/0/0_0.png'])
+
+    def test_levels(self):
+        m = healpix_mipmap(self.data)
+        assert m.nlevels == 9
+        assert m.level(8).size == 12
+
+    def test_index_conflict(self):
+        with pytest.raises(ValueError):
+            healpix_sampler(self.data, mipmap=True, index='foo')
@@ -89,3 +89,22 @@ class TestNormalize(object):
         x = np.array([1, 2, 3])
         y = normalize(x, vmin=3, vmax=1)
         np.testing.assert_array_almost_equal(y, [255, 127, 0])
+
+    @pytest.mark.parametrize('dtype', [np.uint8, np.int8, np.uint16,
+                                       np.int16, '>i2'])
+    @pytest.mark.parametrize('stretch', sorted(warpers))
+    def test_lookup_table(self, dtype, stretch):
+        info = np.iinfo(np.dtype(dtype))
+        x = np.linspace(info.min, info.max, 500).astype(dtype)
+        x = x.reshape(50, 10)[:, ::2]  # not contiguous
+        args = (info.min // 2, info.max // 3, .4, 1.2, stretch)
+
+        y = normalize(x, *args)
+        assert y.dtype == np.uint8
+        assert y.shape == x.shape
+        np.testing.assert_array_equal(y, normalize(x.astype(float), *args))
+
+        # inverted
+        args = (info.max // 3, info.min // 2, .4, 1.2, stretch)
+        np.testing.assert_array_equal(normalize(x, *args),
+                                      normalize(x.astype(float), *args))
@@ -0,0 +1,158 @@
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+
+import numpy as np
+import pytest
+
+from .. import iter_tiles, toast
+from ..region import (Cone, LonLatBox, Polygon, tile_cap,
+                      lonlat2xyz, xyz2lonlat)
+from .. import tile
+from ..tile import iter_corners
+from .._libtoasty import subsample
+
+
+def mock_sampler(x, y):
+    return x
+
+
+def tile_points(depth, npix=8):
+    for node, c, increasing in iter_corners(depth, bottom_only=False):
+        l, b = subsample(c[0], c[1], c[2], c[3], npix, increasing)
+        yield node, c, lonlat2xyz(l.ravel(), b.ravel())
+
+
+def test_lonlat_roundtrip():
+    lon = np.array([0.1, 1, 3, -2])
+    lat = np.array([0, -1, 1.2, .5])
+    l, b = xyz2lonlat(lonlat2xyz(lon, lat))
+    np.testing.assert_array_almost_equal(l, lon)
+    np.testing.assert_array_almost_equal(b, lat)
+
+
+def test_tile_cap_contains_tile():
+    for node, c, xyz in tile_points(3):
+        center, radius = tile_cap(c)
+        if radius >= np.pi / 2:
+            continue
+        angles = np.arccos(np.clip(np.dot(xyz, center), -1, 1))
+        assert angles.max() <= radius + 1e-9
+
+
+def cone_contains(xyz):
+    return np.degrees(np.arccos(np.dot(xyz, lonlat2xyz(*np.radians(
+        [30, 20]))))) < 10
+
+
+def box_contains(xyz):
+    lon, lat = np.degrees(xyz2lonlat(xyz))
+    lon = lon % 360
+    return ((lon > 350) | (lon < 20)) & (lat > -5) & (lat < 5)
+
+
+poly_vertices = np.radians([(200, -10), (220, -10), (220, 10),
+                            (210, 0), (200, 10)])
+
+
+def poly_contains(xyz):
+    poly = Polygon(poly_vertices)
+    return np.array([poly.contains(p) for p in xyz])
+
+
+@pytest.mark.parametrize(('region', 'contains'),
+                         [(Cone(np.radians(30), np.radians(20),
+                                np.radians(10)), cone_contains),
+                          (LonLatBox(np.radians(350), np.radians(20),
+                                     np.radians(-5), np.radians(5)),
+                           box_contains),
+                          (Polygon(poly_vertices), poly_contains)])
+def test_coverage(region, contains):
+    covered = 0
+    total = 0
+    for node, c, xyz in tile_points(3):
+        if node.n != 3:
+            continue
+        total += 1
+        cov = region.coverage(c)
+        covered += cov
+        if contains(xyz).any():
+            assert cov, node
+
+    assert 0 < covered < total / 4
+
+
+def test_polygon_contains():
+    poly = Polygon(poly_vertices)
+    inside = lonlat2xyz(*np.radians([205, 5]))
+    notch = lonlat2xyz(*np.radians([210, 5]))
+    outside = lonlat2xyz(*np.radians([30, 5]))
+    assert poly.contains(inside)
+    assert not poly.contains(notch)
+    assert not poly.contains(outside)
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        Polygon([(0, 0), (1, 1)])
+    with pytest.raises(ValueError):
+        LonLatBox(0, 1, 1, 0)
+
+
+def test_iter_tiles_region():
+    region = Cone(np.radians(30), np.radians(20), np.radians(5))
+    calls = []
+
+    def sampler(x, y):
+        calls.append(1)
+        return mock_sampler(x, y)
+
+    dense = dict(iter_tiles(mock_sampler, 4))
+    result = dict(iter_tiles(sampler, 4, region=region))
+
+    assert 0 < len(calls) < 4 ** 4 / 20
+    assert set(result) < set(dense)
+    for pth, im in result.items():
+        if pth.startswith('4'):
+            np.testing.assert_array_equal(im, dense[pth])
+
+
+@pytest.mark.parametrize('merge', (True, False))
+def test_region_coverage_released(merge, monkeypatch):
+    # the coverage of every visited tile is used, and dropped
+    region = Cone(np.radians(30), np.radians(20), np.radians(20))
+    stored = []
+    pruner = tile._pruner
+
+    def spy(data_sampler, depth, covered, *args):
+        stored.append(covered)
+        return pruner(data_sampler, depth, covered, *args)
+    monkeypatch.setattr(tile, '_pruner', spy)
+
+    assert len(list(iter_tiles(mock_sampler, 5, merge, region=region))) > 0
+    assert stored == [{}]
+
+
+def uint8_sampler(x, y):
+    return np.ones(x.shape, dtype=np.uint8)
+
+
+def test_toast_region():
+    base = mkdtemp()
+    try:
+        region = LonLatBox(0, np.radians(10), 0, np.radians(10))
+        wtml = os.path.join(base, 'test.wtml')
+        toast(uint8_sampler, 3, base, wtml_file=wtml, region=region)
+
+        expected = set(dict(iter_tiles(uint8_sampler, 3, region=region)))
+        actual = set(os.path.relpath(os.path.join(d, f), base)
+                     for d, _, files in os.walk(base)
+                     for f in files if f.endswith('.png'))
+        assert actual == expected
+        assert len(actual) < 20
+        # no directories for the tiles outside the region
+        assert all(subdirs or files for _, subdirs, files in os.walk(base))
+        with open(wtml) as infile:
+            assert 'Sparse="True"' in infile.read()
+    finally:
+        rmtree(base)
@@ -0,0 +1,256 @@
+import os
+from tempfile import mkdtemp
+from shutil import rmtree
+from threading import Thread, Lock, Event
+try:
+    from httplib import HTTPConnection
+except ImportError:  # python 3.X
+    from http.client import HTTPConnection
+try:
+    from io import BytesIO
+except ImportError:  # python 2.X
+    from cStringIO import StringIO as BytesIO
+
+import numpy as np
+import pytest
+
+from .. import toast, cartesian_sampler
+from ..io import read_png
+from ..render import TileRenderer, _healpix_depth
+from ..viewer import TileServer
+from ..windowed import windowed_sampler
+from . import random_image, random_sampler
+
+try:
+    import astropy
+    import healpy
+    HAS_HEALPIX = True
+except ImportError:
+    HAS_HEALPIX = False
+
+
+def cwd():
+    return os.path.split(os.path.abspath(__file__))[0]
+
+
+def make_sampler():
+    return random_sampler()
+
+
+def counting(sampler):
+    def result(l, b):
+        result.calls += 1
+        return sampler(l, b)
+    result.calls = 0
+    return result
+
+
+def decode(data):
+    return read_png(BytesIO(data))
+
+
+class TestTileRenderer(object):
+
+    def setup_class(cls):
+        cls.base = mkdtemp()
+        cls.merged = os.path.join(cls.base, 'merged')
+        cls.sampled = os.path.join(cls.base, 'sampled')
+        toast(make_sampler(), 2, cls.merged)
+        toast(make_sampler(), 2, cls.sampled, merge=False)
+
+    def teardown_class(cls):
+        rmtree(cls.base)
+
+    def expected(self, base, pth):
+        return read_png(os.path.join(base, pth))
+
+    def test_deepest_level(self):
+        r = TileRenderer(make_sampler(), 2)
+        for pth in ['2/1/1_3.png', '2/0/0_0.png']:
+            np.testing.assert_array_equal(decode(r.get(pth)),
+                                          self.expected(self.merged, pth))
+
+    def test_parents_sampled_or_merged(self):
+        sampler = counting(make_sampler())
+        r = TileRenderer(sampler, 2)
+
+        # without cached children, parents are sampled
+        np.testing.assert_array_equal(
+            decode(r.get('1/0/0_1.png')),
+            self.expected(self.sampled, '1/0/0_1.png'))
+        assert (r.rendered, r.merged, sampler.calls) == (1, 0, 1)
+
+        # with cached children, they are merged like toast does
+        for x in range(2):
+            for y in range(2):
+                r.get('2/%i/%i_%i.png' % (y, y, x))
+        r2 = TileRenderer(make_sampler(), 2)
+        r2._tiles = r._tiles
+        np.testing.assert_array_equal(
+            decode(r2.get('1/0/0_0.png')),
+            self.expected(self.merged, '1/0/0_0.png'))
+        assert (r2.rendered, r2.merged) == (0, 1)
+
+    def test_level_zero(self):
+        r = TileRenderer(make_sampler(), 2, merge=False)
+        np.testing.assert_array_equal(
+            decode(r.get('0/0/0_0.png')),
+            self.expected(self.sampled, '0/0/0_0.png'))
+        assert (r.rendered, r.merged) == (4, 1)
+
+    def test_cached(self):
+        sampler = counting(make_sampler())
+        r = TileRenderer(sampler, 2)
+        data = r.get('2/3/3_2.png')
+        assert r.get('2/3/3_2.png') == data
+        assert sampler.calls == 1
+
+    def test_concurrent(self):
+        # different tiles render at the same time, and
+        # duplicate requests wait for the first one
+        sampler = make_sampler()
+        lock, both = Lock(), Event()
+        inside = [0, 0]
+
+        def slow(l, b):
+            with lock:
+                inside[0] += 1
+                inside[1] = max(inside)
+                if inside[0] == 2:
+                    both.set()
+            both.wait(5)
+            with lock:
+                inside[0] -= 1
+            return sampler(l, b)
+
+        r = TileRenderer(counting(slow), 2, merge=False)
+        threads = [Thread(target=r.tile, args=pos)
+                   for pos in [(2, 0, 0), (2, 1, 0), (2, 0, 0), (2, 1, 0)]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert inside[1] == 2
+        assert r.sampler.calls == r.rendered == 2
+        assert r._rendering == {}
+
+    @pytest.mark.parametrize('kind', ['windowed', 'mipmap'])
+    def test_concurrent_cached_samplers(self, kind):
+        # samplers with caches are called by many threads at once
+        data = random_image((256, 512, 3))
+        if kind == 'windowed':
+            def make():
+                return windowed_sampler(data, block=16, cache_mb=0.01)
+        else:
+            def make():
+                return cartesian_sampler(data, mipmap=True)
+
+        tiles = [(n, x, y) for n in (1, 2) for y in range(2 ** n)
+                 for x in range(2 ** n)]
+        serial = TileRenderer(make(), 2, merge=False)
+        expected = [serial.tile(*pos) for pos in tiles]
+
+        r = TileRenderer(make(), 2, merge=False)
+        errors = []
+
+        def fetch(pos):
+            try:
+                r.tile(*pos)
+            except Exception as e:
+                errors.append(e)
+        threads = [Thread(target=fetch, args=(pos,)) for pos in tiles[::-1]]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert errors == []
+        cache = getattr(r.sampler, 'cache', None)
+        if cache is not None:
+            assert cache.nbytes == sum(b.nbytes
+                                       for b in cache._blocks.values())
+        for pos, im in zip(tiles, expected):
+            np.testing.assert_array_equal(r.tile(*pos), im)
+
+    def test_memory_bounded(self):
+        r = TileRenderer(make_sampler(), 2, cache_mb=0.5)
+        for x in range(4):
+            r.get('2/0/0_%i.png' % x)
+        assert r.nbytes <= r.limit
+        assert len(r._tiles) < 4
+
+    def test_disk_cache(self):
+        direc = os.path.join(self.base, 'cache')
+        sampler = counting(make_sampler())
+        r = TileRenderer(sampler, 2, cache_dir=direc, cache_mb=0)
+        data = r.get('2/1/1_2.png')
+        assert os.path.exists(os.path.join(direc, '2/1/1_2.png'))
+        assert r.get('2/1/1_2.png') == data
+        assert sampler.calls == 1
+
+        sampler = counting(make_sampler())
+        r = TileRenderer(sampler, 2, cache_dir=direc, disk_mb=0)
+        assert r.get('2/1/1_2.png') == data
+        assert sampler.calls == 0
+        r.get('2/1/1_1.png')  # evicts the older tile
+        assert not os.path.exists(os.path.join(direc, '2/1/1_2.png'))
+        assert os.path.exists(os.path.join(direc, '2/1/1_1.png'))
+
+    def test_missing(self):
+        r = TileRenderer(make_sampler(), 2)
+        assert r.get('3/0/0_0.png') is None
+        assert r.get('1/2/2_0.png') is None
+        assert r.get('1/0/0_0.jpg') is None
+        assert r.get('toasty.wtml') is None
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            TileRenderer(make_sampler())
+        with pytest.raises(TypeError):
+            TileRenderer(make_sampler(), 1).put('1/0/0_0.png', b'')
+
+
+def test_healpix_depth():
+    assert _healpix_depth(64) == 1
+    assert _healpix_depth(1024) == 4
+    assert _healpix_depth(2 ** 20, max_depth=8) == 8
+
+
+@pytest.mark.skipif('not HAS_HEALPIX')
+def test_render_healpix_file():
+    r = TileRenderer(os.path.join(cwd(), 'test.hpx'))
+    assert r.depth == 1
+    im = decode(r.get('1/0/0_0.png'))
+    assert im.shape == (256, 256)
+    assert im.dtype == np.uint8
+
+
+def test_serve_rendered():
+    r = TileRenderer(make_sampler(), 2)
+    server = TileServer('live', ('127.0.0.1', 0), store=r, verbose=False)
+    thread = Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        conn = HTTPConnection(*server.server_address[:2])
+        conn.request('GET', '/toasty.wtml')
+        assert 'TileLevels="2"' in str(conn.getresponse().read())
+
+        conn.request('GET', '/live/2/1/1_1.png')
+        resp = conn.getresponse()
+        assert resp.status == 200
+        assert resp.read() == r.get('2/1/1_1.png')
+        etag = resp.getheader('ETag')
+
+        conn.request('GET', '/live/2/1/1_1.png',
+                     headers={'If-None-Match': etag})
+        resp = conn.getresponse()
+        assert resp.status == 304
+        resp.read()
+
+        conn.request('GET', '/live/3/1/1_1.png')
+        resp = conn.getresponse()
+        assert resp.status == 404
+        resp.read()
+        conn.close()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,150 @@
+import os
+import json
+from tempfile import mkdtemp
+from shutil import rmtree
+
+import numpy as np
+import pytest
+
+from .. import toast, normalizer
+from .. import stats as stats_module
+from ..io import read_png
+from ..stats import BuildStats, stage, activate
+from . import random_sampler
+
+
+def make_sampler(dtype=np.uint8):
+    return random_sampler((64, 128), dtype)
+
+
+class TestBuildStats(object):
+
+    def setup_method(self, method):
+        self.now = [0.]
+        self._clock = stats_module._clock
+        stats_module._clock = lambda: self.now[0]
+
+    def teardown_method(self, method):
+        stats_module._clock = self._clock
+
+    def tick(self, dt):
+        self.now[0] += dt
+
+    def test_exclusive_stages(self):
+        stats = BuildStats()
+        with activate(stats):
+            with stage('sample'):
+                self.tick(1)
+                with stage('normalize'):
+                    self.tick(2)
+                self.tick(3)
+            with stage('merge'):
+                self.tick(4)
+        assert stats.seconds['sample'] == 4
+        assert stats.seconds['normalize'] == 2
+        assert stats.seconds['merge'] == 4
+        assert stats.calls == dict(geometry=0, sample=1, normalize=1,
+                                   merge=1, encode=0, write=0)
+
+    def test_inactive(self):
+        assert stats_module.active() is None
+        with stage('sample'):  # no-op
+            pass
+        stats = BuildStats()
+        with activate(stats):
+            assert stats_module.active() is stats
+            with activate(None):
+                assert stats_module.active() is stats
+        assert stats_module.active() is None
+
+    def test_buffer_peaks(self):
+        stats = BuildStats()
+        stats.buffered(100, 1)
+        stats.buffered(300, 3)
+        stats.buffered(-400, -4)
+        stats.buffered(50, 1)
+        assert (stats.peak_parent_tiles, stats.peak_parent_bytes) == (4, 400)
+        assert (stats.parent_tiles, stats.parent_bytes) == (1, 50)
+
+    def test_merge(self):
+        a, b = BuildStats(), BuildStats()
+        a.seconds['sample'] = 1.
+        a.calls['sample'] = 2
+        b.seconds['sample'] = 3.
+        b.calls['sample'] = 4
+        b.tiles = 5
+        b.peak_parent_bytes = 10
+        a.merge(b.state())
+        assert (a.seconds['sample'], a.calls['sample']) == (4., 6)
+        assert (a.tiles, a.peak_parent_bytes) == (5, 10)
+
+    def test_progress(self):
+        calls = []
+        stats = BuildStats(progress=calls.append, interval=0)
+        with activate(stats, total=10):
+            stats.add_tiles(4)
+        assert len(calls) == 2  # one for add_tiles, one when finished
+        assert calls[-1]['tiles'] == 4
+        assert calls[-1]['total'] == 10
+        assert calls[-1]['eta'] is not None
+
+
+class TestToastStats(object):
+
+    def setup_method(self, method):
+        self.base = mkdtemp()
+
+    def teardown_method(self, method):
+        rmtree(self.base)
+
+    def test_counts(self):
+        stats = BuildStats()
+        out = os.path.join(self.base, 'out')
+        result = toast(normalizer(make_sampler(np.float32), 0, 255), 2, out,
+                       stats=stats)
+        assert result is stats
+        assert stats.tiles == 21
+        for s in ('geometry', 'sample', 'normalize'):
+            assert stats.calls[s] == 16
+        assert stats.calls['merge'] == 5
+        assert stats.calls['encode'] == stats.calls['write'] == 21
+        assert stats.peak_parent_tiles == 7  # 3 at level 2, 4 at level 1
+        assert stats.peak_parent_bytes == 7 * 256 * 256
+        assert stats.elapsed > 0
+        assert stats_module.active() is None
+
+    def test_same_tiles(self):
+        a = os.path.join(self.base, 'a')
+        b = os.path.join(self.base, 'b')
+        toast(make_sampler(), 1, a)
+        toast(make_sampler(), 1, b, stats=BuildStats(), writers=2)
+        for pth in ['0/0/0_0.png', '1/1/1_0.png']:
+            np.testing.assert_array_equal(read_png(os.path.join(a, pth)),
+                                          read_png(os.path.join(b, pth)))
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_json_summary(self, workers):
+        pth = os.path.join(self.base, 'stats.json')
+        out = os.path.join(self.base, 'out')
+        toast(make_sampler(), 2, out, stats=pth, workers=workers)
+        with open(pth) as infile:
+            summary = json.load(infile)
+        assert summary['tiles'] == summary['total'] == 21
+        assert summary['stages']['sample']['calls'] == 16
+        assert summary['stages']['encode']['calls'] == 21
+        assert summary['tiles_per_second'] > 0
+
+    def test_progress(self):
+        calls = []
+        toast(make_sampler(), 2, os.path.join(self.base, 'out'),
+              progress=calls.append)
+        assert calls[-1]['tiles'] == 21
+        assert calls[-1]['eta'] == 0
+
+    def test_profile(self):
+        stats = BuildStats(profile=['merge'])
+        toast(make_sampler(), 1, os.path.join(self.base, 'out'),
+              stats=stats)
+        assert list(stats.profiles) == ['merge']
+        stats.dump_profiles(os.path.join(self.base, 'prof'))
+        assert os.listdir(os.path.join(self.base, 'prof')) == ['merge.prof']
@@ -0,0 +1,246 @@
+import os
+import sys
+from tempfile import mkdtemp
+from shutil import rmtree
+from threading import Thread
+try:
+    from SocketServer import TCPServer
+    from urllib2 import urlopen, HTTPError
+    from httplib import HTTPConnection
+except ImportError:  # python 3.X
+    from socketserver import TCPServer
+    from http.client import HTTPConnection
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+
+import numpy as np
+import pytest
+
+from .. import toast
+from ..storage import (DirectoryStore, MemoryStore, PackStore, open_store,
+                       get_store, parse_tile_path)
+from ..viewer import SimpleWWTHandler, TileServer
+from ..io import read_png
+from . import random_sampler
+
+try:
+    from io import BytesIO
+except ImportError:  # python 2.X
+    from cStringIO import StringIO as BytesIO
+
+
+def sampler():
+    return random_sampler()
+
+
+def all_tiles(base_dir):
+    result = {}
+    for root, dirs, files in os.walk(base_dir):
+        for f in files:
+            pth = os.path.join(root, f)
+            with open(pth, 'rb') as infile:
+                result[os.path.relpath(pth, base_dir)] = infile.read()
+    return result
+
+
+def assert_same_image(a, b):
+    # PIL splits the data of PNGs written to files and to
+    # buffers into different chunks, so compare pixels
+    np.testing.assert_array_equal(read_png(BytesIO(a)), read_png(BytesIO(b)))
+
+
+def test_parse_tile_path():
+    assert parse_tile_path('3/5/5_2.png') == (3, 2, 5)
+    assert parse_tile_path('base/3/5/5_2.jpg') == (3, 2, 5)
+    assert parse_tile_path('3/5/4_2.png') is None
+    assert parse_tile_path('toasty.wtml') is None
+
+
+class TestStores(object):
+
+    def setup_method(self, method):
+        self.base = mkdtemp()
+
+    def teardown_method(self, method):
+        rmtree(self.base)
+
+    @pytest.mark.parametrize('kind', ['directory', 'memory', 'pack'])
+    def test_round_trip(self, kind):
+        store = get_store(kind, self.base)
+        if kind == 'pack':
+            store.write_layout()
+        tiles = {'0/0/0_0.png': b'zero', '1/1/1_0.png': b'one',
+                 '2/3/3_2.png': b'two' * 100, '2/3/3_3.png': b'three'}
+        for pth, data in tiles.items():
+            store.put(pth, data)
+        store.close()
+
+        if kind != 'memory':
+            store = open_store(self.base)
+        for pth, data in tiles.items():
+            assert store.get(pth) == data
+            assert pth in store
+        assert store.get('1/0/0_0.png') is None
+        assert '2/0/0_0.png' not in store
+
+    def test_pack_layout(self):
+        store = PackStore(self.base, subtree_level=1, extension='.jpg',
+                          depth=3)
+        store.write_layout()
+        assert store.pack_name(0, 0, 0) == 'top.pack'
+        assert store.pack_name(1, 1, 0) == 'subtree_1_0_1.pack'
+        assert store.pack_name(3, 7, 2) == 'subtree_1_0_1.pack'
+        other = os.path.join(self.base, 'other')
+        assert PackStore(other).pack_name(2, 0, 0) == 'level_2.pack'
+
+        for pth in ['0/0/0_0.jpg', '2/1/1_2.jpg', '3/7/7_1.jpg']:
+            store.put(pth, pth.encode('ascii'))
+        store.close()
+        assert sorted(os.listdir(self.base)) == [
+            'subtree_1_0_1.pack', 'subtree_1_1_0.pack', 'toasty.packs',
+            'top.pack']
+
+        reader = open_store(self.base)
+        assert isinstance(reader, PackStore)
+        assert (reader.subtree_level, reader.extension,
+                reader.depth) == (1, '.jpg', 3)
+        pth, offset, length = reader.locate('2/1/1_2.jpg')
+        with open(pth, 'rb') as infile:
+            infile.seek(offset)
+            assert infile.read(length) == b'2/1/1_2.jpg'
+
+    def test_unfinished_pack(self):
+        store = PackStore(self.base)
+        store.put('0/0/0_0.png', b'data')
+        store._writing['level_0.pack'][0].flush()
+        with pytest.raises(IOError):
+            PackStore(self.base).get('0/0/0_0.png')
+        store.close()
+
+    def test_directory_locate(self):
+        store = DirectoryStore(self.base)
+        store.put('1/0/0_1.png', b'abc')
+        assert store.locate('1/0/0_1.png') == (
+            os.path.join(self.base, '1/0/0_1.png'), 0, 3)
+        assert store.locate('1/0/0_0.png') is None
+
+    def test_directory_stays_in_base(self):
+        store = DirectoryStore(os.path.join(self.base, 'pyr'))
+        with open(os.path.join(self.base, 'secret.png'), 'wb') as outfile:
+            outfile.write(b'secret')
+        assert store.get('../secret.png') is None
+        assert store.locate('../secret.png') is None
+        with pytest.raises(ValueError):
+            store.put('../1/0/0_0.png', b'')
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            get_store('zip', self.base)
+        with pytest.raises(ValueError):
+            PackStore(self.base).put('foo.png', b'')
+
+
+class TestToastStores(object):
+
+    def setup_method(self, method):
+        self.base = mkdtemp()
+        self.expected = os.path.join(self.base, 'expected')
+        toast(sampler(), 2, self.expected)
+
+    def teardown_method(self, method):
+        rmtree(self.base)
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_pack(self, workers):
+        out = os.path.join(self.base, 'packed')
+        toast(sampler(), 2, out, store='pack', workers=workers, writers=2)
+
+        names = os.listdir(out)
+        assert 'toasty.packs' in names
+        assert len(names) == (6 if workers > 1 else 4)
+
+        store = open_store(out)
+        expected = all_tiles(self.expected)
+        for pth, data in expected.items():
+            assert_same_image(store.get(pth), data)
+        store.close()
+
+    def test_memory(self):
+        store = MemoryStore()
+        toast(sampler(), 2, os.path.join(self.base, 'mem'), store=store)
+        expected = all_tiles(self.expected)
+        assert sorted(store.tiles) == sorted(expected)
+        for pth, data in expected.items():
+            assert_same_image(store.get(pth), data)
+        assert not os.path.exists(os.path.join(self.base, 'mem'))
+
+    def test_several_datasets(self):
+        out = os.path.join(self.base, 'multi')
+        toast(dict(a=sampler(), b=sampler()), 2, out, store='pack')
+        expected = all_tiles(self.expected)
+        for k in 'ab':
+            store = open_store(os.path.join(out, k))
+            for pth, data in expected.items():
+                assert_same_image(store.get(pth), data)
+
+    def test_invalid(self):
+        out = os.path.join(self.base, 'bad')
+        with pytest.raises(ValueError):
+            toast(sampler(), 2, out, store='memory', workers=2)
+        with pytest.raises(ValueError):
+            toast(sampler(), 2, out, store='pack', resume=True)
+        with pytest.raises(ValueError):
+            toast(sampler(), 2, out, store=PackStore(out), workers=2)
+
+
+class TestViewPack(object):
+
+    def setup_class(cls):
+        cls.base = mkdtemp()
+        cls.out = os.path.join(cls.base, 'packed')
+        toast(sampler(), 1, cls.out, store='pack')
+        sys.argv.append(cls.out)
+
+        cls.server = TCPServer(("", 0), SimpleWWTHandler, False)
+        cls.server.allow_reuse_address = True
+        cls.server.server_bind()
+        cls.server.server_activate()
+        cls.url = 'http://127.0.0.1:%i' % cls.server.server_address[1]
+        cls.thread = Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+
+    def teardown_class(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        sys.argv.remove(cls.out)
+        rmtree(cls.base)
+
+    def test_wtml(self):
+        data = urlopen(self.url + '/toasty.wtml').read()
+        assert 'TileLevels="1"' in str(data)
+
+    def test_tile(self):
+        resp = urlopen(self.url + self.out + '/1/1/1_0.png')
+        assert resp.info()['Content-type'] == 'image/png'
+        assert resp.read() == open_store(self.out).get('1/1/1_0.png')
+
+    def test_missing(self):
+        with pytest.raises(HTTPError) as exc:
+            urlopen(self.url + self.out + '/3/1/1_0.png')
+        assert exc.value.code == 404
+
+    def test_tile_server(self):
+        server = TileServer(self.out, ('127.0.0.1', 0), verbose=False)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            conn = HTTPConnection(*server.server_address[:2])
+            expected = open_store(self.out).get('1/0/0_1.png')
+            for i in range(3):  # streamed from the pack, then cached
+                conn.request('GET', server.prefix + '1/0/0_1.png')
+                assert conn.getresponse().read() == expected
+            assert server.cache.hits == 1
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
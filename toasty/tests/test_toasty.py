@@ -16,9 +16,12 @@ except ImportError:
     HAS_ASTRO = False
 
 from .. import tile
-from .. import iter_tiles, cartesian_sampler, gen_wtml, toast, healpix_sampler
+from ..tile import iter_corners, TileTable, _level1_tiles, _postfix_corner
+from .. import (iter_tiles, cartesian_sampler, gen_wtml, toast,
+                healpix_sampler, depth2tiles, normalizer)
 from ..io import read_png, save_png
-from .._libtoasty import mid
+from .._libtoasty import (mid, subsample, subsample_many, sample_cartesian,
+                          divide_tiles)
 
 
 def mock_sampler(x, y):
@@ -45,6 +48,110 @@ def test_mid():
     np.testing.assert_array_almost_equal(result, expected)
 
 
+@pytest.mark.parametrize('dtype', (np.float32, np.float64))
+def test_subsample_many(dtype):
+    tiles = list(iter_corners(2))
+    corners = [c for _, c, _ in tiles]
+    increasing = [inc for _, _, inc in tiles]
+    lon = np.zeros((len(tiles), 32, 32), dtype=dtype)
+    lat = np.zeros((len(tiles), 32, 32), dtype=dtype)
+
+    result = subsample_many(corners, increasing, lon, lat)
+    assert result[0] is lon and result[1] is lat
+
+    for i, (_, c, inc) in enumerate(tiles):
+        l, b = subsample(c[0], c[1], c[2], c[3], 32, inc)
+        np.testing.assert_array_equal(lon[i], l.astype(dtype))
+        np.testing.assert_array_equal(lat[i], b.astype(dtype))
+
+
+def recursive_corners(depth, bottom_only):
+    for t in _level1_tiles():
+        for item in _postfix_corner(t, depth, bottom_only):
+            yield item
+
+
+@pytest.mark.parametrize('bottom_only', (True, False))
+@pytest.mark.parametrize('depth', (0, 1, 3))
+def test_iter_corners_matches_recursion(depth, bottom_only):
+    expected = list(recursive_corners(depth, bottom_only))
+    actual = list(iter_corners(depth, bottom_only))
+    assert len(actual) == len(expected)
+    for (p1, c1, i1), (p2, c2, i2) in zip(actual, expected):
+        assert p1 == p2
+        assert i1 == i2
+        np.testing.assert_array_equal(c1, c2)
+
+
+@pytest.mark.parametrize('height', (1, 6))
+@pytest.mark.parametrize('bottom_only', (True, False))
+def test_iter_subtree_matches_recursion(height, bottom_only, monkeypatch):
+    # split subtrees taller than height
+    monkeypatch.setattr(tile, '_SUBTREE_HEIGHT', height)
+    for root in _level1_tiles() + [next(iter_corners(2))]:
+        expected = list(_postfix_corner(root, 4, bottom_only))
+        actual = list(tile._iter_subtree(root, 4, bottom_only))
+        assert len(actual) == len(expected)
+        for (p1, c1, i1), (p2, c2, i2) in zip(actual, expected):
+            assert p1 == p2
+            assert i1 == i2
+            np.testing.assert_array_equal(c1, c2)
+
+
+def test_tile_table():
+    table = TileTable()
+    for pos, c, inc in recursive_corners(3, False):
+        corners, increasing = table.corners(pos)
+        np.testing.assert_array_equal(corners, c)
+        assert increasing == inc
+        p, c2, inc2 = table.tile(pos)
+        assert (p, inc2) == (pos, inc)
+        np.testing.assert_array_equal(c2, c)
+
+    corners, increasing = table.level(2)
+    assert corners.shape == (16, 4, 2)
+    assert increasing.dtype == bool
+    with pytest.raises(ValueError):
+        table.level(0)
+
+
+def test_tile_corners():
+    table = TileTable()
+    for pos, c, inc in recursive_corners(4, False):
+        p, c2, inc2 = tile._tile_corners(tuple(pos))
+        assert (p, inc2) == (pos, inc)
+        np.testing.assert_array_equal(c2, table.corners(pos)[0])
+    with pytest.raises(ValueError):
+        tile._tile_corners((0, 0, 0))
+
+
+def test_tile_table_postfix():
+    n, x, y = TileTable().postfix(3, bottom_only=False)
+    expected = [p for p, _, _ in recursive_corners(3, False)]
+    assert list(zip(n, x, y)) == [tuple(p) for p in expected]
+
+    n, x, y = TileTable().postfix(3)
+    assert (n == 3).all()
+    assert len(set(zip(x, y))) == 64
+
+
+def test_divide_tiles_invalid():
+    with pytest.raises(ValueError):
+        divide_tiles(np.zeros((3, 4, 2)), np.zeros(3, dtype=bool))
+    with pytest.raises(ValueError):
+        divide_tiles(np.zeros((4, 4, 2)), np.zeros(3, dtype=bool))
+
+
+def test_subsample_many_invalid():
+    c = np.zeros((2, 4, 2))
+    with pytest.raises(ValueError):
+        subsample_many(c, [True])
+    with pytest.raises(ValueError):
+        subsample_many(c, [True, False], npix=12)
+    with pytest.raises(ValueError):
+        subsample_many(c, [True, False], lon=np.zeros((2, 4, 4)))
+
+
 def image_test(expected, actual, err_msg):
     resid = np.abs(1. * actual - expected)
     if np.median(resid) < 15:
@@ -80,6 +187,13 @@ def test_reference_wtml():
         assert ref.getAttribute(k) == val.getAttribute(k)
 
 
+def test_wtml_file_type():
+    wtml = parseString(gen_wtml('test', 3, FileType='.jpg'))
+    imageset = wtml.getElementsByTagName('ImageSet')[0]
+    assert imageset.getAttribute('FileType') == '.jpg'
+    assert imageset.getAttribute('Url') == 'test/{1}/{3}/{3}_{2}.jpg'
+
+
 def cwd():
     return os.path.split(os.path.abspath(__file__))[0]
 
@@ -99,6 +213,116 @@ def test_wwt_compare_sky():
 
 
 @pytest.mark.skipif('not HAS_ASTRO')
+def reference_cartesian(data, l, b):
+    """The original, numpy nearest neighbor cartesian sampler"""
+    ny, nx = data.shape[0:2]
+    l = (l + np.pi) % (2 * np.pi)
+    l[l < 0] += 2 * np.pi
+    l = nx * (1 - l / (2 * np.pi))
+    l = np.clip(l.astype(np.int64), 0, nx - 1)
+    b = ny * (1 - (b + np.pi / 2) / np.pi)
+    b = np.clip(b.astype(np.int64), 0, ny - 1)
+    return data[b, l]
+
+
+def random_lonlat(shape=(64, 64)):
+    rng = np.random.RandomState(0)
+    l = rng.uniform(-10, 10, shape)
+    b = rng.uniform(-1.7, 1.7, shape)
+    l[0, :4] = [-np.pi, np.pi, 0, 2 * np.pi]
+    b[1, :2] = [np.pi / 2, -np.pi / 2]
+    return l, b
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.int16, np.float32,
+                                   np.float64, '>f4', np.int8, '>i2',
+                                   np.uint32, np.float16])
+def test_cartesian_nearest(dtype):
+    data = np.random.RandomState(1).uniform(0, 100, (16, 32, 3))
+    data = data.astype(dtype)
+    l, b = random_lonlat()
+    result = cartesian_sampler(data)(l, b)
+    np.testing.assert_array_equal(result, reference_cartesian(data, l, b))
+    assert result.dtype == data.dtype.newbyteorder('=')
+    np.testing.assert_array_equal(cartesian_sampler(data[:, :, 0])(l, b),
+                                  reference_cartesian(data[:, :, 0], l, b))
+
+
+@pytest.mark.parametrize('interpolation', ['bilinear', 'bicubic'])
+def test_cartesian_interpolation(interpolation):
+    # constant maps stay constant
+    l, b = random_lonlat()
+    data = np.full((16, 32, 2), 7, dtype=np.uint8)
+    sampler = cartesian_sampler(data, interpolation=interpolation)
+    result = sampler(l, b)
+    assert result.dtype == np.uint8
+    assert (result == 7).all()
+
+    # linear gradients in latitude are reproduced away from the poles
+    ny = 64
+    rows = np.arange(ny) + 0.5
+    data = np.repeat(rows[:, np.newaxis], 2 * ny, axis=1)
+    sampler = cartesian_sampler(data, interpolation=interpolation)
+    b = np.linspace(-1.2, 1.2, 50)[np.newaxis, :]
+    l = np.zeros_like(b) + .3
+    expected = ny * (1 - (b + np.pi / 2) / np.pi)
+    np.testing.assert_allclose(sampler(l, b), expected, rtol=1e-10)
+
+    # the map wraps in longitude
+    cols = np.tile(np.arange(2 * ny) + 0.5, (ny, 1))
+    sampler = cartesian_sampler(cols, interpolation=interpolation)
+    np.testing.assert_allclose(sampler(np.array([[np.pi - 1e-9]]),
+                                       np.array([[0.]])),
+                               sampler(np.array([[-np.pi + 1e-9]]),
+                                       np.array([[0.]])), rtol=1e-6)
+
+
+@pytest.mark.parametrize('interpolation', ['bilinear', 'bicubic'])
+def test_cartesian_interpolation_nan(interpolation):
+    data = np.ones((16, 32))
+    data[8, 16] = np.nan
+    sampler = cartesian_sampler(data, interpolation=interpolation)
+    l, b = random_lonlat()
+    result = sampler(l, b)
+    assert np.isfinite(result).all()
+    np.testing.assert_allclose(result, 1)
+
+    data[:] = np.nan
+    assert np.isnan(cartesian_sampler(data, interpolation=interpolation)(
+        l, b)).all()
+
+
+def test_cartesian_interpolation_clip():
+    # bicubic overshoots next to a step, and is clipped to the dtype
+    data = np.zeros((16, 32), dtype=np.uint8)
+    data[:, 16:] = 255
+    sampler = cartesian_sampler(data, interpolation='bicubic')
+    l = np.linspace(-np.pi, np.pi, 500)[np.newaxis, :]
+    result = sampler(l, np.zeros_like(l))
+    assert result.min() == 0 and result.max() == 255
+    assert len(np.unique(result)) > 2
+
+
+def test_sample_cartesian_out():
+    data = np.arange(16 * 32, dtype=np.float32).reshape(16, 32)
+    l, b = random_lonlat((4, 4))
+    out = np.zeros((4, 4), dtype=np.float32)
+    assert sample_cartesian(data, l, b, out=out) is out
+    np.testing.assert_array_equal(out, reference_cartesian(data, l, b))
+    np.testing.assert_array_equal(
+        sample_cartesian(data, l, b, interpolation='bicubic', threads=2),
+        sample_cartesian(data, l, b, interpolation='bicubic'))
+
+    with pytest.raises(ValueError):
+        sample_cartesian(data, l, b, out=np.zeros((3, 3)))
+    with pytest.raises(ValueError):
+        sample_cartesian(data, l, b, interpolation='spline')
+    with pytest.raises(TypeError):
+        sample_cartesian(data.astype(np.int8), l, b)
+    with pytest.raises(ValueError):
+        cartesian_sampler(data, interpolation='spline')
+
+
 def test_healpix_sampler():
 
     direc = cwd()
@@ -155,6 +379,115 @@ def test_merge():
             assert im.max() != 0
 
 
+def test_iter_tiles_many():
+    im = read_png(os.path.join(cwd(), 'test.png'))
+    samplers = {'a': cartesian_sampler(im),
+                'b': cartesian_sampler(255 - im)}
+
+    def null_merge(mosaic):
+        return np.zeros((256, 256, 3), dtype=np.uint8)
+
+    merge = {'a': True, 'b': null_merge}
+    expected_a = list(iter_tiles(samplers['a'], 2))
+    expected_b = list(iter_tiles(samplers['b'], 2, null_merge))
+    actual = list(iter_tiles(samplers, 2, merge))
+
+    assert len(actual) == len(expected_a)
+    for (pth, tiles), (pa, ta), (pb, tb) in zip(actual, expected_a,
+                                                 expected_b):
+        assert pth == pa == pb
+        assert set(tiles) == set(['a', 'b'])
+        np.testing.assert_array_equal(tiles['a'], ta)
+        np.testing.assert_array_equal(tiles['b'], tb)
+
+
+def test_iter_tiles_many_mixed_merge():
+    samplers = {'a': mock_sampler, 'b': mock_sampler}
+    with pytest.raises(ValueError):
+        list(iter_tiles(samplers, 1, {'a': True, 'b': False}))
+
+
+def north_sampler(x, y):
+    """A uint8 image which is blank in the southern hemisphere"""
+    return (np.clip(y, 0, None) * 100).astype(np.uint8)
+
+
+def north_coverage(corners):
+    return max(c[1] for c in corners) > 0
+
+
+class TestSparse(object):
+
+    def test_blank_tiles_skipped(self):
+        dense = dict(iter_tiles(north_sampler, 2))
+        sparse = dict(iter_tiles(north_sampler, 2, sparse=True))
+
+        assert set(sparse) < set(dense)
+        for pth, im in dense.items():
+            if pth in sparse:
+                np.testing.assert_array_equal(sparse[pth], im)
+            else:
+                assert im.max() == 0
+
+    def test_coverage_prunes(self):
+        calls = []
+
+        def sampler(x, y):
+            calls.append(1)
+            return north_sampler(x, y)
+        sampler.coverage = north_coverage
+
+        dense = dict(iter_tiles(north_sampler, 3))
+        sparse = dict(iter_tiles(sampler, 3, sparse=True))
+
+        assert len(calls) < 4 ** 3
+        for pth, im in sparse.items():
+            np.testing.assert_array_equal(im, dense[pth])
+
+    @pytest.mark.parametrize('wrap', ['normalizer', 'frame'])
+    def test_wrapped_coverage_prunes(self, wrap):
+        calls = []
+
+        def sampler(x, y):
+            calls.append(1)
+            return north_sampler(x, y)
+        sampler.coverage = north_coverage
+        if wrap == 'normalizer':
+            wrapped = normalizer(sampler, 0, 100)
+        else:  # a galactic map whose data is all north of the plane
+            wrapped = tile.frame_sampler(sampler, 'G')
+
+        list(iter_tiles(wrapped, 3, sparse=True))
+        assert 0 < len(calls) < 4 ** 3
+
+    def test_coverage_ignored_if_not_sparse(self):
+        def sampler(x, y):
+            return north_sampler(x, y)
+        sampler.coverage = lambda corners: False
+
+        assert len(list(iter_tiles(sampler, 1))) == 5
+        assert len(list(iter_tiles(sampler, 1, sparse=True))) == 0
+
+    def test_float_tiles(self):
+        def sampler(x, y):
+            result = y.copy()
+            result[y < 0] = np.nan
+            return result
+
+        for pth, im in iter_tiles(sampler, 2, sparse=True):
+            assert np.isfinite(im).any()
+
+    def test_many(self):
+        samplers = {'north': north_sampler, 'mock': mock_sampler}
+        sparse = dict(iter_tiles(samplers, 2, sparse=True))
+        north = dict(iter_tiles(north_sampler, 2, sparse=True))
+
+        assert len(sparse) == depth2tiles(2)
+        for pth, tiles in sparse.items():
+            assert 'mock' in tiles
+            assert ('north' in tiles) == (pth in north)
+
+
 class TestToaster(object):
 
     def setup_method(self, method):
@@ -188,6 +521,176 @@ class TestToaster(object):
         toast(self.sampler, 1, self.base, merge=False)
         self.verify_toast()
 
+    def test_many(self):
+        inverted = cartesian_sampler(255 - read_png(os.path.join(self.cwd,
+                                                                 'test.png')))
+        samplers = {'a': self.sampler, 'b': inverted}
+        wtml = {'a': os.path.join(self.base, 'a.wtml'),
+                'b': os.path.join(self.base, 'b.wtml')}
+        toast(samplers, 1, self.base, wtml_file=wtml)
+
+        assert os.path.exists(wtml['a']) and os.path.exists(wtml['b'])
+        for n, x, y in [(0, 0, 0), (1, 0, 0), (1, 1, 1)]:
+            subpth = os.path.join(str(n), str(y), "%i_%i.png" % (y, x))
+            a = read_png(os.path.join(self.base, 'a', subpth))
+            b = read_png(os.path.join(self.base, 'b', subpth))
+            assert a.shape == b.shape
+            assert np.abs(255 - 1. * a - b).mean() < 2
+
+        with pytest.raises(ValueError):
+            toast(samplers, 1, self.base, wtml_file=wtml['a'])
+
+    def test_many_parallel(self):
+        samplers = {'a': self.sampler, 'b': self.sampler}
+        base_dir = {'a': os.path.join(self.base, 'a'),
+                    'b': os.path.join(self.base, 'b')}
+        toast(samplers, 2, base_dir, workers=2)
+        toast(self.sampler, 2, os.path.join(self.base, 'serial'))
+
+        for n, x, y in [(0, 0, 0), (1, 1, 0), (2, 3, 1)]:
+            subpth = os.path.join(str(n), str(y), "%i_%i.png" % (y, x))
+            expected = read_png(os.path.join(self.base, 'serial', subpth))
+            for k in base_dir:
+                actual = read_png(os.path.join(base_dir[k], subpth))
+                np.testing.assert_array_equal(actual, expected)
+
+    @pytest.mark.parametrize('workers', (1, 2))
+    def test_writers(self, workers):
+        serial = os.path.join(self.base, 'serial')
+        threaded = os.path.join(self.base, 'threaded')
+        toast(self.sampler, 2, serial)
+        toast(self.sampler, 2, threaded, writers=3, workers=workers)
+
+        for n, x, y in [(0, 0, 0), (1, 1, 0), (2, 3, 1), (2, 0, 2)]:
+            subpth = os.path.join(str(n), str(y), "%i_%i.png" % (y, x))
+            with open(os.path.join(serial, subpth), 'rb') as a:
+                with open(os.path.join(threaded, subpth), 'rb') as b:
+                    assert a.read() == b.read()
+
+    def test_encoder(self):
+        wtml = os.path.join(self.base, 'test.wtml')
+        toast(self.sampler, 1, self.base, wtml_file=wtml, encoder='jpeg')
+
+        assert os.path.exists(os.path.join(self.base, '1', '1', '1_0.jpg'))
+        assert not os.path.exists(os.path.join(self.base, '1', '1', '1_0.png'))
+        with open(wtml) as infile:
+            assert 'FileType=".jpg"' in infile.read()
+
+    @pytest.mark.parametrize('workers', (1, 2))
+    def test_sparse(self, workers):
+        wtml = os.path.join(self.base, 'test.wtml')
+        north_sampler.coverage = north_coverage
+        try:
+            toast(north_sampler, 2, self.base, wtml_file=wtml, sparse=True,
+                  workers=workers)
+        finally:
+            del north_sampler.coverage
+
+        expected = dict(iter_tiles(north_sampler, 2, sparse=True))
+        for n in range(3):
+            for y in range(2 ** n):
+                for x in range(2 ** n):
+                    subpth = os.path.join(str(n), str(y), '%i_%i.png' % (y, x))
+                    pth = os.path.join(self.base, subpth)
+                    assert os.path.exists(pth) == (subpth in expected)
+        # only the directories of written tiles are created
+        for direc, subdirs, files in os.walk(self.base):
+            assert subdirs or files
+
+        with open(wtml) as infile:
+            assert 'Sparse="True"' in infile.read()
+
+    def test_write_error(self):
+        def bad_sampler(x, y):
+            return np.zeros((256, 256, 2))  # not a valid image
+
+        with pytest.raises(Exception):
+            toast(bad_sampler, 1, self.base, writers=2)
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_resume(self, workers):
+        full = os.path.join(self.base, 'full')
+        toast(self.sampler, 2, full)
+
+        calls = []
+
+        def sampler(x, y):
+            calls.append(1)
+            return self.sampler(x, y)
+
+        # an interrupted build: the last subtree and the parents
+        # are missing, and the last record was cut off
+        resumed = os.path.join(self.base, 'resumed')
+        toast(sampler, 2, resumed, resume=True)
+        manifest = os.path.join(resumed, 'toasty.manifest')
+        with open(manifest, 'rb') as infile:
+            lines = infile.readlines()
+        keep = [l for l in lines if not (l.endswith(b' 1/1/1_0.png\n') or
+                                         l.endswith(b' 0/0/0_0.png\n'))]
+        for l in lines:
+            if l not in keep:
+                os.remove(os.path.join(resumed, l.split()[1].decode()))
+        keep = [l for l in keep if b' 2/3/' not in l]
+        with open(manifest, 'wb') as outfile:
+            outfile.writelines(keep)
+            outfile.write(lines[-1][:10])
+
+        del calls[:]
+        toast(sampler, 2, resumed, resume=True, workers=workers)
+        if workers == 1:
+            assert 0 < len(calls) < 16
+
+        for n in range(3):
+            for y in range(2 ** n):
+                for x in range(2 ** n):
+                    subpth = os.path.join(str(n), str(y), '%i_%i.png' % (y, x))
+                    with open(os.path.join(full, subpth), 'rb') as a:
+                        with open(os.path.join(resumed, subpth), 'rb') as b:
+                            assert a.read() == b.read()
+
+    @pytest.mark.parametrize(('workers', 'coverage'),
+                             [(1, False), (1, True), (2, True)])
+    def test_resume_sparse(self, workers, coverage):
+        def sampler(x, y):
+            return north_sampler(x, y)
+
+        def resampled(x, y):  # raises in worker processes too
+            raise AssertionError("A finished subtree was resampled")
+        if coverage:
+            sampler.coverage = resampled.coverage = north_coverage
+
+        # blank and skipped tiles are recorded, so that a finished
+        # sparse build counts as complete
+        toast(sampler, 3, self.base, sparse=True, resume=True,
+              workers=workers)
+        toast(resampled, 3, self.base, sparse=True, resume=True,
+              workers=workers)
+
+        expected = dict(iter_tiles(north_sampler, 3, sparse=True))
+        for n in range(4):
+            for y in range(2 ** n):
+                for x in range(2 ** n):
+                    subpth = os.path.join(str(n), str(y), '%i_%i.png' % (y, x))
+                    pth = os.path.join(self.base, subpth)
+                    assert os.path.exists(pth) == (subpth in expected)
+
+    @pytest.mark.parametrize(('merge', 'split_level'),
+                             [(True, 1), (True, 2), (False, 1), (False, 2)])
+    def test_parallel(self, merge, split_level):
+        serial = os.path.join(self.base, 'serial')
+        parallel = os.path.join(self.base, 'parallel')
+        toast(self.sampler, 2, serial, merge=merge)
+        toast(self.sampler, 2, parallel, merge=merge, workers=2,
+              split_level=split_level)
+
+        for n in range(3):
+            for y in range(2 ** n):
+                for x in range(2 ** n):
+                    subpth = os.path.join(str(n), str(y), '%i_%i.png' % (y, x))
+                    with open(os.path.join(serial, subpth), 'rb') as a:
+                        with open(os.path.join(parallel, subpth), 'rb') as b:
+                            assert a.read() == b.read()
+
 
 reference_wtml = """
 <Folder Name="ADS All Sky Survey">
@@ -2,14 +2,18 @@ from threading import Thread
 try:
     from SocketServer import TCPServer
     from urllib import urlopen
+    from httplib import HTTPConnection
 except ImportError:  # python 3.X
     from socketserver import TCPServer
     from urllib.request import urlopen
+    from http.client import HTTPConnection
 
 import sys
 import os
+import shutil
+from tempfile import mkdtemp
 
-from ..viewer import SimpleWWTHandler
+from ..viewer import SimpleWWTHandler, TileServer, HotTileCache
 
 
 def cwd():
@@ -40,3 +44,181 @@ class TestViewer(object):
     def test_root(self):
         data = urlopen('http://0.0.0.0:8000/').read()
         assert 'WWTCanvas' in str(data)
+
+
+class TestTileServer(object):
+
+    def setup_class(cls):
+        cls.base = os.path.join(cwd(), 'test_sky')
+        cls.server = TileServer(cls.base, ('127.0.0.1', 0), cache_mb=1,
+                                verbose=False)
+        cls.host, cls.port = cls.server.server_address[:2]
+        cls.thread = Thread(target=cls.server.serve_forever)
+        cls.thread.start()
+
+    def teardown_class(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def tile_url(self, pth='1/1/1_0.png'):
+        return self.server.prefix + pth
+
+    def test_wtml(self):
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('GET', '/toasty.wtml')
+        assert '<ImageSet' in str(conn.getresponse().read())
+
+    def test_keep_alive(self):
+        conn = HTTPConnection(self.host, self.port)
+        expected = open(os.path.join(self.base, '1/1/1_0.png'), 'rb').read()
+        for i in range(3):
+            conn.request('GET', self.tile_url())
+            resp = conn.getresponse()
+            assert resp.status == 200
+            assert resp.getheader('Content-type') == 'image/png'
+            assert resp.read() == expected
+        conn.close()
+
+    def test_not_modified(self):
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('GET', self.tile_url('1/0/0_1.png'))
+        resp = conn.getresponse()
+        resp.read()
+        etag = resp.getheader('ETag')
+        modified = resp.getheader('Last-Modified')
+        assert 'max-age' in resp.getheader('Cache-Control')
+
+        conn.request('GET', self.tile_url('1/0/0_1.png'),
+                     headers={'If-None-Match': etag})
+        resp = conn.getresponse()
+        assert resp.status == 304
+        assert resp.read() == b''
+
+        conn.request('GET', self.tile_url('1/0/0_1.png'),
+                     headers={'If-Modified-Since': modified})
+        resp = conn.getresponse()
+        assert resp.status == 304
+        resp.read()
+
+        conn.request('GET', self.tile_url('1/0/0_1.png'),
+                     headers={'If-None-Match': '"other"'})
+        resp = conn.getresponse()
+        assert resp.status == 200
+        resp.read()
+        conn.close()
+
+    def test_missing(self):
+        conn = HTTPConnection(self.host, self.port)
+        conn.request('GET', self.tile_url('5/0/0_0.png'))
+        resp = conn.getresponse()
+        assert resp.status == 404
+        resp.read()
+
+    def test_hot_tiles_cached(self):
+        cache = self.server.cache
+        url = self.tile_url('1/0/0_0.png')
+        conn = HTTPConnection(self.host, self.port)
+        bodies = []
+        for i in range(3):
+            conn.request('GET', url)
+            bodies.append(conn.getresponse().read())
+        assert bodies[0] == bodies[1] == bodies[2]
+        assert cache.hits >= 1
+        assert cache.nbytes >= len(bodies[0])
+
+    def test_concurrent(self):
+        results = []
+
+        def fetch(pth):
+            conn = HTTPConnection(self.host, self.port)
+            conn.request('GET', self.tile_url(pth))
+            resp = conn.getresponse()
+            resp.read()
+            results.append(resp.status)
+            conn.close()
+
+        paths = ['1/%i/%i_%i.png' % (y, y, x) for y in range(2)
+                 for x in range(2)] * 4
+        threads = [Thread(target=fetch, args=(p,)) for p in paths]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == [200] * len(paths)
+
+
+def test_hot_tile_cache():
+    cache = HotTileCache(cache_mb=10. / 2 ** 20)
+    assert not cache.hot('a')
+    assert cache.hot('a')
+    cache.put('a', b'12345')
+    cache.put('b', b'123456')
+    assert cache.get('a') is None
+    assert cache.get('b') == b'123456'
+    cache.put('c', b'x' * 11)
+    assert cache.get('c') is None
+    assert (cache.hits, cache.misses, cache.nbytes) == (1, 2, 6)
+
+
+def test_tile_server_stays_in_pyramid():
+    base = mkdtemp()
+    try:
+        pyramid = os.path.join(base, 'pyr')
+        shutil.copytree(os.path.join(cwd(), 'test_sky'), pyramid)
+        secret = os.path.join(base, 'secret', '1', '0')
+        os.makedirs(secret)
+        with open(os.path.join(secret, '0_0.png'), 'wb') as outfile:
+            outfile.write(b'secret')
+
+        server = TileServer(pyramid, ('127.0.0.1', 0), verbose=False)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            conn = HTTPConnection(*server.server_address[:2])
+            for pth in ['../secret/1/0/0_0.png',
+                        '1/../../secret/1/0/0_0.png',
+                        '%2e%2e/secret/1/0/0_0.png']:
+                conn.request('GET', server.prefix + pth)
+                resp = conn.getresponse()
+                assert resp.status == 404
+                assert b'secret' not in resp.read()
+            conn.request('GET', server.prefix + '1/0/0_0.png')
+            resp = conn.getresponse()
+            assert resp.status == 200
+            resp.read()
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(base)
+
+
+def test_hot_cache_same_size_tiles():
+    # tiles of the same size and mtime have the same ETag
+    base = mkdtemp()
+    try:
+        os.makedirs(os.path.join(base, '0', '0'))
+        os.makedirs(os.path.join(base, '1', '0'))
+        for x, content in enumerate([b'A' * 100, b'B' * 100]):
+            pth = os.path.join(base, '1', '0', '0_%i.png' % x)
+            with open(pth, 'wb') as outfile:
+                outfile.write(content)
+            os.utime(pth, (1000000000, 1000000000))
+
+        server = TileServer(base, ('127.0.0.1', 0), verbose=False)
+        thread = Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            conn = HTTPConnection(*server.server_address[:2])
+            for pth, content in [('0_0', b'A'), ('0_0', b'A'),
+                                 ('0_0', b'A'), ('0_1', b'B'),
+                                 ('0_1', b'B')]:
+                conn.request('GET', server.prefix + '1/0/%s.png' % pth)
+                assert conn.getresponse().read() == content * 100
+            conn.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+    finally:
+        shutil.rmtree(base)
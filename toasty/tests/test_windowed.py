@@ -0,0 +1,144 @@
+import os
+from threading import Thread
+from time import sleep
+from tempfile import mkdtemp
+from shutil import rmtree
+
+import numpy as np
+import pytest
+
+try:
+    from astropy.io import fits
+    HAS_ASTRO = True
+except ImportError:
+    HAS_ASTRO = False
+
+from .. import iter_tiles, cartesian_sampler
+from ..windowed import (windowed_sampler, open_raw, open_fits, BlockCache,
+                        _column_range)
+from . import random_image
+
+
+def assert_same_tiles(a, b, depth=2, merge=False):
+    for (p1, t1), (p2, t2) in zip(iter_tiles(a, depth, merge),
+                                  iter_tiles(b, depth, merge)):
+        assert p1 == p2
+        np.testing.assert_array_equal(t1, t2)
+
+
+class TestWindowedSampler(object):
+
+    def setup_method(self, method):
+        self.base = mkdtemp()
+
+    def teardown_method(self, method):
+        rmtree(self.base)
+
+    @pytest.mark.parametrize('interpolation',
+                             ['nearest', 'bilinear', 'bicubic'])
+    @pytest.mark.parametrize('dtype', [np.uint8, np.float32])
+    def test_matches_cartesian(self, interpolation, dtype):
+        data = random_image(dtype=dtype, nans=True)
+        pth = os.path.join(self.base, 'map.raw')
+        data.tofile(pth)
+        mapped = open_raw(pth, data.shape, data.dtype)
+
+        windowed = windowed_sampler(mapped, interpolation=interpolation,
+                                    block=16, cache_mb=.05)
+        plain = cartesian_sampler(data, interpolation=interpolation)
+        assert_same_tiles(windowed, plain)
+        assert windowed.cache.nbytes <= .05 * 2 ** 20
+        assert windowed.cache.hit_rate > 0
+
+    def test_coord(self):
+        data = random_image(dtype=np.uint8)
+        assert_same_tiles(windowed_sampler(data, coord='G', block=16),
+                          cartesian_sampler(data, coord='G'))
+
+    def test_max_window(self):
+        data = random_image((64, 128), dtype=np.int16)
+        windowed = windowed_sampler(data, interpolation='bilinear',
+                                    max_window=100)
+        assert_same_tiles(windowed, cartesian_sampler(data), depth=1)
+        assert windowed.cache.misses == 0
+
+    @pytest.mark.skipif('not HAS_ASTRO')
+    def test_fits(self):
+        data = random_image((64, 128), dtype=np.int16)
+        pth = os.path.join(self.base, 'map.fits')
+        hdu = fits.PrimaryHDU(data)
+        hdu.header['BSCALE'] = 2.
+        hdu.header['BZERO'] = 10.
+        hdu.writeto(pth)
+
+        image = open_fits(pth)
+        np.testing.assert_array_equal(image[:, :], data * 2. + 10)
+        assert_same_tiles(windowed_sampler(pth, block=32),
+                          cartesian_sampler(data * np.float32(2) + 10))
+
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            windowed_sampler(np.zeros((10, 10)))
+        with pytest.raises(ValueError):
+            windowed_sampler(np.zeros((10, 20)), interpolation='spline')
+
+
+def test_block_cache_window():
+    data = np.arange(8 * 16).reshape(8, 16)
+    cache = BlockCache(data, block=3, cache_mb=1)
+    np.testing.assert_array_equal(cache.window(2, 6, 4, 7), data[2:7, 4:11])
+    # wrapping around the right edge
+    np.testing.assert_array_equal(cache.window(0, 7, 14, 5),
+                                  np.hstack((data[:, 14:], data[:, :3])))
+    assert cache.hits == 0
+    cache.window(3, 4, 5, 2)
+    assert cache.hits > 0
+
+
+def test_block_cache_lru():
+    data = np.zeros((64, 64), dtype=np.uint8)
+    cache = BlockCache(data, block=8, cache_mb=3 * 64 / 2. ** 20)
+    for j in range(4):
+        cache.get(0, j)
+    assert list(cache._blocks) == [(0, 1), (0, 2), (0, 3)]
+    cache.get(0, 1)
+    cache.get(0, 0)
+    assert list(cache._blocks) == [(0, 3), (0, 1), (0, 0)]
+    assert cache.hits == 1 and cache.misses == 5
+
+
+class SlowImage(object):
+    """An array whose reads let other threads run"""
+
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+
+    def __getitem__(self, index):
+        sleep(0.001)
+        return self.data[index]
+
+
+def test_block_cache_threads():
+    data = np.arange(64 * 64, dtype=np.float64).reshape(64, 64)
+    cache = BlockCache(SlowImage(data), block=8, cache_mb=6 * 512 / 2. ** 20)
+
+    def run(seed):
+        rng = np.random.RandomState(seed)
+        for i, j in rng.randint(0, 8, (50, 2)):
+            np.testing.assert_array_equal(
+                cache.get(i, j), data[i * 8:(i + 1) * 8, j * 8:(j + 1) * 8])
+    threads = [Thread(target=run, args=(seed,)) for seed in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert cache.nbytes == sum(b.nbytes for b in cache._blocks.values())
+    assert cache.nbytes <= cache.limit
+
+
+def test_column_range():
+    assert _column_range(np.array([3, 4, 5]), 10) == (3, 3)
+    assert _column_range(np.array([0, 1, 9, 8]), 10) == (8, 4)
+    assert _column_range(np.array([-1, 0]), 10) == (9, 2)
@@ -4,12 +4,20 @@ Generate PNG tile directories
 from __future__ import print_function, division
 import os
 import logging
+import multiprocessing
 
 import numpy as np
 
-from ._libtoasty import subsample, mid
-from .io import save_png
-from .norm import normalize
+from ._libtoasty import subsample, mid, sample_cartesian, divide_tiles
+from .io import save_png, get_encoder, TileWriter
+from .manifest import Manifest
+from . import stats as _stats
+from .storage import get_store, DirectoryStore, PackStore
+from .merge import MergeKernel, get_merge
+from .frames import frame_sampler
+from .mipmap import cartesian_mipmap, healpix_mipmap
+from .windowed import _kernel_dtype, _kernel_dtypes
+from .norm import normalize, cscale
 from collections import defaultdict, namedtuple
 
 level1 = [[np.radians(c) for c in row]
@@ -23,7 +31,7 @@ Pos = namedtuple('Pos', 'n x y')
 Tile = namedtuple('Tile', 'pos increasing corners')
 
 
-def _postfix_corner(tile, depth, bottom_only):
+def _postfix_corner(tile, depth, bottom_only, prune=None):
     """
     Yield subtiles of a given tile, in postfix order
 
@@ -36,13 +44,20 @@ def _postfix_corner(tile, depth, bottom_only):
       Depth to descend to
     bottom_only : bool
       If True, only yield tiles at max_depth
+    prune : function (optional)
+      A function of tile. If it returns True, the tile
+      is yielded without descending into its subtiles
     """
     n = tile[0].n
     if n > depth:
         return
 
+    if prune is not None and prune(tile):
+        yield tile
+        return
+
     for child in _div4(*tile):
-        for item in _postfix_corner(child, depth, bottom_only):
+        for item in _postfix_corner(child, depth, bottom_only, prune):
             yield item
 
     if n == depth or not bottom_only:
@@ -80,7 +95,7 @@ def _parent(child):
     return (parent, left, top)
 
 
-def iter_corners(depth, bottom_only=True):
+def iter_corners(depth, bottom_only=True, prune=None):
     """
     Iterate over toast tiles and return the corners.
     Tiles are traversed in post-order (children before parent)
@@ -93,61 +108,473 @@ def iter_corners(depth, bottom_only=True):
     bottom_only : bool
       If True, then only the lowest tiles will be yielded
 
+    prune : function (optional)
+      A function of (pos, corner, increasing). Tiles for which this
+      returns True are yielded (even when bottom_only is True),
+      but their subtiles are skipped
+
     Yields
     ------
     pos, corner
     """
-    todo = [(Pos(n=1, x=0, y=0), level1[0], True),
+    if prune is not None:
+        for t in _level1_tiles():
+            for item in _postfix_corner(t, depth, bottom_only, prune):
+                yield item
+        return
+
+    table = TileTable()
+    n, x, y = table.postfix(depth, bottom_only)
+    for i in range(n.size):
+        yield table.tile(Pos(n=int(n[i]), x=int(x[i]), y=int(y[i])))
+
+
+def _postfix_offsets(height):
+    """
+    The (n, x, y) offsets of every tile in a subtree of the given
+    height, relative to its root, in postfix order
+    """
+    dn = dx = dy = np.zeros(1, dtype=np.int64)
+    for h in range(height):
+        parts = [(dn + 1, (q % 2 << dn) + dx, (q // 2 << dn) + dy)
+                 for q in range(4)]
+        parts.append((np.zeros(1, dtype=np.int64),) * 3)
+        dn, dx, dy = (np.concatenate(p) for p in zip(*parts))
+    return dn, dx, dy
+
+
+class TileTable(object):
+    """
+    The corners and increasing flags of every toast tile, stored
+    as arrays for each level, and built one level at a time
+
+    Level n holds a (4^n, 4, 2) array of the (lon, lat) of the
+    (ul, ur, lr, ll) corners of each tile, and a length 4^n bool
+    array of increasing flags, with tile (n, x, y) at index
+    y * 2^n + x. Corners are identical to those of iter_corners.
+
+    Levels are built from the level above them in compiled code (see
+    _libtoasty.divide_tiles), the first time they are needed. Level n
+    uses 72 * 4^n bytes
+    """
+
+    def __init__(self):
+        corners = np.zeros((4, 4, 2))
+        increasing = np.zeros(4, dtype=bool)
+        for pos, c, inc in _level1_tiles():
+            corners[pos.y * 2 + pos.x] = c
+            increasing[pos.y * 2 + pos.x] = inc
+        self._levels = {1: (corners, increasing)}
+
+    def level(self, n):
+        """Return the (corners, increasing) arrays of level n >= 1"""
+        if n < 1:
+            raise ValueError("Tile tables start at level 1")
+        if n not in self._levels:
+            self._levels[n] = divide_tiles(*self.level(n - 1))
+        return self._levels[n]
+
+    def corners(self, pos):
+        """
+        The (4, 2) corners and the increasing flag of tile pos = (n, x, y)
+        """
+        corners, increasing = self.level(pos[0])
+        i = pos[2] * 2 ** pos[0] + pos[1]
+        return corners[i], bool(increasing[i])
+
+    def tile(self, pos):
+        """The (Pos, corners, increasing) tuple of tile pos = (n, x, y)"""
+        corners, increasing = self.corners(pos)
+        return (Pos(*pos), tuple(tuple(c) for c in corners.tolist()),
+                increasing)
+
+    def postfix(self, depth, bottom_only=True):
+        """
+        The positions of the tiles down to depth, in the
+        postfix order of iter_corners
+
+        Returns
+        -------
+        n, x, y : integer arrays
+        """
+        if depth < 1:
+            return (np.zeros(0, dtype=np.int64),) * 3
+        dn, dx, dy = _postfix_offsets(max(depth - 1, 0))
+        if bottom_only:
+            keep = dn == depth - 1
+            dn, dx, dy = dn[keep], dx[keep], dy[keep]
+        roots = [t[0] for t in _level1_tiles()]
+        n = np.concatenate([dn + 1 for r in roots])
+        x = np.concatenate([(r.x << dn) + dx for r in roots])
+        y = np.concatenate([(r.y << dn) + dy for r in roots])
+        return n, x, y
+
+
+def _level1_tiles():
+    return [(Pos(n=1, x=0, y=0), level1[0], True),
             (Pos(n=1, x=1, y=0), level1[1], False),
             (Pos(n=1, x=1, y=1), level1[2], True),
             (Pos(n=1, x=0, y=1), level1[3], False)]
 
-    for t in todo:
-        for item in _postfix_corner(t, depth, bottom_only):
+
+def _tile_corners(pos):
+    """
+    The (Pos, corners, increasing) of a single tile pos = (n, x, y),
+    found by dividing its level 1 ancestor along the path to the tile.
+    Unlike TileTable, this needs no memory for the rest of the level
+    """
+    n, x, y = pos
+    if n < 1:
+        raise ValueError("Tile corners start at level 1")
+    x1, y1 = x >> (n - 1), y >> (n - 1)
+    tile = [t for t in _level1_tiles() if t[0][1:] == (x1, y1)][0]
+    for k in range(n - 2, -1, -1):
+        tile = _div4(*tile)[((y >> k) & 1) * 2 + ((x >> k) & 1)]
+    return tile
+
+
+# the height of the subtrees _iter_subtree builds corner arrays for.
+# Taller subtrees are split, so the arrays use at most 72 * 4^6 bytes
+_SUBTREE_HEIGHT = 6
+
+
+def _expand(pos, corners, increasing, height, bottom_only):
+    """
+    Yield the (Pos, corners, increasing) of the tiles in the subtree
+    of the given height below tile pos, in postfix order. Corners are
+    (4, 2) arrays, computed a level at a time with divide_tiles
+    """
+    levels = [(np.asarray(corners, dtype=float).reshape(1, 4, 2),
+               np.array([increasing]))]
+    for h in range(height):
+        levels.append(divide_tiles(*levels[-1]))
+
+    dn, dx, dy = _postfix_offsets(height)
+    if bottom_only:
+        keep = dn == height
+        dn, dx, dy = dn[keep], dx[keep], dy[keep]
+
+    n, x, y = pos
+    for k, i, j in zip(dn.tolist(), dx.tolist(), dy.tolist()):
+        c, inc = levels[k]
+        index = (j << k) + i
+        yield (Pos(n=n + k, x=(x << k) + i, y=(y << k) + j), c[index],
+               bool(inc[index]))
+
+
+def _iter_subtree(root, depth, bottom_only):
+    """
+    Yield the same tiles as _postfix_corner(root, depth, bottom_only),
+    without prune, but with corners from arrays instead of recursion
+    """
+    pos, corners, increasing = root
+    if pos.n > depth:
+        return
+    top = max(depth - _SUBTREE_HEIGHT, pos.n)
+    for node, c, inc in _expand(pos, corners, increasing, top - pos.n,
+                                False):
+        if node.n < top:
+            if not bottom_only:
+                yield node, c, inc
+            continue
+        for item in _expand(node, c, inc, depth - top, bottom_only):
             yield item
 
 
-def iter_tiles(data_sampler, depth, merge=True):
+def iter_tiles(data_sampler, depth, merge=True, geometry=None,
+               sparse=False, region=None, resume=None):
     """
     Create a hierarchy of toast tiles
 
     Parameters
     ----------
-    data_sampler : function
+    data_sampler : function or dict
        A function that takes two 2D numpy arrays of (lon, lat) as input,
        and returns an image of the original dataset sampled
-       at these locations
+       at these locations.
+
+       To build several datasets in a single traversal, pass a dict
+       of named samplers. Each tile's (lon, lat) grid is computed
+       once, and passed to every sampler
+
+       Samplers with a sample_tile(pos) method (e.g. a healpix_sampler
+       with an index cache) are called with each tile's (n, x, y)
+       position instead, and no (lon, lat) grid is computed for them
 
     depth : int
       The maximum depth to tile to. A depth of N creates
       4^N pngs at the deepest level
 
-    merge : bool or callable (default True)
+    merge : bool or callable, or dict (default True)
       How to treat lower resolution tiles.
       - If True, tiles above the lowest level (highest resolution)
         will be computed by averaging and downsampling the 4 subtiles.
       - If False, sampler will be called explicitly for all tiles
+      - If 'mean', 'nanmean', 'max' or 'nearest', tiles are merged
+        with a built-in kernel (see toasty.merge.MergeKernel).
+        True is the same as 'mean'
       - If a callable object, this object will be passed the
         4x oversampled image to downsample
 
+      When building several datasets, this can be a dict giving
+      the merge strategy for each dataset. Datasets must either all
+      merge, or all not merge.
+
+    geometry : GeometryCache (optional)
+      If provided, read the (lon, lat) coordinates of each tile
+      from this cache instead of computing them
+
+    sparse : bool (default False)
+      If True, skip empty regions of the sky:
+      - If data_sampler has a `coverage` attribute, it is called with
+        the (ul, ur, lr, ll) corners of a tile. If it returns False,
+        the dataset has no data within the tile, and the tile and
+        all of its subtiles are skipped.
+      - Tiles whose pixels are all zero or NaN are not yielded.
+      Missing tiles are treated as transparent when merging.
+
+    region : Region (optional)
+      If provided, only build tiles which overlap this region
+      of the sky (see toasty.region). Other tiles are skipped
+      without descending into their subtiles, and treated as
+      transparent when merging
+
+    resume : Manifest or dict (optional)
+      The manifest of a previous, interrupted build (or a dict of
+      manifests for each dataset). Subtrees which the manifest
+      records as complete are skipped, and their root tiles are read
+      from disk to build their parents
+
     Yields
     ------
-    (pth, tile) : str, ndarray
-      pth is the relative path where the tile image should be saved
+    (pth, tile) : str, ndarray or dict
+      pth is the relative path where the tile image should be saved.
+      If data_sampler is a dict, tile is a dict of the images
+      for each dataset
+    """
+    items = _iter_roots(data_sampler, _level1_tiles(), depth, merge,
+                        geometry, sparse, region, resume)
+    for item in _present(items):
+        yield item
+
+
+def _iter_roots(data_sampler, roots, depth, merge, geometry=None,
+                sparse=False, region=None, resume=None):
+    """
+    Build the subtrees below each of a list of root tiles, in postfix
+    order. Missing (sparse) tiles are yielded as None, and tiles
+    loaded from a previous build are not yielded
+    """
+    merge = _resolve_merge(merge, data_sampler)
+    parents = _new_parents(data_sampler)
+    covered = {}
+    resumed = {}
+    prune = None
+    if sparse or region is not None or resume is not None:
+        prune = _pruner(data_sampler, depth, covered, sparse, region,
+                        resume, resumed, _merging(merge))
+
+    for root in roots:
+        if prune is None:
+            tiles = _iter_subtree(root, max(depth, 1), _merging(merge))
+        else:
+            tiles = _postfix_corner(root, max(depth, 1), _merging(merge),
+                                    prune)
+        for node, c, increasing in tiles:
+            if node in resumed:
+                items = _trickle_up(resumed.pop(node), node, parents,
+                                    merge, depth)
+                if depth >= node.n:
+                    next(items)  # already saved by a previous build
+            else:
+                img = _sample(data_sampler, node, c, increasing, geometry,
+                              covered.pop(node, True), sparse)
+                items = _trickle_up(img, node, parents, merge, depth)
+
+            for item in items:
+                yield item
+
+
+def _sample(data_sampler, node, corners, increasing, geometry=None,
+            covered=True, sparse=False):
     """
-    if merge is True:
-        merge = _default_merge
+    Sample a dataset at the pixel locations of a tile.
+
+    Returns None for datasets which are not covered, or
+    for blank images if sparse is True
+    """
+    if isinstance(data_sampler, dict):
+        if not isinstance(covered, dict):
+            covered = dict((k, covered) for k in data_sampler)
+        if not any(covered.values()):
+            return dict((k, None) for k in data_sampler)
+    elif not covered:
+        return None
+
+    samplers = (data_sampler.values() if isinstance(data_sampler, dict)
+                else [data_sampler])
+    l = b = None
+    if not all(hasattr(s, 'sample_tile') for s in samplers):
+        with _stats.stage('geometry'):
+            if geometry is not None:
+                l, b = geometry.get(node)
+            else:
+                c = corners
+                l, b = subsample(c[0], c[1], c[2], c[3], 256, increasing)
+
+    def run(s):
+        with _stats.stage('sample'):
+            # samplers with a sample_tile method look up tiles directly
+            if hasattr(s, 'sample_tile'):
+                return s.sample_tile(node)
+            return s(l, b)
+
+    if isinstance(data_sampler, dict):
+        result = dict((k, run(s) if covered[k] else None)
+                      for k, s in data_sampler.items())
+        if sparse:
+            result = dict((k, None if im is None or _is_blank(im) else im)
+                          for k, im in result.items())
+        return result
+
+    result = run(data_sampler)
+    if sparse and _is_blank(result):
+        return None
+    return result
+
+
+def _coverage(data_sampler, tile, sparse=True, region=None):
+    """
+    Whether a dataset might have data within a tile, according to
+    the region being built and (if sparse) its sampler's optional
+    coverage function. Returns a dict of bools for several datasets
+    """
+    if isinstance(data_sampler, dict):
+        if region is not None and not region.coverage(tile[1]):
+            return dict((k, False) for k in data_sampler)
+        return dict((k, _coverage(s, tile, sparse))
+                    for k, s in data_sampler.items())
+
+    if region is not None and not region.coverage(tile[1]):
+        return False
+    test = getattr(data_sampler, 'coverage', None) if sparse else None
+    return True if test is None else bool(test(tile[1]))
+
+
+def _pruner(data_sampler, depth, covered, sparse=True, region=None,
+            resume=None, resumed=None, bottom_only=False):
+    """
+    Build a prune function for iter_corners, which skips tiles that
+    no dataset covers, and subtrees that were completed by a previous
+    build. The coverage of each tile that will be sampled is stored
+    in covered (if bottom_only, parents are merged and not sampled),
+    and the root tiles of completed subtrees in resumed
+    """
+    def prune(tile):
+        if resume is not None:
+            done, img = _resume(resume, tile[0], depth)
+            if done:
+                resumed[tile[0]] = img
+                return True
+            if not sparse and region is None:
+                return False
+
+        cov = _coverage(data_sampler, tile, sparse, region)
+        if resume is not None:
+            _skip(resume, tile[0], cov)
+        pruned = not (any(cov.values()) if isinstance(cov, dict) else cov)
+        if pruned or not bottom_only or tile[0].n >= depth:
+            covered[tile[0]] = cov
+        return pruned
+    return prune
+
+
+def _skip(resume, node, covered):
+    """
+    Record the subtree below node as empty in the manifest
+    of each dataset that doesn't cover it
+    """
+    if isinstance(resume, dict):
+        for k, manifest in resume.items():
+            _skip(manifest, node, covered[k])
+    elif not covered:
+        resume.skip(node)
+
+
+def _resume(resume, node, depth):
+    """
+    Whether the subtree below node was completed by a previous build,
+    and if so its root tile (which is None for empty subtrees).
+    Returns (done, tile)
+    """
+    if isinstance(resume, dict):
+        result = {}
+        for k, manifest in resume.items():
+            done, result[k] = _resume(manifest, node, depth)
+            if not done:
+                return False, None
+        return True, result
+
+    if not resume.complete(node, depth):
+        return False, None
+    img = resume.load(node)
+    if img is None and not resume.empty(node):
+        return False, None  # changed since it was recorded
+    return True, img
+
+
+def _is_blank(im):
+    """Whether every pixel in an image is zero or NaN"""
+    im = np.asarray(im)
+    if im.dtype.kind in 'fc':
+        return not np.any(im[~np.isnan(im)])
+    return not np.any(im)
+
+
+def _present(items):
+    """
+    Filter missing tiles from an iterable of (pth, tile)
+    """
+    for pth, im in items:
+        if isinstance(im, dict):
+            im = dict((k, v) for k, v in im.items() if v is not None)
+            if not im:
+                continue
+        elif im is None:
+            continue
+        yield pth, im
 
-    parents = defaultdict(dict)
 
-    for node, c, increasing in iter_corners(max(depth, 1),
-                                            bottom_only=merge):
+def _resolve_merge(merge, data_sampler):
+    """
+    Replace merge=True or a method name with a MergeKernel. When building
+    several datasets, return a dict with a merge strategy per dataset
+    """
+    if not isinstance(data_sampler, dict):
+        return get_merge(merge)
+
+    if not isinstance(merge, dict):
+        merge = dict((k, merge) for k in data_sampler)
+    merge = dict((k, merge.get(k, True)) for k in data_sampler)
+    merge = dict((k, get_merge(m)) for k, m in merge.items())
+
+    if len(set(bool(m) for m in merge.values())) > 1:
+        raise ValueError("Datasets must either all merge, or all not merge")
+    return merge
+
+
+def _merging(merge):
+    """Whether a (resolved) merge strategy merges lower resolution tiles"""
+    if isinstance(merge, dict):
+        return any(merge.values())
+    return bool(merge)
 
-        l, b = subsample(c[0], c[1], c[2], c[3], 256, increasing)
-        img = data_sampler(l, b)
 
-        for pth, img in _trickle_up(img, node, parents, merge, depth):
-            yield pth, img
+def _new_parents(data_sampler):
+    """The stack of incomplete parent tiles, for each dataset"""
+    if isinstance(data_sampler, dict):
+        return dict((k, defaultdict(dict)) for k in data_sampler)
+    return defaultdict(dict)
 
 
 def _trickle_up(im, node, parents, merge, depth):
@@ -155,6 +582,10 @@ def _trickle_up(im, node, parents, merge, depth):
     When a new toast tile is ready, propagate it up the hierarchy
     and recursively yield its completed parents
     """
+    if isinstance(im, dict):
+        for item in _trickle_up_many(im, node, parents, merge, depth):
+            yield item
+        return
 
     n, x, y = node.n, node.x, node.y
 
@@ -176,28 +607,73 @@ def _trickle_up(im, node, parents, merge, depth):
     parent, xc, yc = _parent(node)
     corners = parents[parent]
     corners[(xc, yc)] = im
+    _stats.buffered(_nbytes(im), 1)
 
     if len(corners) < 4:  # parent not yet ready
         return
 
     parents.pop(parent)
-    ul = corners[(0, 0)]
-    ur = corners[(1, 0)]
-    bl = corners[(0, 1)]
-    br = corners[(1, 1)]
-    mosaic = np.vstack((np.hstack((ul, ur)), np.hstack((bl, br))))
-    im = (merge or _default_merge)(mosaic)
+    _stats.buffered(-sum(_nbytes(c) for c in corners.values()), -4)
+    im = _merge_children(corners, merge)
 
     for item in _trickle_up(im, parent, parents, merge, depth):
         yield item
 
 
-def _default_merge(mosaic):
-    """The default merge strategy -- just average all 4 pixels"""
-    return (mosaic[::2, ::2] / 4. +
-            mosaic[1::2, ::2] / 4. +
-            mosaic[::2, 1::2] / 4. +
-            mosaic[1::2, 1::2] / 4.).astype(mosaic.dtype)
+def _nbytes(im):
+    """The size of a tile, or 0 for a missing tile"""
+    return 0 if im is None else im.nbytes
+
+
+def _merge_children(corners, merge):
+    """
+    Merge the four subtiles of a tile. Missing (None) subtiles are
+    treated as transparent, and the result is None if all are missing
+    """
+    with _stats.stage('merge'):
+        return _merge_tiles(corners, merge)
+
+
+def _merge_tiles(corners, merge):
+    tiles = [corners[(0, 0)], corners[(1, 0)],
+             corners[(0, 1)], corners[(1, 1)]]
+    present = [t for t in tiles if t is not None]
+    if not present:
+        return None
+    if len(present) < 4:
+        blank = _blank_like(present[0])
+        tiles = [blank if t is None else t for t in tiles]
+
+    ul, ur, bl, br = tiles
+    merge = merge or _mean_kernel  # level 0 is always merged
+    if isinstance(merge, MergeKernel):
+        return merge.merge(ul, ur, bl, br)
+    mosaic = np.vstack((np.hstack((ul, ur)), np.hstack((bl, br))))
+    return merge(mosaic)
+
+
+def _blank_like(im):
+    """A transparent tile: NaN for floating point tiles, zero otherwise"""
+    if im.dtype.kind in 'fc':
+        return np.full_like(im, np.nan)
+    return np.zeros_like(im)
+
+
+def _trickle_up_many(ims, node, parents, merge, depth):
+    """
+    Run _trickle_up for the tiles of several datasets at the same
+    position, and yield the completed parents of all datasets together
+    """
+    names = list(ims)
+    # run each generator to completion, so that every dataset's
+    # parent stack is updated
+    items = [list(_trickle_up(ims[k], node, parents[k], merge[k], depth))
+             for k in names]
+    for row in zip(*items):
+        yield row[0][0], dict((k, im) for k, (_, im) in zip(names, row))
+
+
+_mean_kernel = MergeKernel('mean')
 
 
 def gen_wtml(base_dir, depth, **kwargs):
@@ -220,6 +696,8 @@ def gen_wtml(base_dir, depth, **kwargs):
     Credits
     CreditsUrl
     ThumbnailUrl
+    FileType : The extension of tile files (default '.png')
+    Sparse : Whether some tiles are missing (default False)
 
     Returns
     -------
@@ -232,17 +710,20 @@ def gen_wtml(base_dir, depth, **kwargs):
     kwargs.setdefault('Credits', 'Toasty')
     kwargs.setdefault('CreditsUrl', 'http://github.com/ChrisBeaumont/toasty')
     kwargs.setdefault('ThumbnailUrl', '')
+    kwargs.setdefault('FileType', '.png')
+    kwargs.setdefault('Sparse', False)
     kwargs['url'] = base_dir
     kwargs['depth'] = depth
 
     template = ('<Folder Name="{FolderName}">\n'
                 '<ImageSet Generic="False" DataSetType="Sky" '
                 'BandPass="{BandPass}" Name="{Name}" '
-                'Url="{url}/{{1}}/{{3}}/{{3}}_{{2}}.png" BaseTileLevel="0" '
+                'Url="{url}/{{1}}/{{3}}/{{3}}_{{2}}{FileType}" '
+                'BaseTileLevel="0" '
                 'TileLevels="{depth}" BaseDegreesPerTile="180" '
-                'FileType=".png" BottomsUp="False" Projection="Toast" '
+                'FileType="{FileType}" BottomsUp="False" Projection="Toast" '
                 'QuadTreeMap="" CenterX="0" CenterY="0" OffsetX="0" '
-                'OffsetY="0" Rotation="0" Sparse="False" '
+                'OffsetY="0" Rotation="0" Sparse="{Sparse}" '
                 'ElevationModel="False">\n'
                 '<Credits> {Credits} </Credits>\n'
                 '<CreditsUrl>{CreditsUrl}</CreditsUrl>\n'
@@ -251,47 +732,453 @@ def gen_wtml(base_dir, depth, **kwargs):
     return template.format(**kwargs)
 
 
-def toast(data_sampler, depth, base_dir, wtml_file=None, merge=True):
+def toast(data_sampler, depth, base_dir, wtml_file=None, merge=True,
+          workers=1, split_level=1, geometry=None, writers=0,
+          encoder=None, sparse=False, region=None, resume=False,
+          breadth_first=False, level_dir=None, store=None, stats=None,
+          progress=None):
     """
     Build a directory of toast tiles
 
     Parameters
     ----------
-    data_sampler : func
+    data_sampler : func or dict
       A function of (lon, lat) that samples a dataset
-      at the input 2D coordinate arrays
+      at the input 2D coordinate arrays. To build several datasets
+      in one pass, use a dict of named samplers (see iter_tiles)
     depth : int
       The maximum depth to generate tiles for.
       4^n tiles are generated at each depth n
-    base_dir : str
-      The path to create the files at
-    wtml_file : str (optional)
+    base_dir : str or dict
+      The path to create the files at. When building several datasets,
+      either a dict giving the path for each dataset, or a single path
+      under which each dataset is written to a subdirectory named
+      after it
+    wtml_file : str or dict (optional)
       The path to write a WTML file to. If not present,
-      no file will be written
-    merge : bool or callable (default True)
+      no file will be written. When building several datasets,
+      this must be a dict of paths for each dataset
+    merge : bool or callable or dict (default True)
       How to treat lower resolution tiles.
       - If True, tiles above the lowest level (highest resolution)
       will be computed by averaging and downsampling the 4 subtiles.
       - If False, sampler will be called explicitly for all tiles
+      - If 'mean', 'nanmean', 'max' or 'nearest', tiles are merged
+        with a built-in kernel (see toasty.merge.MergeKernel).
+        True is the same as 'mean'
       - If a callable object, this object will be passed the
         4x oversampled image to downsample
+      When building several datasets, this can be a dict giving
+      the merge strategy of each dataset
+    workers : int (default 1)
+      The number of processes to build tiles with. If greater than 1,
+      the 4^split_level subtrees below split_level are built and saved
+      by a pool of forked worker processes, and the remaining tiles
+      are merged in this process. The output is identical to
+      a serial build
+    split_level : int (default 1)
+      The level at which to split the pyramid into subtrees,
+      when workers > 1
+    geometry : GeometryCache (optional)
+      A cache of tile coordinates to read from, instead of
+      computing coordinates for each tile. Missing levels
+      are added to the cache
+    writers : int (default 0)
+      The number of background threads to encode and write tiles with,
+      in each process. If 0, tiles are written as they are created.
+      Otherwise, tile creation only waits for writes when the queue
+      of unwritten tiles is full
+    encoder : TileEncoder or 'png' | 'jpeg' | 'webp' (optional)
+      How to encode tiles. Defaults to PNG files with PIL's default
+      settings. The WTML file refers to tiles of the chosen format
+    sparse : bool (default False)
+      If True, skip tiles outside the coverage of data_sampler,
+      and don't write blank tiles (see iter_tiles). The WTML file
+      marks the pyramid as sparse
+    region : Region (optional)
+      If provided, only build tiles which overlap this region of the
+      sky (see toasty.region). The WTML file marks the pyramid as sparse
+    resume : bool (default False)
+      If True, record each tile in a manifest file as it is written
+      (see toasty.manifest), and skip any subtrees which a previous
+      run with resume=True completed. The previous run must have
+      used the same encoder. Tiles which a sparse build leaves out
+      are not recorded, so their subtrees are rebuilt.
+      The roots of skipped subtrees are read back to build their
+      parents, so lossy formats may give slightly different parents
+      than an uninterrupted build
+    breadth_first : bool (default False)
+      If True, build the pyramid one level at a time (see
+      toasty.levels.iter_levels): sample the deepest level into a
+      memory mapped mosaic, and merge each level from the one below it
+      in large blocks, with workers threads. The tiles are identical.
+      Requires a single sampler that merges, and can't be combined
+      with sparse, region or resume
+    level_dir : str (optional)
+      Where to keep the level mosaics of a breadth first build.
+      Defaults to a temporary directory
+    store : TileStore or 'directory' | 'pack' | 'memory' (optional)
+      Where to keep the encoded tiles (see toasty.storage). By
+      default, each tile is written to its own file. 'pack' writes
+      a few large pack files under base_dir instead: one per level,
+      or for parallel builds, one per subtree below split_level.
+      When building several datasets, this can be a dict of stores.
+      Can't be combined with resume
+    stats : BuildStats or str (optional)
+      Measure the time spent in each stage of the build, and other
+      counters (see toasty.stats.BuildStats). If a path, a BuildStats
+      is created, and a JSON summary of it is written there when the
+      build finishes. The tiles written while measuring a build are
+      encoded in memory before being written, so PNG files may be
+      chunked differently than in other builds (with identical pixels)
+    progress : callable (optional)
+      A function called about once a second with a dict of the
+      tiles built so far, tiles/second and estimated seconds left
+      (see toasty.stats.BuildStats)
+
+    Returns
+    -------
+    The BuildStats of the build, if stats or progress is given
     """
-    if wtml_file is not None:
-        wtml = gen_wtml(base_dir, depth)
-        with open(wtml_file, 'w') as outfile:
-            outfile.write(wtml)
+    merge = _resolve_merge(merge, data_sampler)
+    merging = _merging(merge)
+    encoder = get_encoder(encoder)
+
+    if isinstance(data_sampler, dict):
+        if not isinstance(base_dir, dict):
+            base_dir = dict((k, os.path.join(base_dir, k))
+                            for k in data_sampler)
+        if wtml_file is not None and not isinstance(wtml_file, dict):
+            raise ValueError("wtml_file must be a dict when building "
+                             "several datasets")
+
+    wtml_opts = dict(FileType=encoder.extension,
+                     Sparse=sparse or region is not None)
+    if isinstance(wtml_file, dict):
+        for k, pth in wtml_file.items():
+            _write_wtml(pth, base_dir[k], depth, **wtml_opts)
+    elif wtml_file is not None:
+        _write_wtml(wtml_file, base_dir, depth, **wtml_opts)
+
+    # build any missing cache levels once, before workers are forked
+    samplers = (list(data_sampler.values()) if isinstance(data_sampler, dict)
+                else [data_sampler])
+    levels = [max(depth, 1)] if merging else range(1, depth + 1)
+    caches = [s.index for s in samplers
+              if hasattr(s, 'sample_tile') and hasattr(s, 'index')]
+    if geometry is not None:
+        caches.append(geometry)
+    for cache in caches:
+        for n in levels:
+            cache.level(n)
+    if workers > 1:
+        for s in samplers:
+            if hasattr(s, 'mipmap'):
+                s.mipmap.build()
+
+    parallel = workers > 1 and depth >= split_level >= 1 and not breadth_first
+    stores = None
+    if store is not None:
+        stores = _get_stores(store, base_dir, encoder, depth,
+                             split_level if parallel else None)
+        _check_stores(stores, parallel, split_level, resume)
+
+    manifest = None
+    save = encoder.save
+    if stores is not None:
+        save = _store_saver(stores, encoder)
+    if resume:
+        if isinstance(base_dir, dict):
+            manifest = dict((k, Manifest(d, encoder))
+                            for k, d in base_dir.items())
+        else:
+            manifest = Manifest(base_dir, encoder)
+        save = _manifest_saver(manifest)
+
+    summary_file = None
+    if isinstance(stats, str):
+        summary_file, stats = stats, _stats.BuildStats()
+    if progress is not None:
+        stats = stats or _stats.BuildStats()
+        stats.progress = progress
+    if stats is not None and save == encoder.save:
+        save = _file_saver(encoder)
+    if stores is None:
+        save = _dir_saver(save)
+
+    if breadth_first:
+        from .levels import iter_levels
+        if sparse or region is not None or resume:
+            raise ValueError("Breadth first builds can't be sparse, "
+                             "restricted to a region, or resumed")
+        tiles = iter_levels(data_sampler, depth, merge, level_dir,
+                            geometry, threads=workers)
+    elif parallel:
+        tiles = _toast_parallel(data_sampler, depth, base_dir, merge,
+                                workers, split_level, geometry=geometry,
+                                writers=writers, encoder=encoder,
+                                sparse=sparse, region=region,
+                                resume=manifest, stores=stores)
+    else:
+        tiles = _iter_roots(data_sampler, _level1_tiles(), depth, merge,
+                            geometry, sparse, region, manifest)
+        if manifest is None:  # resumed builds record missing tiles too
+            tiles = _present(tiles)
 
     num = 0
-    for pth, tile in iter_tiles(data_sampler, depth, merge):
-        num += 1
-        if num % 10 == 0:
-            logging.getLogger(__name__).info("Finished %i of %i tiles" %
-                                             (num, depth2tiles(depth)))
-        pth = os.path.join(base_dir, pth)
-        direc, _ = os.path.split(pth)
-        if not os.path.exists(direc):
-            os.makedirs(direc)
-        save_png(pth, tile)
+    with _stats.activate(stats, depth2tiles(depth)):
+        with TileWriter(writers, save=save) as writer:
+            for pth, tile in tiles:
+                num += 1
+                if num % 10 == 0:
+                    logging.getLogger(__name__).info(
+                        "Finished %i of %i tiles" % (num, depth2tiles(depth)))
+                _save_tile(base_dir, pth, tile, writer.put,
+                           encoder.extension, manifest is not None)
+                if stats is not None:
+                    stats.add_tiles(1)
+
+        for s in (stores or {}).values():
+            s.close()
+
+    if summary_file is not None:
+        stats.write_json(summary_file)
+    return stats
+
+
+def _write_wtml(pth, base_dir, depth, **kwargs):
+    wtml = gen_wtml(base_dir, depth, **kwargs)
+    with open(pth, 'w') as outfile:
+        outfile.write(wtml)
+
+
+def _dir_saver(save):
+    """
+    Build a save function which creates the n/y/ directory of each
+    tile as it is saved, so that sparse builds only create
+    the directories of the tiles they write
+    """
+    def save_in_dir(pth, array):
+        direc = os.path.dirname(pth)
+        if array is not None and not os.path.isdir(direc):
+            try:
+                os.makedirs(direc)
+            except OSError:  # made by another thread
+                if not os.path.isdir(direc):
+                    raise
+        return save(pth, array)
+
+    return save_in_dir
+
+
+def _save_tile(base_dir, pth, tile, save=save_png, ext='.png',
+               missing=False):
+    """
+    Save a tile, or each tile of a dict. Missing (None) tiles are
+    skipped, or passed to save if missing is True (to record them
+    in a manifest)
+    """
+    if tile is None and not missing:  # a missing tile in a sparse pyramid
+        return
+
+    if isinstance(tile, dict):
+        for k, im in tile.items():
+            _save_tile(base_dir[k], pth, im, save, ext, missing)
+        return
+
+    if ext != '.png':
+        pth = os.path.splitext(pth)[0] + ext
+    save(os.path.join(base_dir, pth), tile)
+
+
+def _file_saver(encoder):
+    """
+    Build a save function which encodes tiles and writes them to
+    files as separately timed stages (see toasty.stats)
+    """
+    def save(pth, array):
+        with _stats.stage('encode'):
+            data = encoder.encode(array)
+        with _stats.stage('write'):
+            with open(pth, 'wb') as outfile:
+                outfile.write(data)
+
+    return save
+
+
+def _manifest_saver(manifest):
+    """
+    Build a save function which records tiles in a manifest,
+    or in the manifest of the base directory each tile is saved under
+    """
+    if not isinstance(manifest, dict):
+        return manifest.save
+
+    manifests = list(manifest.values())
+
+    def save(pth, array):
+        for m in manifests:
+            if pth.startswith(os.path.join(m.base_dir, '')):
+                return m.save(pth, array)
+        raise ValueError("No manifest for tile %s" % pth)
+
+    return save
+
+
+def _get_stores(store, base_dir, encoder, depth, subtree_level):
+    """
+    Resolve the store argument of toast to a dict mapping
+    each base directory to its TileStore
+    """
+    if isinstance(base_dir, dict):
+        if not isinstance(store, dict):
+            store = dict((k, store) for k in base_dir)
+        return dict((d, get_store(store[k], d, encoder.extension, depth,
+                                  subtree_level))
+                    for k, d in base_dir.items())
+    return {base_dir: get_store(store, base_dir, encoder.extension, depth,
+                                subtree_level)}
+
+
+def _check_stores(stores, parallel, split_level, resume):
+    if resume and any(not isinstance(s, DirectoryStore)
+                      for s in stores.values()):
+        raise ValueError("Only directory stores can be resumed")
+    for s in stores.values():
+        if isinstance(s, PackStore):
+            if parallel and s.subtree_level != split_level:
+                raise ValueError("Parallel builds must pack tiles by subtree, "
+                                 "with subtree_level=split_level")
+            s.write_layout()
+        elif parallel and not s.multiprocess:
+            raise ValueError("%s can't be used by parallel builds" %
+                             type(s).__name__)
+
+
+def _store_saver(stores, encoder):
+    """
+    Build a save function which encodes tiles, and puts them in
+    the store of the base directory each tile is saved under
+    """
+    stores = list(stores.items())
+
+    def save(pth, array):
+        for base_dir, s in stores:
+            if pth.startswith(os.path.join(base_dir, '')):
+                with _stats.stage('encode'):
+                    data = encoder.encode(array)
+                with _stats.stage('write'):
+                    return s.put(os.path.relpath(pth, base_dir), data)
+        raise ValueError("No store for tile %s" % pth)
+
+    return save
+
+
+# state shared with forked worker processes. Samplers are usually
+# closures, which cannot be pickled and sent to a worker explicitly
+_subtree_state = {}
+
+
+def _build_subtree(index):
+    """
+    Build and save the index'th subtree of a parallel toast() run,
+    and return the image of its root tile, along with the counters
+    of the worker's BuildStats (or None, if the build isn't measured)
+    """
+    state = _subtree_state
+    encoder = state['encoder']
+    resume = state['resume']
+    root = state['roots'][index]
+
+    # measure the subtree from scratch, rather than adding to
+    # the copy of the parent's BuildStats inherited by the fork
+    stats = None
+    if _stats.active() is not None:
+        stats = _stats.BuildStats()
+
+    stores = state['stores']
+    save = encoder.save
+    if stores is not None:
+        save = _store_saver(stores, encoder)
+    elif stats is not None:
+        save = _file_saver(encoder)
+    if resume is not None:
+        done, img = _resume(resume, root[0], state['depth'])
+        if done:
+            return img, None if stats is None else stats.state()
+        save = _manifest_saver(resume)
+    if stores is None:
+        save = _dir_saver(save)
+
+    img = None
+    with _stats.activate(stats):
+        with TileWriter(state['writers'], save=save) as writer:
+            for pth, img in _iter_roots(state['data_sampler'], [root],
+                                        state['depth'], state['merge'],
+                                        state['geometry'], state['sparse'],
+                                        state['region'], resume):
+                _save_tile(state['base_dir'], pth, img, writer.put,
+                           encoder.extension, resume is not None)
+                if stats is not None:
+                    stats.tiles += 1
+    # finish the packs this worker wrote
+    for s in (stores or {}).values():
+        s.close()
+    return img, None if stats is None else stats.state()
+
+
+def _toast_parallel(data_sampler, depth, base_dir, merge, workers,
+                    split_level, geometry=None, writers=0, encoder=None,
+                    sparse=False, region=None, resume=None, stores=None):
+    """
+    Build each subtree rooted at split_level in a pool of worker
+    processes, and yield the tiles above split_level as they complete.
+
+    The tiles written by the workers are not yielded
+    """
+    merge = _resolve_merge(merge, data_sampler)
+    roots = list(iter_corners(split_level))
+    _subtree_state.update(data_sampler=data_sampler, roots=roots,
+                          depth=depth, base_dir=base_dir, merge=merge,
+                          geometry=geometry, writers=writers,
+                          encoder=get_encoder(encoder), sparse=sparse,
+                          region=region, resume=resume, stores=stores)
+
+    # fork, so that workers inherit _subtree_state
+    if hasattr(multiprocessing, 'get_context'):
+        pool = multiprocessing.get_context('fork').Pool(workers)
+    else:
+        pool = multiprocessing.Pool(workers)
+
+    try:
+        results = pool.imap(_build_subtree, range(len(roots)))
+        parents = _new_parents(data_sampler)
+
+        for node, c, increasing in iter_corners(split_level,
+                                                bottom_only=_merging(merge)):
+            if node.n == split_level:
+                img, worker_stats = next(results)
+                if worker_stats is not None:
+                    _stats.active().merge(worker_stats)
+                items = _trickle_up(img, node, parents, merge, depth)
+                next(items)  # the root of a subtree is saved by its worker
+            else:
+                tile = (node, c, increasing)
+                covered = _coverage(data_sampler, tile, sparse, region)
+                img = _sample(data_sampler, node, c, increasing, geometry,
+                              covered, sparse)
+                items = _trickle_up(img, node, parents, merge, depth)
+
+            if resume is None:  # resumed builds record missing tiles too
+                items = _present(items)
+            for item in items:
+                yield item
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _subtree_state.clear()
 
 
 def depth2tiles(depth):
@@ -330,7 +1217,23 @@ def _guess_healpix(pth, extension=None):
     return data, nest, coord
 
 
-def healpix_sampler(data, nest=False, coord='C', interpolation='nearest'):
+def _pixel_scale(l, b):
+    """
+    Estimate the angular spacing of a grid of (lon, lat), from
+    the distance between neighboring pixels along its middle row
+    """
+    l, b = np.asarray(l), np.asarray(b)
+    if l.ndim != 2 or l.shape[1] < 2:
+        return 0.
+    i = l.shape[0] // 2
+    l0, l1, b0, b1 = l[i, :-1], l[i, 1:], b[i, :-1], b[i, 1:]
+    c = (np.sin(b0) * np.sin(b1) +
+         np.cos(b0) * np.cos(b1) * np.cos(l1 - l0))
+    return np.median(np.arccos(np.clip(c, -1, 1)))
+
+
+def healpix_sampler(data, nest=False, coord='C', interpolation='nearest',
+                    index=None, mipmap=False):
     """
     Build a sampler for Healpix images
 
@@ -340,52 +1243,86 @@ def healpix_sampler(data, nest=False, coord='C', interpolation='nearest'):
       The healpix data
     nest : bool (default: False)
       Whether the data is ordered in the nested healpix style
-    coord : 'C' | 'G'
-      Whether the image is in Celestial (C) or Galactic (G) coordinates
+    coord : 'C' | 'G' | 'E'
+      Whether the image is in Celestial (C), Galactic (G), or
+      Ecliptic (E) coordinates
     interpolation : 'nearest' | 'bilinear'
       What interpolation scheme to use.
 
       WARNING: bilinear uses healpy's get_interp_val,
                which seems prone to segfaults
+    index : str or HealpixIndexCache (optional)
+      A cache of the healpix pixel under each toast pixel, or the
+      directory to keep one in. Sampling a tile then reduces to
+      a single lookup. The cache only depends on the map's nside,
+      nest, and coord, so can be shared by many maps. Requires
+      nearest interpolation
+    mipmap : bool (default False)
+      If True, sample grids which are coarser than the map from a
+      lazily built pyramid of averaged, lower nside copies of it (see
+      toasty.mipmap). Shallow tiles of pyramids built with merge=False
+      are then anti-aliased. Can't be combined with index
 
     Returns
     -------
     A function which samples the healpix image, given arrays
-    of (lon, lat)
+    of (lon, lat). If index is provided, the function also has a
+    sample_tile(pos) method, which samples tile pos = (n, x, y).
+    If mipmap is True, its mipmap attribute is the Mipmap
     """
     from healpy import ang2pix, get_interp_val, npix2nside
-    from astropy.coordinates import Galactic, FK5
-    import astropy.units as u
 
     interp_opts = ['nearest', 'bilinear']
     if interpolation not in interp_opts:
         raise ValueError("Invalid interpolation %s. Must be one of %s" %
                          (interpolation, interp_opts))
-    if coord.upper() not in 'CG':
-        raise ValueError("Invalid coord %s. Must be 'C' or 'G'" % coord)
 
-    galactic = coord.upper() == 'G'
+    if mipmap and index is not None:
+        raise ValueError("Index caches can't be combined with mipmap")
+
     interp = interpolation == 'bilinear'
     nside = npix2nside(data.size)
+    pyramid = healpix_mipmap(data, nest) if mipmap else None
 
     def vec2pix(l, b):
-        if galactic:
-            f = FK5(l, b, unit=(u.rad, u.rad))
-            g = f.transform_to(Galactic)
-            l, b = g.l.rad, g.b.rad
-
         theta = np.pi / 2 - b
         phi = l
 
-        if interp:
-            return get_interp_val(data, theta, phi, nest=nest)
-
-        return data[ang2pix(nside, theta, phi, nest=nest)]
+        m, s, n = data, nside, nest
+        if pyramid is not None:
+            j = pyramid.choose(_pixel_scale(l, b))
+            if j > 0:
+                m, s, n = pyramid.level(j), nside >> j, True
 
-    return vec2pix
+        if interp:
+            return get_interp_val(m, theta, phi, nest=n)
+
+        return m[ang2pix(s, theta, phi, nest=n)]
+
+    result = frame_sampler(vec2pix, coord)
+    if pyramid is not None:
+        result.mipmap = pyramid
+    if index is None:
+        return result
+
+    from .cache import HealpixIndexCache
+    if interp:
+        raise ValueError("Index caches require nearest interpolation")
+    if not isinstance(index, HealpixIndexCache):
+        index = HealpixIndexCache(index, nside, nest, coord)
+    if (index.nside, index.nest, index.coord) != (nside, bool(nest),
+                                                  coord.upper()):
+        raise ValueError("Index cache for nside=%i, nest=%s, coord=%s "
+                         "does not match the map" %
+                         (index.nside, index.nest, index.coord))
+
+    result.index = index
+    result.sample_tile = lambda pos: data[index.get(pos)]
+    return result
 
 
-def cartesian_sampler(data):
+def cartesian_sampler(data, coord='C', interpolation='nearest', threads=1,
+                      mipmap=False):
     """Return a sampler function for a dataset in the cartesian projection
 
     The image is assumed to be oriented with longitude increasing to the left,
@@ -394,7 +1331,27 @@ def cartesian_sampler(data):
     Parameters
     ----------
     data : array-like
-      The map to sample
+      The map to sample. May have several channels along a third axis,
+      and NaNs for missing data
+    coord : 'C' | 'G' | 'E' (default 'C')
+      Whether the map is in Celestial (C), Galactic (G), or
+      Ecliptic (E) coordinates
+    interpolation : 'nearest' | 'bilinear' | 'bicubic'
+      What interpolation scheme to use (see
+      _libtoasty.sample_cartesian). Interpolated
+      integer maps are rounded
+    threads : int (default 1)
+      The number of threads to sample each tile with
+    mipmap : bool (default False)
+      If True, sample grids which are coarser than the map from a
+      lazily built pyramid of 2x2 averaged copies of it (see
+      toasty.mipmap). Shallow tiles of pyramids built with merge=False
+      are then anti-aliased, and only read the small copies
+
+    Returns
+    -------
+    A function of (lon, lat). If mipmap is True, its
+    mipmap attribute is the Mipmap
     """
     data = np.asarray(data)
     ny, nx = data.shape[0:2]
@@ -402,20 +1359,39 @@ def cartesian_sampler(data):
     if ny * 2 != nx:
         raise ValueError("Map must be twice as wide as it is tall")
 
-    def vec2pix(l, b):
-        l = (l + np.pi) % (2 * np.pi)
-        l[l < 0] += 2 * np.pi
-        l = nx * (1 - l / (2 * np.pi))
-        l = np.clip(l.astype(np.int), 0, nx - 1)
-        b = ny * (1 - (b + np.pi / 2) / np.pi)
-        b = np.clip(b.astype(np.int), 0, ny - 1)
-        return data[b, l]
+    interp_opts = ['nearest', 'bilinear', 'bicubic']
+    if interpolation not in interp_opts:
+        raise ValueError("Invalid interpolation %s. Must be one of %s" %
+                         (interpolation, interp_opts))
 
-    return vec2pix
+    # sample_cartesian needs native byte order, and one of a few dtypes.
+    # Nearest neighbor samples are converted back to the map's dtype
+    if interpolation != 'nearest' and data.dtype.name not in _kernel_dtypes:
+        data = data.astype(np.float64)
+    dtype = data.dtype.newbyteorder('=')
+    data = np.asarray(data, dtype=_kernel_dtype(dtype))
+
+    pyramid = cartesian_mipmap(data) if mipmap else None
+
+    def vec2pix(l, b):
+        m = data
+        if pyramid is not None:
+            m = pyramid.level(pyramid.choose(_pixel_scale(l, b)))
+
+        result = sample_cartesian(m, l, b, interpolation=interpolation,
+                                  threads=threads)
+        if result.dtype != dtype:
+            result = result.astype(dtype)
+        return result
+
+    result = frame_sampler(vec2pix, coord)
+    if pyramid is not None:
+        result.mipmap = pyramid
+    return result
 
 
 def normalizer(sampler, vmin, vmax, scaling='linear',
-               bias=0.5, contrast=1):
+               bias=0.5, contrast=1, percentiles=(0.5, 99.5), sample=None):
     """
     Apply an intensity scaling to a sampler function
 
@@ -424,25 +1400,89 @@ def normalizer(sampler, vmin, vmax, scaling='linear',
     sampler : function
        A function of (lon, lat) that samples a dataset
 
-    vmin : float
-      The data value to assign to black
-    vmin : float
-      The data value to assign to white
+    vmin : float or 'auto'
+      The data value to assign to black. If 'auto', estimate
+      it from the lower of percentiles
+    vmin : float or 'auto'
+      The data value to assign to white. If 'auto', estimate
+      it from the upper of percentiles
     bias : float between 0-1. Default=0.5
       Where to assign middle-grey, relative to (vmin, vmax).
     contrast : float, default=1
       How quickly to ramp from black to white. The default of 1
       ramps over a data range of (vmax - vmin)
-    scaling : 'linear' | 'log' | 'arcsinh' | 'sqrt' | 'power'
-      The type of intensity scaling to apply
+    scaling : 'linear' | 'log' | 'arcsinh' | 'sqrt' | 'power' | 'histeq'
+      The type of intensity scaling to apply. 'histeq' equalizes
+      the histogram of the sampled data between vmin and vmax
+    percentiles : (lo, hi) (default (0.5, 99.5))
+      The percentiles of the data to use for 'auto' limits
+    sample : None, 'toast', 'random', array, or QuantileSketch
+      The data to estimate 'auto' limits and histogram equalization
+      from. By default, the sampler is evaluated on a low resolution
+      toast pyramid. See toasty.limits.get_sketch
 
     Returns
     -------
     A function of (lon, lat) that samples an image,
-    scales the intensity, and returns an array of dtype=np.uint8
+    scales the intensity, and returns an array of dtype=np.uint8.
+    Integer samples of at most 16 bits are scaled with a cached
+    lookup table (see norm.normalize)
+    """
+    sketch = None
+    if 'auto' in (vmin, vmax) or scaling == 'histeq':
+        from .limits import get_sketch
+        sketch = get_sketch(sampler, sample)
+        lo, hi = sketch.limits(*percentiles)
+        vmin = lo if vmin == 'auto' else vmin
+        vmax = hi if vmax == 'auto' else vmax
+
+    if scaling == 'histeq':
+        scale = _equalizer(sketch, vmin, vmax, bias, contrast)
+    else:
+        def scale(raw):
+            return normalize(raw, vmin, vmax, bias, contrast, scaling)
+
+    return _wrap_sampler(sampler, _stats.timed('normalize', scale))
+
+
+def _wrap_sampler(sampler, func):
+    """
+    Build a sampler which applies func to the output of sampler,
+    keeping any sample_tile method and coverage function
     """
     def result(x, y):
-        raw = sampler(x, y)
-        r = normalize(raw, vmin, vmax, bias, contrast, scaling)
-        return r
+        return func(sampler(x, y))
+
+    if hasattr(sampler, 'sample_tile'):
+        result.sample_tile = lambda pos: func(sampler.sample_tile(pos))
+        if hasattr(sampler, 'index'):
+            result.index = sampler.index
+    if hasattr(sampler, 'mipmap'):
+        result.mipmap = sampler.mipmap
+    if hasattr(sampler, 'coverage'):
+        result.coverage = sampler.coverage
+    return result
+
+
+def _equalizer(sketch, vmin, vmax, bias, contrast):
+    """
+    Build a function which applies a histogram equalization curve
+    """
+    lo, hi = min(vmin, vmax), max(vmin, vmax)
+    values = sketch.values
+    values = values[(values >= lo) & (values <= hi)]
+    if values.size:
+        curve = np.percentile(values, np.linspace(0, 100, 257))
+    else:
+        curve = np.linspace(lo, hi, 257)
+    curve = np.maximum.accumulate(curve)
+    levels = np.linspace(0, 1, curve.size)
+    if vmax < vmin:
+        levels = levels[::-1]
+
+    def result(raw):
+        r = np.interp(np.asarray(raw, dtype=float), curve, levels)
+        r = cscale(r, bias, contrast)
+        r = np.multiply(255, r, out=r)
+        return np.clip(r, 0, 255, out=r).astype(np.uint8)
     return result
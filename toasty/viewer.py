@@ -1,18 +1,78 @@
 """
 Set up a minimal HTTP Server to preview a Toasty-generated
 tile pyramid
+
+    python -m toasty.viewer [port] base_dir
+
+runs a TileServer: a threaded, keep-alive server that computes the
+WTML once, lets browsers cache tiles (and revalidate them with 304
+responses), keeps frequently requested tiles in memory, and sends
+the rest straight from disk with sendfile. If base_dir is a HEALPix
+FITS file, tiles are rendered as they are requested instead.
 """
+from __future__ import print_function, division
 import os
 import sys
+import errno
+import socket
+import hashlib
+import posixpath
+import mimetypes
+from collections import OrderedDict
+from email.utils import parsedate_tz, mktime_tz
+from threading import Lock
 from time import time
 try:
-    from SimpleHTTPServer import SimpleHTTPRequestHandler, test
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+    from BaseHTTPServer import HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
     from cStringIO import StringIO
 except:  # python 3.X
-    from http.server import SimpleHTTPRequestHandler, test
+    from http.server import SimpleHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
     from io import BytesIO
 
 from . import gen_wtml
+from .storage import open_store, parse_tile_path, PackStore
+
+
+def _tile_extension(base_dir):
+    """
+    Return the file extension of the tiles in a pyramid
+    """
+    store = open_store(base_dir)
+    if isinstance(store, PackStore):
+        return store.extension
+    for pth in os.listdir(os.path.join(base_dir, '0', '0')):
+        if pth.startswith('0_0.'):
+            return os.path.splitext(pth)[1]
+    return '.png'
+
+
+def _safe_path(pth):
+    """
+    Normalize the path of a request relative to a pyramid, or
+    return None if it could lead outside of the pyramid
+    """
+    if pth.startswith('/') or '..' in pth.split('/'):
+        return None
+    pth = posixpath.normpath(pth)
+    if pth.startswith('/') or pth == '..' or pth.startswith('../'):
+        return None
+    return pth
+
+
+def _max_depth(base_dir):
+    """
+    Return the depth of a pyramid
+    """
+    store = open_store(base_dir)
+    if isinstance(store, PackStore) and store.depth is not None:
+        return store.depth
+    depths = next(os.walk(base_dir))[1]
+    return max(int(d) for d in depths if d.isdigit())
 
 
 class SimpleWWTHandler(SimpleHTTPRequestHandler):
@@ -23,15 +83,54 @@ class SimpleWWTHandler(SimpleHTTPRequestHandler):
 
         return BytesIO(contents.encode('UTF-8'))
 
+    def serve_bytes(self, contents):
+        if sys.version_info.major == 2:
+            return StringIO(contents)
+        return BytesIO(contents)
+
+    @property
+    def base_dir(self):
+        """The pyramid to serve"""
+        return sys.argv[-1]
+
     @property
     def wtml(self):
         if not hasattr(self, '_wtml'):
-            base_dir = sys.argv[-1]
-            depths = next(os.walk(base_dir))[1]
-            max_depth = max(map(int, depths))
-            self._wtml = gen_wtml(base_dir, max_depth)
+            base_dir = self.base_dir
+            self._wtml = gen_wtml(base_dir, _max_depth(base_dir),
+                                  FileType=_tile_extension(base_dir))
         return self._wtml
 
+    def packed_tile(self):
+        """
+        If the request is for a tile of a packed pyramid, return
+        the PackStore and the tile's path within it. Otherwise None
+        """
+        base_dir = os.path.normpath(self.base_dir)
+        prefix = '/' + base_dir.strip('/') + '/'
+        path = unquote(self.path.split('?')[0].split('#')[0])
+        if not path.startswith(prefix):
+            return None
+        store = open_store(base_dir)
+        if not isinstance(store, PackStore):
+            return None
+        return store, _safe_path(path[len(prefix):]) or ''
+
+    def send_packed_tile(self, store, pth):
+        """Read a tile from its pack, and send the headers"""
+        data = store.get(pth)
+        store.close()
+        if data is None:
+            self.send_error(404, "File not found")
+            return None
+        self.send_response(200)
+        self.send_header("Content-type",
+                         mimetypes.guess_type(pth)[0] or
+                         'application/octet-stream')
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        return self.serve_bytes(data)
+
     def send_head(self):
         if self.path == '/toasty.wtml':
             self.send_response(200)
@@ -51,9 +150,286 @@ class SimpleWWTHandler(SimpleHTTPRequestHandler):
             self.end_headers()
             return self.serve_string(html)
 
+        packed = self.packed_tile()
+        if packed is not None:
+            return self.send_packed_tile(*packed)
         return SimpleHTTPRequestHandler.send_head(self)
 
 
+class HotTileCache(object):
+    """
+    A thread-safe, least-recently-used cache of encoded tiles
+
+    A tile is only cached the second time it is requested, so that
+    clients sweeping over a deep pyramid don't evict the tiles
+    everyone keeps coming back to. Tiles are keyed by their file,
+    offset, length and modification time, so a rebuilt pyramid
+    never serves stale tiles.
+
+    Parameters
+    ----------
+    cache_mb : float (default 64)
+      The maximum size of the cached tiles, in megabytes
+    seen : int (default 100000)
+      How many uncached tiles to remember requests for
+    """
+
+    def __init__(self, cache_mb=64, seen=100000):
+        self.limit = int(cache_mb * 2 ** 20)
+        self.max_seen = seen
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._seen = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        """Return the bytes of a cached tile, or None"""
+        with self._lock:
+            if key not in self._tiles:
+                self.misses += 1
+                return None
+            self.hits += 1
+            data = self._tiles.pop(key)
+            self._tiles[key] = data
+            return data
+
+    def hot(self, key):
+        """
+        Record a request for an uncached tile, and return
+        whether it has been requested before
+        """
+        with self._lock:
+            if key in self._seen:
+                del self._seen[key]
+                return True
+            self._seen[key] = None
+            if len(self._seen) > self.max_seen:
+                self._seen.popitem(last=False)
+            return False
+
+    def put(self, key, data):
+        """Cache the bytes of a tile"""
+        if len(data) > self.limit:
+            return
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._tiles[key] = data
+            self.nbytes += len(data)
+            while self.nbytes > self.limit:
+                _, old = self._tiles.popitem(last=False)
+                self.nbytes -= len(old)
+
+
+class _FileRange(object):
+    """A range of bytes in a file, to send without copying if possible"""
+
+    def __init__(self, pth, offset, length):
+        self.file = open(pth, 'rb')
+        self.offset = offset
+        self.length = length
+
+    def send(self, connection, wfile):
+        wfile.flush()
+        if hasattr(connection, 'sendfile'):
+            connection.sendfile(self.file, self.offset, self.length)
+        else:  # python 2.X
+            self.file.seek(self.offset)
+            wfile.write(self.file.read(self.length))
+
+    def close(self):
+        self.file.close()
+
+
+class CachingWWTHandler(SimpleWWTHandler):
+    """
+    The request handler of a TileServer. Connections are kept alive,
+    and tiles are sent with ETag, Last-Modified and Cache-Control
+    headers, so that browsers can cache and revalidate them
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def base_dir(self):
+        return self.server.base_dir
+
+    @property
+    def wtml(self):
+        return self.server.wtml
+
+    def send_head(self):
+        path = unquote(self.path.split('?')[0].split('#')[0])
+        prefix = self.server.prefix
+        if path.startswith(prefix) and parse_tile_path(path) is not None:
+            pth = _safe_path(path[len(prefix):])
+            if pth is None:
+                self.send_error(404, "File not found")
+                return None
+            return self.send_tile(pth)
+        return SimpleWWTHandler.send_head(self)
+
+    def not_modified(self, etag, mtime):
+        """Whether the client's copy of a tile is still valid"""
+        tags = self.headers.get('If-None-Match')
+        if tags is not None:
+            tags = [t.strip() for t in tags.split(',')]
+            return etag in tags or '*' in tags
+        since = self.headers.get('If-Modified-Since')
+        if since is not None:
+            since = parsedate_tz(since)
+            return since is not None and mktime_tz(since) >= mtime
+        return False
+
+    def send_cache_headers(self, etag, mtime):
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", self.date_time_string(mtime))
+        self.send_header("Cache-Control",
+                         "public, max-age=%i" % self.server.max_age)
+
+    def send_tile(self, pth):
+        """Send the headers of a tile, and return its contents"""
+        store = self.server.store
+        found = store.locate(pth)
+        data = None
+        if found is not None:
+            fname, offset, length = found
+            modified = os.path.getmtime(fname)
+            mtime = int(modified)
+            etag = '"%x-%x-%x"' % (mtime, offset, length)
+        else:  # tiles not kept in files, e.g. rendered on demand
+            data = store.get(pth)
+            if data is None:
+                self.send_error(404, "File not found")
+                return None
+            length = len(data)
+            mtime = self.server.started
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+
+        if self.not_modified(etag, mtime):
+            self.send_response(304)
+            self.send_cache_headers(etag, mtime)
+            self.end_headers()
+            return None
+
+        self.send_response(200)
+        self.send_header("Content-type",
+                         mimetypes.guess_type(pth)[0] or
+                         'application/octet-stream')
+        self.send_header("Content-Length", str(length))
+        self.send_cache_headers(etag, mtime)
+        self.end_headers()
+
+        if data is not None:
+            return self.serve_bytes(data)
+        # ETags are only unique per URL, so key the cache by file
+        cache = self.server.cache
+        key = (fname, offset, length, modified)
+        data = cache.get(key)
+        if data is None and cache.hot(key):
+            with open(fname, 'rb') as infile:
+                infile.seek(offset)
+                data = infile.read(length)
+            cache.put(key, data)
+        if data is not None:
+            return self.serve_bytes(data)
+        return _FileRange(fname, offset, length)
+
+    def copyfile(self, source, outputfile):
+        if isinstance(source, _FileRange):
+            source.send(self.connection, outputfile)
+        else:
+            SimpleWWTHandler.copyfile(self, source, outputfile)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            SimpleWWTHandler.log_message(self, format, *args)
+
+
+class TileServer(ThreadingMixIn, HTTPServer):
+    """
+    A threaded HTTP server, to preview a pyramid with many clients
+
+    Parameters
+    ----------
+    base_dir : str
+      The pyramid to serve, as a directory or pack store (see
+      toasty.storage). Tiles are served at /base_dir/n/y/y_x.png
+    address : (host, port) (default ('', 8000))
+      The address to serve at. Use port 0 for any free port
+    cache_mb : float (default 64)
+      The size of the in-memory cache of frequently requested tiles
+    max_age : int (default 3600)
+      How long browsers may reuse tiles before revalidating them,
+      in seconds
+    verbose : bool (default True)
+      Whether to log each request
+    store : TileStore (optional)
+      The tiles to serve, instead of those in base_dir. The store
+      needs depth and extension attributes, like a TileRenderer
+      (see toasty.render) which renders tiles as they are requested.
+      base_dir is then only the name tiles are served under
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, base_dir, address=('', 8000), cache_mb=64,
+                 max_age=3600, verbose=True, store=None):
+        self.base_dir = os.path.normpath(base_dir)
+        self.prefix = '/' + self.base_dir.strip('/') + '/'
+        if store is None:
+            store = open_store(base_dir)
+            depth, extension = _max_depth(base_dir), _tile_extension(base_dir)
+        else:
+            depth, extension = store.depth, store.extension
+        self.store = store
+        self.wtml = gen_wtml(base_dir, depth, FileType=extension)
+        self.started = int(time())
+        self.cache = HotTileCache(cache_mb)
+        self.max_age = max_age
+        self.verbose = verbose
+        HTTPServer.__init__(self, address, CachingWWTHandler)
+
+    def handle_error(self, request, client_address):
+        # browsers drop requests for tiles panned out of view
+        err = sys.exc_info()[1]
+        if isinstance(err, socket.error) and \
+                err.errno in (errno.EPIPE, errno.ECONNRESET):
+            return
+        HTTPServer.handle_error(self, request, client_address)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.store.close()
+
+
+def serve(base_dir, port=8000, cache_mb=64, max_age=3600):
+    """
+    Preview a pyramid with a TileServer, until interrupted
+
+    If base_dir is a HEALPix FITS file rather than a directory,
+    its tiles are rendered as they are requested (see toasty.render)
+    """
+    store = None
+    if os.path.isfile(base_dir):
+        from .render import TileRenderer
+        store = TileRenderer(base_dir)
+        base_dir = os.path.splitext(os.path.basename(base_dir))[0]
+    server = TileServer(base_dir, ('', port), cache_mb, max_age,
+                        store=store)
+    host, port = server.server_address[:2]
+    print("Serving %s at http://%s:%i" % (base_dir, host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
 html = """
 <html>
 <head>
@@ -150,5 +526,4 @@ function set_layers() {
 """
 
 if __name__ == "__main__":
-    sys.argv.insert(1, '8000')
-    test(HandlerClass=SimpleWWTHandler)
+    serve(sys.argv[-1], int(sys.argv[1]) if len(sys.argv) > 2 else 8000)
@@ -0,0 +1,297 @@
+"""
+Sample cartesian maps which are too large to fit in memory.
+
+Maps are read through memory maps, one window at a time. Each tile
+only reads the block of rows and columns it overlaps, through an LRU
+cache of fixed-size blocks. Since tiles are built in quadtree order,
+neighboring tiles reuse most of the same blocks.
+"""
+from __future__ import print_function, division
+from collections import OrderedDict
+from threading import Lock
+
+import numpy as np
+
+from ._libtoasty import sample_cartesian
+from .frames import frame_sampler
+
+_kernel_dtypes = ('uint8', 'uint16', 'int16', 'int32', 'int64',
+                  'float32', 'float64')
+
+
+def _kernel_dtype(dtype):
+    """The closest dtype that sample_cartesian supports"""
+    dtype = np.dtype(dtype)
+    if dtype.name in _kernel_dtypes:
+        return dtype.newbyteorder('=')
+    if dtype.kind == 'b' or (dtype.kind == 'u' and dtype.itemsize == 1):
+        return np.dtype(np.uint8)
+    if dtype.kind == 'i' and dtype.itemsize == 1:
+        return np.dtype(np.int16)
+    if dtype.kind == 'u' and dtype.itemsize == 4:
+        return np.dtype(np.int64)
+    return np.dtype(np.float64)
+
+
+class _ScaledImage(object):
+    """
+    A FITS image whose raw values are scaled by BSCALE and BZERO
+    as they are read
+    """
+
+    def __init__(self, raw, bscale, bzero):
+        self.raw = raw
+        self.bscale = bscale
+        self.bzero = bzero
+        self.shape = raw.shape
+        self.dtype = np.dtype(np.float32 if raw.dtype.itemsize <= 2
+                              else np.float64)
+
+    def __getitem__(self, index):
+        result = np.asarray(self.raw[index], dtype=self.dtype)
+        result *= self.bscale
+        result += self.bzero
+        return result
+
+
+def open_fits(path, extension=0):
+    """
+    Memory map an image in a FITS file, without reading it
+
+    Parameters
+    ----------
+    path : str
+      The FITS file. Must not be compressed
+    extension : int or str (default 0)
+      The HDU holding the image
+
+    Returns
+    -------
+    An array-like image, to pass to windowed_sampler. Data scaled by
+    BSCALE and BZERO keywords are scaled as they are read
+    """
+    from astropy.io import fits
+
+    hdu = fits.open(path, memmap=True, do_not_scale_image_data=True)[extension]
+    raw = hdu.data
+    bscale = hdu.header.get('BSCALE', 1)
+    bzero = hdu.header.get('BZERO', 0)
+    if bscale == 1 and bzero == 0:
+        return raw
+    return _ScaledImage(raw, bscale, bzero)
+
+
+def open_raw(path, shape, dtype, offset=0):
+    """
+    Memory map an image stored as raw binary data, in row-major order
+
+    Parameters
+    ----------
+    path : str
+      The file to read
+    shape : tuple
+      The (ny, nx) or (ny, nx, nchannel) shape of the image
+    dtype : dtype
+      The type of each value, including its byte order
+    offset : int (default 0)
+      The number of bytes to skip at the start of the file
+    """
+    return np.memmap(path, dtype=dtype, mode='r', shape=tuple(shape),
+                     offset=offset)
+
+
+class BlockCache(object):
+    """
+    A thread-safe, least-recently-used cache of square blocks
+    of a large image
+
+    Parameters
+    ----------
+    data : array-like
+      The image, usually memory mapped
+    block : int (default 512)
+      The width of each block, in pixels
+    cache_mb : float (default 256)
+      The maximum size of the cached blocks, in megabytes
+    """
+
+    def __init__(self, data, block=512, cache_mb=256):
+        self.data = data
+        self.block = block
+        self.limit = int(cache_mb * 2 ** 20)
+        self.shape = tuple(data.shape)
+        self.dtype = _kernel_dtype(data.dtype)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+        self._lock = Lock()
+
+    @property
+    def hit_rate(self):
+        """The fraction of block reads served from the cache"""
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def get(self, i, j):
+        """
+        Return block (i, j), which covers rows [i * block, (i + 1) * block)
+        and columns [j * block, (j + 1) * block)
+        """
+        key = (i, j)
+        with self._lock:
+            if key in self._blocks:
+                self.hits += 1
+                result = self._blocks.pop(key)
+                self._blocks[key] = result
+                return result
+            self.misses += 1
+
+        # read outside the lock, so other threads can use the cache
+        b = self.block
+        result = np.ascontiguousarray(self.data[i * b:(i + 1) * b,
+                                                j * b:(j + 1) * b],
+                                      dtype=self.dtype)
+        with self._lock:
+            if key in self._blocks:  # read by another thread meanwhile
+                return self._blocks[key]
+            self._blocks[key] = result
+            self.nbytes += result.nbytes
+            while self.nbytes > self.limit and len(self._blocks) > 1:
+                _, old = self._blocks.popitem(last=False)
+                self.nbytes -= old.nbytes
+        return result
+
+    def window(self, r0, r1, c0, width):
+        """
+        Read rows r0 to r1 (inclusive) and the width columns starting
+        at c0, wrapping around the right edge of the image
+        """
+        ny, nx = self.shape[:2]
+        b = self.block
+        out = np.empty((r1 - r0 + 1, width) + self.shape[2:],
+                       dtype=self.dtype)
+
+        for i in range(r0 // b, r1 // b + 1):
+            lo, hi = max(r0, i * b), min(r1, (i + 1) * b - 1)
+            col = 0
+            while col < width:
+                c = (c0 + col) % nx
+                j = c // b
+                n = min(width - col, (j + 1) * b - c, nx - c)
+                blk = self.get(i, j)
+                out[lo - r0:hi - r0 + 1, col:col + n] = \
+                    blk[lo - i * b:hi - i * b + 1, c - j * b:c - j * b + n]
+                col += n
+        return out
+
+
+def _pixel_positions(l, b, ny, nx):
+    """The (column, row) position of (lon, lat), like sample_cartesian"""
+    l = (l + np.pi) % (2 * np.pi)
+    u = nx * (1 - l / (2 * np.pi))
+    v = ny * (1 - (b + np.pi / 2) / np.pi)
+    return u, v
+
+
+def _nearest_indices(u, n):
+    """Truncate and clip pixel positions, mapping NaNs to 0"""
+    with np.errstate(invalid='ignore'):
+        u = np.clip(np.where(np.isnan(u), 0, u), 0, n - 1)
+    return u.astype(np.intp)
+
+
+def _column_range(cols, nx):
+    """
+    The shortest range of columns, wrapping around the image,
+    that contains every column in cols. Returns (start, width)
+    """
+    cols = np.unique(cols % nx)
+    if cols.size == 0:
+        return 0, 1
+    gaps = np.diff(np.append(cols, cols[0] + nx))
+    k = np.argmax(gaps)
+    return cols[(k + 1) % cols.size], nx - gaps[k] + 1
+
+
+def windowed_sampler(data, coord='C', interpolation='nearest',
+                     cache_mb=256, block=512, max_window=2 ** 24):
+    """
+    Build a sampler for a cartesian map which may not fit in memory
+
+    The map is oriented like the input to cartesian_sampler, and
+    sampled with the same kernel, with identical results. Each
+    tile reads the rectangle of the map it overlaps, through a
+    BlockCache. Each worker process of a parallel build has its
+    own cache.
+
+    Parameters
+    ----------
+    data : array-like or str
+      The map, as a memory mapped array (see open_fits and open_raw),
+      or the path to a FITS file
+    coord : 'C' | 'G' | 'E' (default 'C')
+      The frame of the map
+    interpolation : 'nearest' | 'bilinear' | 'bicubic'
+      What interpolation scheme to use
+    cache_mb : float (default 256)
+      The size of the block cache, in megabytes
+    block : int (default 512)
+      The width of each cached block, in pixels
+    max_window : int (default 2^24)
+      The largest window to read for one tile, in pixels. Tiles which
+      overlap larger windows are much coarser than the map (e.g. the
+      top levels of a pyramid built with merge=False), and are sampled
+      by reading their nearest pixels straight from the map
+
+    Returns
+    -------
+    A function of (lon, lat). Its cache attribute is the BlockCache
+    """
+    if isinstance(data, str):
+        data = open_fits(data)
+
+    ny, nx = data.shape[:2]
+    if ny * 2 != nx:
+        raise ValueError("Map must be twice as wide as it is tall")
+    interp_opts = ['nearest', 'bilinear', 'bicubic']
+    if interpolation not in interp_opts:
+        raise ValueError("Invalid interpolation %s. Must be one of %s" %
+                         (interpolation, interp_opts))
+
+    cache = BlockCache(data, block, cache_mb)
+    nearest = interpolation == 'nearest'
+
+    def vec2pix(l, b):
+        u, v = _pixel_positions(l, b, ny, nx)
+        if nearest:
+            rows = _nearest_indices(v, ny)
+            cols = _nearest_indices(u, nx)
+            r0, r1 = rows.min(), rows.max()
+        else:
+            with np.errstate(invalid='ignore'):
+                fy = np.floor(v[np.isfinite(v)] - 0.5)
+                fx = np.floor(u[np.isfinite(u)] - 0.5).astype(np.intp)
+            r0 = int(np.clip(fy.min() - 1, 0, ny - 1)) if fy.size else 0
+            r1 = int(np.clip(fy.max() + 2, 0, ny - 1)) if fy.size else 0
+            cols = np.concatenate([fx + k for k in range(-1, 3)])
+
+        # pad by a pixel, to absorb any rounding differences
+        r0, r1 = max(r0 - 1, 0), min(r1 + 1, ny - 1)
+        c0, width = _column_range(cols, nx)
+        c0, width = (c0 - 1) % nx, min(width + 2, nx)
+
+        if (r1 - r0 + 1) * width > max_window:
+            rows = _nearest_indices(v, ny)
+            cols = _nearest_indices(u, nx)
+            return np.asarray(data[rows.ravel(), cols.ravel()],
+                              dtype=cache.dtype).reshape(
+                                  l.shape + cache.shape[2:])
+
+        window = cache.window(r0, r1, c0, width)
+        return sample_cartesian(window, l, b, interpolation=interpolation,
+                                shape=(ny, nx), origin=(r0, c0))
+
+    result = frame_sampler(vec2pix, coord)
+    result.cache = cache
+    return result